@@ -3,6 +3,16 @@ ASGI config for busbuddy project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve through this entry point for the assistant's server-sent events to
+stream (WSGI buffers async responses until they finish), e.g.:
+
+    gunicorn busbuddy.asgi:application -k uvicorn.workers.UvicornWorker
+
+Under ASGI the sync views run in per-request threads, so a persistent
+database connection would be left open by each thread and never reused.
+This entry point therefore defaults SQLITE_CONN_MAX_AGE to 0 (a connection
+per request); set it explicitly only if you know the threads are reused.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -12,5 +22,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'busbuddy.settings')
+# read by busbuddy/sqlite.py when the settings load, see above
+os.environ.setdefault('SQLITE_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
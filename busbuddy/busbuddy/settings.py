@@ -12,6 +12,10 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
+import tempfile
+
+from . import sqlite
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 from pathlib import Path
 
@@ -49,6 +53,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'main.instrumentation.RequestTimingMiddleware',
+    'main.instrumentation.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -61,7 +67,8 @@ ROOT_URLCONF = 'busbuddy.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that also times renders for the request metrics
+        'BACKEND': 'main.instrumentation.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'main', 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -81,10 +88,15 @@ WSGI_APPLICATION = 'busbuddy.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite is tuned for several workers (WAL, busy timeout, IMMEDIATE transactions),
+# see busbuddy/sqlite.py for the environment variables
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': sqlite.conn_max_age(),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': sqlite.options(),
     }
 }
 
@@ -139,9 +151,91 @@ MEDIA_ROOT = BASE_DIR / 'media'
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'index'
 
+# How many days ahead recurring schedules are expanded into dated trips (see `manage.py generate_trips`)
+TRIP_HORIZON_DAYS = int(os.environ.get('TRIP_HORIZON_DAYS', '60'))
+
+# How long seats stay held for an unpaid booking (see `manage.py release_expired_holds`)
+SEAT_HOLD_TTL_SECONDS = int(os.environ.get('SEAT_HOLD_TTL_SECONDS', '600'))
+
+# Cache: per-process local memory by default; CACHE_BACKEND=file shares it between workers
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
+CACHE_DIR = os.environ.get('CACHE_DIR', str(BASE_DIR / 'cache'))
+CACHES = {
+    'default': {
+        'BACKEND': (
+            'django.core.cache.backends.filebased.FileBasedCache'
+            if CACHE_BACKEND == 'file'
+            else 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': CACHE_DIR if CACHE_BACKEND == 'file' else 'busbuddy',
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', '10000'))},
+    },
+    # The search cache's version tokens must be seen by every worker, or a booking served by one
+    # would leave stale results in the others; they always live on disk, whatever holds the entries
+    'search_versions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('SEARCH_VERSIONS_DIR', os.path.join(CACHE_DIR, 'search-versions')),
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('SEARCH_VERSIONS_MAX_ENTRIES', '100000'))},
+    },
+}
+
+# Search results are invalidated by version bumps (see main/services/search_cache.py), so shared
+# entries can live long; per-process ones are kept short to bound what each worker holds
+SEARCH_CACHE_TIMEOUT = int(os.environ.get('SEARCH_CACHE_TIMEOUT', '3600' if CACHE_BACKEND == 'file' else '60'))
+
+# Pages that only change on deploy (index, search, sectors, ...) are cached whole and answer
+# If-None-Match with 304s; see main/services/page_cache.py. Set PAGE_CACHE_VERSION to the
+# release id, or leave it empty to derive it from the template and static files.
+PAGE_CACHE = os.environ.get('PAGE_CACHE', '1').lower() in ('1', 'true', 'yes')
+PAGE_CACHE_VERSION = os.environ.get('PAGE_CACHE_VERSION', '')
+PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', str(24 * 3600)))
+PAGE_CACHE_MAX_AGE = int(os.environ.get('PAGE_CACHE_MAX_AGE', '300'))  # browser freshness, anonymous only
+
+# How often the autocomplete index checks for routes added by other workers
+AUTOCOMPLETE_SYNC_SECONDS = int(os.environ.get('AUTOCOMPLETE_SYNC_SECONDS', '30'))
+
+# Shortest change between two buses the journey planner will offer
+MIN_TRANSFER_MINUTES = int(os.environ.get('MIN_TRANSFER_MINUTES', '10'))
+
+# Per-request query counting, @query_budget enforcement and N+1 detection (main/instrumentation.py);
+# off by default, QUERY_BUDGET_RAISE turns the warnings into errors
+QUERY_INSTRUMENTATION = os.environ.get('QUERY_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+QUERY_BUDGET_RAISE = os.environ.get('QUERY_BUDGET_RAISE', '').lower() in ('1', 'true', 'yes')
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '5'))
+
+# Per-view latency/DB/template/cache metrics with Server-Timing headers (main/services/metrics.py).
+# Each worker writes its counters under METRICS_DIR so /ops/metrics/ reports the whole pool.
+REQUEST_METRICS = os.environ.get('REQUEST_METRICS', '1').lower() in ('1', 'true', 'yes')
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', '1').lower() in ('1', 'true', 'yes')
+METRICS_DIR = os.environ.get('METRICS_DIR', str(BASE_DIR / 'metrics'))
+if sys.argv[1:2] == ['test']:
+    # the test suite's requests are recorded too; keep their files out of the project tree
+    METRICS_DIR = tempfile.mkdtemp(prefix='busbuddy-test-metrics-')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+# files of workers that have not written for this long are dropped from the totals and deleted
+METRICS_STALE_SECONDS = float(os.environ.get('METRICS_STALE_SECONDS', str(24 * 3600)))
+
 # Anthropic / Claude HTTP integration (set via environment variable)
 import os as _os
 ANTHROPIC_API_KEY = _os.environ.get('ANTHROPIC_API_KEY', '')
 AI_ENABLED_MODELS = _os.environ.get('AI_ENABLED_MODELS', 'claude-haiku-4.5').split(',')
+ANTHROPIC_API_URL = _os.environ.get('ANTHROPIC_API_URL', 'https://api.anthropic.com/v1/complete')
+# client limits, see main/services/anthropic_client.py
+ANTHROPIC_TIMEOUT = float(_os.environ.get('ANTHROPIC_TIMEOUT', '20'))
+ANTHROPIC_DEADLINE = float(_os.environ.get('ANTHROPIC_DEADLINE', '30'))
+ANTHROPIC_MAX_RETRIES = int(_os.environ.get('ANTHROPIC_MAX_RETRIES', '3'))
+ANTHROPIC_MAX_CONCURRENCY = int(_os.environ.get('ANTHROPIC_MAX_CONCURRENCY', '8'))
+ANTHROPIC_BREAKER_THRESHOLD = int(_os.environ.get('ANTHROPIC_BREAKER_THRESHOLD', '5'))
+ANTHROPIC_BREAKER_RESET_SECONDS = float(_os.environ.get('ANTHROPIC_BREAKER_RESET_SECONDS', '30'))
+# completion cache: in-process LRU, then a SQLite file shared by workers (see main/services/llm_cache.py)
+LLM_CACHE = _os.environ.get('LLM_CACHE', '1').lower() in ('1', 'true', 'yes')
+LLM_CACHE_PATH = _os.environ.get('LLM_CACHE_PATH', str(BASE_DIR / 'cache' / 'llm.sqlite3'))
+LLM_CACHE_MEMORY_ENTRIES = int(_os.environ.get('LLM_CACHE_MEMORY_ENTRIES', '1024'))
+LLM_CACHE_TTL = int(_os.environ.get('LLM_CACHE_TTL', str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(_os.environ.get('LLM_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+LLM_CACHE_MAX_TEMPERATURE = float(_os.environ.get('LLM_CACHE_MAX_TEMPERATURE', '0'))
+# typed trip queries the rules cannot read are parsed by the model and memoized (main/services/query_parser.py)
+QUERY_PARSER_MEMO_ENTRIES = int(_os.environ.get('QUERY_PARSER_MEMO_ENTRIES', '4096'))
+QUERY_PARSER_MEMO_TTL = int(_os.environ.get('QUERY_PARSER_MEMO_TTL', str(24 * 3600)))
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
\ No newline at end of file
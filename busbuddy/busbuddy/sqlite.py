@@ -0,0 +1,54 @@
+"""
+SQLite connection tuning for running under several gunicorn workers.
+
+Every setting comes from the environment:
+
+    SQLITE_JOURNAL_MODE      journal mode, "wal" so readers never block the writer (default wal)
+    SQLITE_SYNCHRONOUS       "normal" is durable across app crashes under WAL (default normal)
+    SQLITE_BUSY_TIMEOUT_MS   how long a connection waits for the write lock (default 5000)
+    SQLITE_MMAP_SIZE         bytes of the file to memory-map (default 256 MiB)
+    SQLITE_CACHE_SIZE        page cache; negative values are KiB (default -20000, ~20 MB)
+    SQLITE_TRANSACTION_MODE  how atomic blocks BEGIN (default IMMEDIATE)
+    SQLITE_CONN_MAX_AGE      seconds to keep a connection open between requests (default 60;
+                             0 when served through busbuddy/asgi.py)
+
+IMMEDIATE takes the write lock when a transaction starts, so a booking's
+read-then-write transaction waits its turn under busy_timeout instead of
+failing with "database is locked" when two deferred transactions both try
+to upgrade their read lock. It is set for the whole connection rather
+than per transaction because it only applies to atomic blocks: views that
+just read run in autocommit and never BEGIN, and every atomic block in the
+app writes, so no transaction takes the write lock it would not need anyway.
+"""
+import os
+
+
+def pragmas(environ=os.environ):
+    """The PRAGMAs run on every new connection, in order."""
+    return {
+        "journal_mode": environ.get("SQLITE_JOURNAL_MODE", "wal"),
+        "synchronous": environ.get("SQLITE_SYNCHRONOUS", "normal"),
+        "busy_timeout": int(environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+        "mmap_size": int(environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+        "cache_size": int(environ.get("SQLITE_CACHE_SIZE", "-20000")),
+        "foreign_keys": "on",
+    }
+
+
+def init_command(values):
+    return ";".join(f"PRAGMA {name}={value}" for name, value in values.items())
+
+
+def options(environ=os.environ):
+    """OPTIONS for a django.db.backends.sqlite3 DATABASES entry."""
+    values = pragmas(environ)
+    return {
+        "init_command": init_command(values),
+        "transaction_mode": environ.get("SQLITE_TRANSACTION_MODE", "IMMEDIATE") or None,
+        # the sqlite3 module's own wait, which also covers BEGIN IMMEDIATE
+        "timeout": values["busy_timeout"] / 1000,
+    }
+
+
+def conn_max_age(environ=os.environ):
+    return int(environ.get("SQLITE_CONN_MAX_AGE", "60"))
@@ -0,0 +1,178 @@
+"""
+Opt-in SQL instrumentation: per-request query counts, DB time, N+1
+detection and per-view query budgets, plus request timing metrics.
+
+Views declare a ceiling with ``@query_budget(n)``. With
+``QUERY_INSTRUMENTATION`` on, QueryBudgetMiddleware counts every query a
+request runs and logs (or, with ``QUERY_BUDGET_RAISE``, raises
+QueryBudgetExceeded) when a view goes over its budget or repeats one query
+shape ``N_PLUS_ONE_THRESHOLD`` times or more. main/tests.py holds every
+routed view to its budget against a seeded dataset.
+
+RequestTimingMiddleware (REQUEST_METRICS) feeds services/metrics.py and adds
+a Server-Timing header; TimedDjangoTemplates supplies the template time.
+"""
+import logging
+import re
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+from .services import metrics
+
+logger = logging.getLogger("busbuddy.queries")
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(limit):
+    """Declare the most queries a view may run per request."""
+    def decorator(view_func):
+        view_func.query_budget = limit
+        return view_func
+    return decorator
+
+
+def query_shape(sql):
+    """The SQL with literals and IN lists collapsed, so N+1 repeats compare equal."""
+    return _IN_LISTS.sub("(?)", _LITERALS.sub("?", sql))
+
+
+class QueryCounter:
+    """Context manager counting the queries run on the default connection, and their time."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.shapes[query_shape(sql)] += 1
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def repeated(self, threshold=None):
+        """Query shapes run at least `threshold` times: likely N+1 loops."""
+        threshold = threshold or getattr(settings, "N_PLUS_ONE_THRESHOLD", 5)
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+class QueryBudgetMiddleware:
+    """Enforces @query_budget and flags N+1 query shapes; enabled by QUERY_INSTRUMENTATION."""
+
+    def __init__(self, get_response):
+        if not getattr(settings, "QUERY_INSTRUMENTATION", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.query_budget = None
+        with QueryCounter() as counter:
+            response = self.get_response(request)
+        self.report(request, counter)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(view_func, "query_budget", None)
+
+    def report(self, request, counter):
+        problems = []
+        budget = request.query_budget
+        if budget is not None and counter.count > budget:
+            problems.append(f"{counter.count} queries, budget {budget}")
+        for shape, n in counter.repeated():
+            problems.append(f"N+1: {n}x {shape[:200]}")
+        summary = f"{request.method} {request.path}: {counter.count} queries in {counter.seconds * 1000:.1f} ms"
+        if not problems:
+            logger.debug(summary)
+            return
+        message = summary + "; " + "; ".join(problems)
+        if getattr(settings, "QUERY_BUDGET_RAISE", False):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.add_template_time(time.perf_counter() - started)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, timing each top-level render for RequestTimingMiddleware."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class RequestTimingMiddleware:
+    """
+    Records latency, DB time, query count, template time and cache hits per
+    view into services/metrics.py and reports them in a Server-Timing header.
+    Enabled by REQUEST_METRICS.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "REQUEST_METRICS", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings, token = metrics.start()
+        started = time.perf_counter()
+        try:
+            with QueryCounter() as counter:
+                response = self.get_response(request)
+        finally:
+            metrics.finish(token)
+        elapsed = time.perf_counter() - started
+        timings.db_seconds, timings.queries = counter.seconds, counter.count
+
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        metrics.observe(view, request.method, response.status_code, elapsed, timings)
+        if getattr(settings, "SERVER_TIMING_HEADER", True):
+            response["Server-Timing"] = self.server_timing(timings, elapsed)
+        return response
+
+    @staticmethod
+    def server_timing(timings, elapsed):
+        hits, misses = timings.cache_counts()
+        return ", ".join([
+            f'db;dur={timings.db_seconds * 1000:.1f};desc="{timings.queries} queries"',
+            f"tpl;dur={timings.template_seconds * 1000:.1f}",
+            f'cache;desc="{hits} hit, {misses} miss"',
+            f"total;dur={elapsed * 1000:.1f}",
+        ])
@@ -0,0 +1,77 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from main.management.commands.benchmark_requests import percentile
+from main.services import place_index, query_parser
+
+# how people type a trip; {a} and {b} are places
+TEMPLATES = [
+    "{a} to {b}",
+    "from {a} to {b} {day}",
+    "{filter} bus from {a} to {b} {day} {time}",
+    "to {b} from {a} {day}",
+    "{a} {b} {filter} {day}",
+    "need a {filter} bus {a} to {b} on {date}",
+    "{filter} {filter2} from {a} to {b} next {weekday} {time}",
+    "ladies seat {a} to {b} tomorrow",
+    "buses to {b} {day}",
+    "{a_typo} to {b} {day}",
+]
+DAYS = ["", "today", "tomorrow", "day after tomorrow", "friday", "next monday", "this sunday", "tonight"]
+FILTERS = ["AC", "non-ac", "A/C", "sleeper", "seater", "AC sleeper", "non AC seater"]
+TIMES = ["", "morning", "evening", "night", "overnight"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the rule-based pass of the typed trip query parser over generated queries built from "
+        "the place vocabulary: latency percentiles and how many queries would need the model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", type=int, default=20000)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--max-p99-us", type=float, default=None,
+                            help="Fail if the p99 latency is above this many microseconds.")
+
+    def handle(self, *args, **options):
+        place_index.index.sync(force=True)
+        names = sorted(place_index.index.names())
+        if len(names) < 2:
+            raise CommandError("No places to build queries from; load data with generate_dataset first.")
+        rng = random.Random(options["seed"])
+        queries = [self.query(rng, names) for _ in range(options["queries"])]
+        today = timezone.localdate()
+
+        latencies, fallback = [], 0
+        for query in queries:
+            started = time.perf_counter()
+            params, _, leftover = query_parser.parse_rules(query, today)
+            latencies.append((time.perf_counter() - started) * 1e6)
+            if leftover and not ("source" in params and "destination" in params):
+                fallback += 1
+
+        p99 = percentile(latencies, 99)
+        self.stdout.write(
+            f"{len(queries)} queries over {len(names)} places: p50 {percentile(latencies, 50):.1f} us, "
+            f"p95 {percentile(latencies, 95):.1f} us, p99 {p99:.1f} us, max {max(latencies):.1f} us; "
+            f"{100 * fallback / len(queries):.2f}% would go to the model"
+        )
+        if options["max_p99_us"] is not None and p99 > options["max_p99_us"]:
+            raise CommandError(f"p99 {p99:.1f} us is above {options['max_p99_us']} us")
+
+    def query(self, rng, names):
+        a, b = rng.sample(names, 2)
+        weekday = rng.choice(query_parser.WEEKDAYS)
+        typo = a
+        if len(a) >= 6 and " " not in a:
+            i = rng.randrange(1, len(a) - 1)
+            typo = a[:i] + a[i + 1:]  # one letter dropped
+        return " ".join(rng.choice(TEMPLATES).format(
+            a=a, b=b, a_typo=typo, day=rng.choice(DAYS), time=rng.choice(TIMES), weekday=weekday,
+            filter=rng.choice(FILTERS), filter2=rng.choice(FILTERS),
+            date=f"{rng.randint(1, 28)}/{rng.randint(1, 12)}",
+        ).split())
@@ -0,0 +1,178 @@
+import json
+import platform
+import random
+import subprocess
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from main.instrumentation import QueryCounter
+from main.models import Booking, Bus, Conductor, Payment, Route, Schedule, Trip
+
+SCENARIOS = ["search", "booking", "payment", "user_dashboard", "conductor_dashboard"]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * pct // 100) - 1)]
+
+
+def _commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=settings.BASE_DIR, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure p50/p95 latency and queries per request of search, booking, payment and both "
+        "dashboards against the current database (see generate_dataset), and write the results as "
+        "JSON so runs can be compared across commits. Every write is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50, help="Measured requests per scenario.")
+        parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests per scenario first.")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--scenario", action="append", dest="scenarios", choices=SCENARIOS,
+                            help="Run only this scenario (repeatable).")
+        parser.add_argument("--output", default=None,
+                            help="JSON results file (default: benchmark-<commit>.json).")
+        parser.add_argument("--compare", default=None, help="An earlier results file to print deltas against.")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.today = timezone.localdate()
+        self.pick_fixtures()
+
+        results = {}
+        # the test client sends Host: testserver
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]), transaction.atomic():
+            for name in options["scenarios"] or SCENARIOS:
+                results[name] = self.run(name, options["warmup"], options["iterations"])
+                self.report(name, results[name])
+            transaction.set_rollback(True)
+
+        commit = _commit()
+        document = {
+            "commit": commit,
+            "created_at": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "database": {"vendor": connection.vendor, "name": str(connection.settings_dict["NAME"])},
+            "dataset": {
+                model.__name__: model.objects.count()
+                for model in (Bus, Route, Schedule, Trip, Booking, Payment)
+            },
+            "iterations": options["iterations"],
+            "seed": options["seed"],
+            "results": results,
+        }
+        output = options["output"] or f"benchmark-{commit or 'local'}.json"
+        with open(output, "w") as fh:
+            json.dump(document, fh, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {output}"))
+
+        if options["compare"]:
+            self.compare(options["compare"], results)
+
+    def pick_fixtures(self):
+        """Sample the users, conductors and upcoming trips the scenarios draw from."""
+        self.trips = list(
+            Trip.objects.filter(service_date__gte=self.today, service_date__lte=self.today + timedelta(days=14),
+                                cancelled=False)
+            .order_by("pk")
+            .values_list("schedule_id", "service_date", "schedule__route__origin", "schedule__route__destination")[:5000]
+        )
+        if not self.trips:
+            raise CommandError("No upcoming trips; load data with generate_dataset first.")
+        # the busiest riders and conductors, whose dashboards are the slowest
+        self.users = list(
+            Booking.objects.order_by().values("user_id").annotate(n=Count("pk"))
+            .order_by("-n").values_list("user_id", flat=True)[:50]
+        )
+        self.conductors = list(
+            Conductor.objects.annotate(n=Count("buses")).order_by("-n").values_list("user_id", flat=True)[:20]
+        )
+        if not self.users or not self.conductors:
+            raise CommandError("The benchmark needs bookings and conductors; load data with generate_dataset first.")
+        self.accounts = {user.pk: user for user in get_user_model().objects.filter(pk__in=self.users + self.conductors)}
+
+    def client_for(self, user_id):
+        client = Client()
+        client.force_login(self.accounts[user_id])
+        return client
+
+    def request(self, name):
+        """(client, method, url, data) for one request of a scenario; setup requests are not measured."""
+        if name == "search":
+            _, day, origin, destination = self.rng.choice(self.trips)
+            return Client(), "get", reverse("search_results"), {
+                "source": origin, "destination": destination, "travel_date": day.isoformat(),
+            }
+        if name in ("booking", "payment"):
+            client = self.client_for(self.rng.choice(self.users))
+            schedule_id, day, _, _ = self.rng.choice(self.trips)
+            url = reverse("start_booking", kwargs={"schedule_id": schedule_id})
+            data = {"seats": 1, "service_date": day.isoformat()}
+            if name == "booking":
+                return client, "post", url, data
+            response = client.post(url, data)
+            return client, "post", response.url, {}
+        if name == "user_dashboard":
+            return self.client_for(self.rng.choice(self.users)), "get", reverse("user_dashboard"), {}
+        return self.client_for(self.rng.choice(self.conductors)), "get", reverse("conductor_dashboard"), {}
+
+    def run(self, name, warmup, iterations):
+        latencies, queries, errors = [], [], 0
+        for i in range(warmup + iterations):
+            client, method, url, data = self.request(name)
+            with QueryCounter() as counter:
+                started = time.perf_counter()
+                response = getattr(client, method)(url, data)
+                elapsed = time.perf_counter() - started
+            if i < warmup:
+                continue
+            if response.status_code >= 400:
+                errors += 1
+            latencies.append(elapsed * 1000)
+            queries.append(counter.count)
+        return {
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "max_ms": round(max(latencies), 2),
+            "queries_p50": percentile(queries, 50),
+            "queries_max": max(queries),
+            "errors": errors,
+        }
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:>20}: p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, "
+            f"{result['queries_p50']} queries (max {result['queries_max']}), {result['errors']} errors"
+        )
+
+    def compare(self, path, results):
+        with open(path) as fh:
+            previous = json.load(fh)
+        self.stdout.write(f"Compared with {previous.get('commit') or path}:")
+        for name, result in results.items():
+            before = previous["results"].get(name)
+            if not before:
+                continue
+            change = 100 * (result["p95_ms"] - before["p95_ms"]) / before["p95_ms"] if before["p95_ms"] else 0
+            self.stdout.write(
+                f"{name:>20}: p95 {before['p95_ms']} -> {result['p95_ms']} ms ({change:+.0f}%), "
+                f"queries {before['queries_p50']} -> {result['queries_p50']}"
+            )
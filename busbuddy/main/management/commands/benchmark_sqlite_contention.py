@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from busbuddy import sqlite
+
+# Django's stock sqlite3 behaviour: rollback journal, FULL sync, deferred
+# BEGIN, the sqlite3 module's 5 s timeout and a new connection per request
+BASELINE = {
+    "pragmas": {"journal_mode": "delete", "synchronous": "full"},
+    "timeout": 5.0,
+    "transaction_mode": "",
+    "reuse_connection": False,
+}
+
+
+def _tuned_profile():
+    options = sqlite.options()
+    return {
+        "pragmas": sqlite.pragmas(),
+        "timeout": options["timeout"],
+        "transaction_mode": options["transaction_mode"] or "",
+        "reuse_connection": sqlite.conn_max_age() != 0,
+    }
+
+
+def _connect(path, profile):
+    conn = sqlite3.connect(path, timeout=profile["timeout"], isolation_level=None)
+    for name, value in profile["pragmas"].items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+
+def _worker(path, profile, bookings, results):
+    """Make `bookings` booking-shaped write transactions: read availability, decrement, insert."""
+    latencies, errors = [], 0
+    conn = _connect(path, profile) if profile["reuse_connection"] else None
+    for _ in range(bookings):
+        started = time.perf_counter()
+        db = conn or _connect(path, profile)
+        try:
+            db.execute(f"BEGIN {profile['transaction_mode']}")
+            (remaining,) = db.execute("SELECT seats_remaining FROM segment WHERE id = 1").fetchone()
+            if remaining > 0:
+                db.execute("UPDATE segment SET seats_remaining = seats_remaining - 1 WHERE id = 1")
+                db.execute("INSERT INTO booking (segment_id, seats) VALUES (1, 1)")
+            db.execute("COMMIT")
+            latencies.append(time.perf_counter() - started)
+        except sqlite3.OperationalError:
+            errors += 1
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+        finally:
+            if conn is None:
+                db.close()
+    results.put((latencies, errors))
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare booking write contention on SQLite with Django's default connection "
+        "settings and with the tuned settings from busbuddy/sqlite.py."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8, help="Concurrent writer processes.")
+        parser.add_argument("--bookings", type=int, default=200, help="Booking transactions per worker.")
+
+    def run_profile(self, profile, workers, bookings):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.sqlite3")
+            conn = _connect(path, profile)
+            conn.execute("CREATE TABLE segment (id INTEGER PRIMARY KEY, seats_remaining INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE booking (id INTEGER PRIMARY KEY, segment_id INTEGER, seats INTEGER)")
+            conn.execute("INSERT INTO segment VALUES (1, ?)", (workers * bookings,))
+            conn.close()
+
+            results = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(target=_worker, args=(path, profile, bookings, results))
+                for _ in range(workers)
+            ]
+            started = time.perf_counter()
+            for process in processes:
+                process.start()
+            outcomes = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for done, _ in outcomes for latency in done)
+        errors = sum(failed for _, failed in outcomes)
+        return {
+            "committed": len(latencies),
+            "locked_errors": errors,
+            "seconds": round(elapsed, 3),
+            "bookings_per_second": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(statistics.median(latencies) * 1000, 2) if latencies else None,
+            "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2) if latencies else None,
+        }
+
+    def handle(self, *args, **options):
+        workers, bookings = options["workers"], options["bookings"]
+        self.stdout.write(f"{workers} workers x {bookings} booking transactions")
+        for name, profile in (("default", BASELINE), ("tuned", _tuned_profile())):
+            result = self.run_profile(profile, workers, bookings)
+            self.stdout.write(
+                f"{name:>8}: {result['committed']} committed, {result['locked_errors']} 'database is locked', "
+                f"{result['bookings_per_second']}/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms"
+            )
@@ -0,0 +1,308 @@
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, time as dtime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from main.models import (
+    WEEKDAYS,
+    Booking,
+    Bus,
+    Conductor,
+    Payment,
+    Route,
+    Schedule,
+    Stop,
+    Trip,
+    TripSegment,
+)
+from main.services import fares, search_cache, seatmap
+
+# rough west/south Indian intercity network; routes pick their stops from here
+CITIES = [
+    "Mumbai", "Pune", "Nashik", "Aurangabad", "Ahmednagar", "Solapur", "Kolhapur", "Satara",
+    "Sangli", "Karad", "Ratnagiri", "Nagpur", "Amravati", "Akola", "Jalgaon", "Dhule",
+    "Nanded", "Latur", "Jalna", "Beed", "Goa", "Belgaum", "Hubli", "Dharwad", "Bangalore",
+    "Mysore", "Mangalore", "Hyderabad", "Vijayawada", "Chennai", "Indore", "Bhopal",
+    "Surat", "Vadodara", "Ahmedabad", "Rajkot", "Udaipur", "Jaipur", "Raipur", "Nizamabad",
+]
+SEATS = {"Seater": [36, 40, 45, 49], "Sleeper": [30, 36], "Both": [36, 41]}
+# departure clock every 15 minutes, most between 05:00 and 23:45
+DEPARTURE_SLOTS = list(range(5 * 4, 24 * 4))
+PASSWORD = "busbuddy"
+
+
+@contextmanager
+def _explicit_timestamps(*models):
+    """Let bulk_create keep the created_at values we generate instead of auto_now_add's now()."""
+    fields = [model._meta.get_field("created_at") for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def _scaled(value, scale):
+    return max(1, round(value * scale))
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a reproducible synthetic dataset (users, conductors, buses, routes with stops, "
+        "schedules, trips with seat inventory, bookings and payments) for benchmarking."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=1, help="Random seed; the same seed gives the same data.")
+        parser.add_argument("--scale", type=float, default=1.0,
+                            help="Multiplier on every count below, e.g. 0.01 for a quick local dataset.")
+        parser.add_argument("--users", type=int, default=200_000)
+        parser.add_argument("--buses", type=int, default=5_000)
+        parser.add_argument("--buses-per-conductor", type=int, default=10)
+        parser.add_argument("--routes", type=int, default=20_000)
+        parser.add_argument("--schedules", type=int, default=50_000)
+        parser.add_argument("--bookings", type=int, default=5_000_000)
+        parser.add_argument("--history-days", type=int, default=14,
+                            help="Days of past trips (and their bookings) before today.")
+        parser.add_argument("--days", type=int, default=30, help="Days of upcoming trips from today.")
+        parser.add_argument("--batch-size", type=int, default=5_000, help="Rows per bulk_create.")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        self.prefix = f"GEN{options['seed']}"
+        if Bus.objects.filter(registration_number__startswith=f"{self.prefix}-").exists():
+            raise CommandError(f"A dataset with seed {options['seed']} is already loaded; use another --seed.")
+
+        scale = options["scale"]
+        counts = {name: _scaled(options[name], scale) for name in ("users", "buses", "routes", "schedules", "bookings")}
+        conductors = max(1, counts["buses"] // options["buses_per_conductor"])
+        today = timezone.localdate()
+        self.first_day = today - timedelta(days=options["history_days"])
+        self.days = options["history_days"] + options["days"]
+        self.now = timezone.now()
+
+        started = time.perf_counter()
+        with _explicit_timestamps(Conductor, Booking, Payment):
+            self.users = self.create_users(counts["users"])
+            conductor_ids = self.create_conductors(conductors)
+            buses = self.create_buses(counts["buses"], conductor_ids)
+            routes = self.create_routes(counts["routes"], buses)
+            schedules = self.create_schedules(counts["schedules"], routes)
+            trips, bookings = self.create_trips_and_bookings(schedules, routes, buses, counts["bookings"])
+        search_cache.bump_catalog()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {counts['users']} users, {conductors} conductors, {len(buses)} buses, {len(routes)} routes, "
+            f"{len(schedules)} schedules, {trips} trips and {bookings} bookings "
+            f"in {time.perf_counter() - started:.1f}s (seed {options['seed']}, password {PASSWORD!r})."
+        ))
+
+    def log(self, message):
+        self.stdout.write(message)
+        self.stdout.flush()
+
+    def create(self, model, objects):
+        """bulk_create in batches, one transaction per batch; returns the objects with their pks."""
+        created = []
+        for start in range(0, len(objects), self.batch_size):
+            with transaction.atomic():
+                created += model.objects.bulk_create(objects[start:start + self.batch_size])
+        return created
+
+    def create_users(self, count):
+        User = get_user_model()
+        password = make_password(PASSWORD)  # hashed once, shared by every generated user
+        users = [
+            User(
+                username=f"{self.prefix.lower()}-user{i}@example.com",
+                email=f"{self.prefix.lower()}-user{i}@example.com",
+                password=password,
+                first_name=f"Rider{i}",
+            )
+            for i in range(count)
+        ]
+        users = self.create(User, users)
+        self.log(f"{len(users)} users")
+        return [user.pk for user in users]
+
+    def create_conductors(self, count):
+        User = get_user_model()
+        password = make_password(PASSWORD)
+        users = self.create(User, [
+            User(username=f"{self.prefix.lower()}-conductor{i}@example.com",
+                 email=f"{self.prefix.lower()}-conductor{i}@example.com", password=password)
+            for i in range(count)
+        ])
+        joined = self.now - timedelta(days=365)
+        conductors = self.create(Conductor, [
+            Conductor(user=user, phone=f"9{self.rng.randrange(10 ** 9):09d}",
+                      license_number=f"{self.prefix}-L{i:05d}", created_at=joined)
+            for i, user in enumerate(users)
+        ])
+        self.log(f"{len(conductors)} conductors")
+        return [conductor.pk for conductor in conductors]
+
+    def create_buses(self, count, conductor_ids):
+        buses = []
+        for i in range(count):
+            bus_type = self.rng.choices(["Seater", "Sleeper", "Both"], weights=[6, 3, 1])[0]
+            buses.append(Bus(
+                bus_name=f"{self.rng.choice(CITIES)} Express {i}",
+                registration_number=f"{self.prefix}-{i:06d}",
+                ac_type=self.rng.choice(["AC", "Non-AC"]),
+                bus_type=bus_type,
+                is_sleeper=bus_type == "Sleeper",
+                total_seats=self.rng.choice(SEATS[bus_type]),
+                conductor_id=conductor_ids[i % len(conductor_ids)],
+            ))
+        buses = self.create(Bus, buses)
+        self.log(f"{len(buses)} buses")
+        return {bus.pk: bus for bus in buses}
+
+    def create_routes(self, count, buses):
+        bus_ids = list(buses)
+        routes, stop_times = [], []
+        for i in range(count):
+            bus = buses[bus_ids[i % len(bus_ids)]]
+            places = self.rng.sample(CITIES, 2 + self.rng.choices(range(7), weights=[3, 4, 4, 3, 2, 1, 1])[0])
+            route = Route(bus=bus, origin=places[0], destination=places[-1], stops=", ".join(places[1:-1]))
+            route.fare_matrix = fares.build(len(places), bus.ac_type, bus.is_sleeper)
+            routes.append(route)
+            stop_times.append(places[1:-1])
+        routes = self.create(Route, routes)
+
+        stops = []
+        for route, names in zip(routes, stop_times):
+            minutes = self.rng.randrange(5 * 60, 12 * 60)
+            for order, name in enumerate(names):
+                minutes += self.rng.randrange(45, 150)
+                stops.append(Stop(route=route, name=name, order=order,
+                                  time=dtime((minutes // 60) % 24, minutes % 60)))
+        self.create(Stop, stops)
+        self.log(f"{len(routes)} routes, {len(stops)} stops")
+        return {route.pk: route for route in routes}
+
+    def create_schedules(self, count, routes):
+        route_ids = list(routes)
+        schedules = []
+        for i in range(count):
+            route = routes[route_ids[i % len(route_ids)]]
+            departure = self.rng.choice(DEPARTURE_SLOTS) * 15
+            arrival = departure + 60 * (len(route.stop_names()) - 1) * self.rng.randrange(2, 5)
+            kind = self.rng.random()
+            if kind < 0.6:
+                days = WEEKDAYS
+            elif kind < 0.9:
+                days = sorted(self.rng.sample(WEEKDAYS, self.rng.randrange(2, 6)), key=WEEKDAYS.index)
+            else:
+                days = None
+            schedules.append(Schedule(
+                bus_id=route.bus_id,
+                route=route,
+                date=None if days else self.first_day + timedelta(days=self.rng.randrange(self.days)),
+                departure_time=dtime(departure // 60, departure % 60),
+                arrival_time=dtime((arrival // 60) % 24, arrival % 60),
+                days=",".join(days) if days else None,
+                days_mask=sum(1 << WEEKDAYS.index(day) for day in days) if days else 0,
+            ))
+        schedules = self.create(Schedule, schedules)
+        self.log(f"{len(schedules)} schedules")
+        return schedules
+
+    def service_dates(self, schedule):
+        if schedule.date:
+            return [schedule.date]
+        dates = (self.first_day + timedelta(days=i) for i in range(self.days))
+        return [day for day in dates if schedule.days_mask & (1 << day.weekday())]
+
+    def create_trips_and_bookings(self, schedules, routes, buses, target):
+        """
+        Trips, their segments and their bookings, a slice of schedules at a time.
+        Seats are allocated here with the same seat maps the booking flow keeps,
+        so segment counters and maps match the Booking table without a reconcile.
+        """
+        total_trips = sum(len(self.service_dates(schedule)) for schedule in schedules)
+        per_trip = target / max(1, total_trips)
+        trip_count = booking_count = 0
+        step = max(1, self.batch_size // max(1, self.days))
+        for start in range(0, len(schedules), step):
+            with transaction.atomic():
+                trips = Trip.objects.bulk_create([
+                    Trip(schedule=schedule, service_date=day)
+                    for schedule in schedules[start:start + step]
+                    for day in self.service_dates(schedule)
+                ])
+                segments, bookings = [], []
+                for trip in trips:
+                    wanted = int(per_trip) + (self.rng.random() < per_trip % 1)
+                    wanted = min(wanted, target - booking_count - len(bookings))
+                    route = routes[trip.schedule.route_id]
+                    bus = buses[route.bus_id]
+                    segments += self.fill_trip(trip, route, bus, wanted, bookings)
+                bookings = Booking.objects.bulk_create(bookings, batch_size=self.batch_size)
+                Payment.objects.bulk_create([
+                    Payment(booking=booking, provider="razorpay", provider_payment_id=f"sim_{booking.pk}",
+                            amount=booking._fare, status="succeeded" if booking.paid else "failed",
+                            created_at=booking.created_at)
+                    for booking in bookings
+                ], batch_size=self.batch_size)
+                TripSegment.objects.bulk_create(segments, batch_size=self.batch_size)
+            trip_count += len(trips)
+            booking_count += len(bookings)
+            self.log(f"{trip_count}/{total_trips} trips, {booking_count} bookings")
+        return trip_count, booking_count
+
+    def fill_trip(self, trip, route, bus, wanted, bookings):
+        """Append up to `wanted` bookings for `trip` to `bookings`; returns the trip's TripSegments."""
+        positions = len(route.stop_names())
+        maps = [0] * (positions - 1)
+        departs = timezone.make_aware(datetime.combine(trip.service_date, trip.schedule.departure_time))
+        for _ in range(wanted):
+            if self.rng.random() < 0.6:
+                board, alight = 0, positions - 1
+            else:
+                board = self.rng.randrange(positions - 1)
+                alight = self.rng.randrange(board + 1, positions)
+            seats = self.rng.choices([1, 2, 3, 4], weights=[50, 30, 12, 8])[0]
+            occupied = 0
+            for index in range(board, alight):
+                occupied |= maps[index]
+            taken = seatmap.allocate(occupied, bus.total_seats, seats)
+            if taken is None:
+                continue
+            cancelled = self.rng.random() < 0.05
+            if not cancelled:
+                bits = seatmap.mask(taken)
+                for index in range(board, alight):
+                    maps[index] |= bits
+            fare = seats * fares.lookup(bytes(route.fare_matrix), positions, board, alight)
+            created = min(self.now, departs - timedelta(minutes=self.rng.randrange(30, 30 * 24 * 60)))
+            booking = Booking(
+                user_id=self.rng.choice(self.users),
+                schedule_id=trip.schedule_id,
+                trip=trip,
+                seats=seats,
+                board_order=board,
+                alight_order=alight,
+                seat_numbers=seatmap.format_seat_numbers(taken),
+                amount_paid=0 if cancelled else fare,
+                paid=not cancelled,
+                cancelled=cancelled,
+                created_at=created,
+            )
+            booking._fare = fare
+            bookings.append(booking)
+        return [
+            TripSegment(trip=trip, index=index, seat_map=seatmap.to_bytes(bits, bus.total_seats),
+                        seats_remaining=bus.total_seats - bin(bits).count("1"))
+            for index, bits in enumerate(maps)
+        ]
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.services import search_cache, trips
+
+
+class Command(BaseCommand):
+    help = "Materialize dated trips for recurring schedules over a rolling horizon."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None,
+                            help="Horizon length in days (default: settings.TRIP_HORIZON_DAYS).")
+        parser.add_argument("--start", default=None, help="First service date, YYYY-MM-DD (default: today).")
+
+    def handle(self, *args, **options):
+        start = None
+        if options["start"]:
+            try:
+                start = datetime.strptime(options["start"], "%Y-%m-%d").date()
+            except ValueError:
+                raise CommandError("--start must be YYYY-MM-DD")
+
+        created = trips.materialize_trips(start=start, days=options["days"])
+        cancelled = trips.apply_service_exceptions(start=start)
+        search_cache.bump_catalog()
+        self.stdout.write(self.style.SUCCESS(
+            f"Materialized {created} trip(s); cancelled {cancelled} trip(s) on service exception dates."
+        ))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Trip, TripSegment
+from main.services import inventory, search_cache
+
+
+class Command(BaseCommand):
+    help = "Rebuild trip segment seats_remaining and seat maps from the Booking table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--schedule", type=int, action="append", dest="schedules",
+                            help="Only reconcile trips of this schedule id (repeatable).")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report drifted segments without writing.")
+
+    def handle(self, *args, **options):
+        segments = TripSegment.objects.all()
+        if options["schedules"]:
+            segments = segments.filter(trip__schedule_id__in=options["schedules"])
+
+        if options["dry_run"]:
+            drifted = inventory.drifted_segments(segments).values_list(
+                "trip_id", "index", "seats_remaining", "expected"
+            )
+            for trip_id, index, current, expected in drifted:
+                self.stdout.write(f"trip {trip_id} segment {index}: seats_remaining={current}, expected={expected}")
+            self.stdout.write(f"{len(drifted)} segment(s) out of sync.")
+            return
+
+        trips = Trip.objects.all()
+        if options["schedules"]:
+            trips = trips.filter(schedule_id__in=options["schedules"])
+
+        drifted = inventory.rebuild_seats_remaining(segments)
+        remapped = inventory.rebuild_seat_maps(trips)
+        if drifted or remapped:
+            search_cache.bump_catalog()
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciled seat inventory; {drifted} segment counter(s) and {remapped} seat map(s) were out of sync."
+        ))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.services import holds
+
+
+class Command(BaseCommand):
+    help = "Release seat holds whose payment window has expired."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Holds released per bulk update (default: 500).")
+        parser.add_argument("--loop", type=float, default=0, metavar="SECONDS",
+                            help="Keep running, sweeping every SECONDS (default: sweep once and exit).")
+
+    def handle(self, *args, **options):
+        while True:
+            released = holds.release_expired(batch_size=options["batch_size"])
+            self.stdout.write(f"Released {released} expired hold(s); {holds.live_count()} live hold(s).")
+            if not options["loop"]:
+                break
+            time.sleep(options["loop"])
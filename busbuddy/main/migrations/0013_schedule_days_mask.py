@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:46
+
+from django.db import migrations, models
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def fill_days_mask(apps, schema_editor):
+    Schedule = apps.get_model('main', 'Schedule')
+    schedules = list(Schedule.objects.exclude(days__isnull=True).exclude(days=''))
+    for schedule in schedules:
+        mask = 0
+        for day in schedule.days.split(','):
+            abbr = day.strip()[:3].capitalize()
+            if abbr in WEEKDAYS:
+                mask |= 1 << WEEKDAYS.index(abbr)
+        schedule.days_mask = mask
+    Schedule.objects.bulk_update(schedules, ['days_mask'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_schedule_date_alter_schedule_days'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='days_mask',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(fill_days_mask, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:47
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_seats_remaining(apps, schema_editor):
+    Booking = apps.get_model('main', 'Booking')
+    Bus = apps.get_model('main', 'Bus')
+    Schedule = apps.get_model('main', 'Schedule')
+    booked = (
+        Booking.objects.filter(schedule=OuterRef('pk'), cancelled=False)
+        .values('schedule')
+        .annotate(total=Sum('seats'))
+        .values('total')
+    )
+    total_seats = Bus.objects.filter(pk=OuterRef('bus_id')).values('total_seats')
+    Schedule.objects.update(seats_remaining=Subquery(total_seats) - Coalesce(Subquery(booked), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_schedule_days_mask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='seats_remaining',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_seats_remaining, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:49
+
+import django.db.models.deletion
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def attach_bookings_to_trips(apps, schema_editor):
+    """
+    Existing bookings only reference a schedule. Attach each one to the trip it
+    most plausibly was for: the schedule's date, or for recurring schedules the
+    first running day on or after the booking was made.
+    """
+    Booking = apps.get_model('main', 'Booking')
+    Trip = apps.get_model('main', 'Trip')
+
+    trips = {}
+    for booking in Booking.objects.select_related('schedule__bus').filter(trip__isnull=True):
+        schedule = booking.schedule
+        service_date = schedule.date
+        if service_date is None and schedule.days_mask:
+            day = booking.created_at.date()
+            while not schedule.days_mask & (1 << day.weekday()):
+                day += timedelta(days=1)
+            service_date = day
+        if service_date is None:
+            continue
+
+        key = (schedule.pk, service_date)
+        if key not in trips:
+            trips[key], _ = Trip.objects.get_or_create(
+                schedule=schedule,
+                service_date=service_date,
+                defaults={'seats_remaining': schedule.bus.total_seats},
+            )
+        trip = trips[key]
+        booking.trip = trip
+        booking.save(update_fields=['trip'])
+        if not booking.cancelled:
+            Trip.objects.filter(pk=trip.pk).update(seats_remaining=models.F('seats_remaining') - booking.seats)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_schedule_seats_remaining'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('reason', models.CharField(choices=[('holiday', 'Holiday'), ('cancelled', 'Cancelled')], default='cancelled', max_length=20)),
+                ('note', models.CharField(blank=True, max_length=200)),
+                ('schedule', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='main.schedule')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Trip',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_date', models.DateField(db_index=True)),
+                ('seats_remaining', models.IntegerField(default=0)),
+                ('cancelled', models.BooleanField(default=False)),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trips', to='main.schedule')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='trip',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='bookings', to='main.trip'),
+        ),
+        migrations.AddConstraint(
+            model_name='trip',
+            constraint=models.UniqueConstraint(fields=('schedule', 'service_date'), name='unique_trip_per_schedule_date'),
+        ),
+        migrations.RunPython(attach_bookings_to_trips, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='schedule',
+            name='seats_remaining',
+        ),
+    ]
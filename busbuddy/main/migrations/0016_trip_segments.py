@@ -0,0 +1,58 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def split_trips_into_segments(apps, schema_editor):
+    """Existing bookings cover the whole route, so every segment starts at the trip's counter."""
+    Trip = apps.get_model('main', 'Trip')
+    TripSegment = apps.get_model('main', 'TripSegment')
+    segments = []
+    for trip in Trip.objects.select_related('schedule__route'):
+        route = trip.schedule.route
+        count = 1
+        if route is not None:
+            count = len([s for s in (route.stops or '').split(',') if s.strip()]) + 1
+        segments += [
+            TripSegment(trip=trip, index=i, seats_remaining=trip.seats_remaining) for i in range(count)
+        ]
+    TripSegment.objects.bulk_create(segments, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_trips'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='alight_order',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='board_order',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='TripSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('seats_remaining', models.IntegerField(default=0)),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='main.trip')),
+            ],
+            options={
+                'ordering': ['index'],
+                'constraints': [models.UniqueConstraint(fields=('trip', 'index'), name='unique_segment_per_trip')],
+            },
+        ),
+        migrations.RunPython(split_trips_into_segments, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='trip',
+            name='seats_remaining',
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.7 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+def assign_seat_numbers(apps, schema_editor):
+    """Give live bookings made before seat maps existed the lowest free seats on their journey."""
+    Booking = apps.get_model('main', 'Booking')
+    TripSegment = apps.get_model('main', 'TripSegment')
+
+    bookings = (
+        Booking.objects.filter(cancelled=False, trip__isnull=False)
+        .select_related('trip__schedule__bus')
+        .order_by('created_at', 'pk')
+    )
+    maps = {}
+    for booking in bookings:
+        if booking.trip_id not in maps:
+            maps[booking.trip_id] = {seg.index: seg for seg in TripSegment.objects.filter(trip_id=booking.trip_id)}
+            for seg in maps[booking.trip_id].values():
+                seg.bits = 0
+                seg.total = booking.trip.schedule.bus.total_seats
+        segments = [
+            seg for index, seg in maps[booking.trip_id].items()
+            if index >= (booking.board_order or 0) and (booking.alight_order is None or index < booking.alight_order)
+        ]
+        occupied = 0
+        for seg in segments:
+            occupied |= seg.bits
+
+        taken = [int(p) for p in booking.seat_numbers.split(',') if p.strip().isdigit()]
+        if not taken:
+            total = booking.trip.schedule.bus.total_seats
+            taken = [n for n in range(1, total + 1) if not occupied >> (n - 1) & 1][:booking.seats]
+            booking.seat_numbers = ','.join(str(n) for n in taken)
+            booking.save(update_fields=['seat_numbers'])
+        for n in taken:
+            for seg in segments:
+                seg.bits |= 1 << (n - 1)
+
+    for trip_id, segments in maps.items():
+        for seg in segments.values():
+            total = max(seg.bits.bit_length(), seg.total)
+            seg.seat_map = seg.bits.to_bytes((total + 7) // 8, 'little')
+        TripSegment.objects.bulk_update(list(segments.values()), ['seat_map'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_trip_segments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tripsegment',
+            name='seat_map',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(assign_seat_numbers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-18 16:03
+
+import struct
+
+from django.db import migrations, models
+
+
+def build_fare_matrices(apps, schema_editor):
+    """Precompute every existing route's fare matrix (frozen copy of services/fares.py)."""
+    Route = apps.get_model('main', 'Route')
+
+    routes = list(Route.objects.select_related('bus'))
+    for route in routes:
+        count = 2 + len([s for s in (route.stops or '').split(',') if s.strip()])
+        surcharges = []
+        if route.bus.is_sleeper:
+            surcharges.append(130)
+        if route.bus.ac_type == 'AC':
+            surcharges.append(120)
+        matrix = bytearray()
+        for board in range(count):
+            for alight in range(board + 1, count):
+                fare, divisor = 150 + (alight - board + 1) * 80, 1
+                for percent in surcharges:
+                    fare *= percent
+                    divisor *= 100
+                matrix += struct.pack('<I', fare // divisor)
+        route.fare_matrix = bytes(matrix)
+    Route.objects.bulk_update(routes, ['fare_matrix'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_seat_holds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='fare_matrix',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(build_fare_matrices, migrations.RunPython.noop),
+    ]
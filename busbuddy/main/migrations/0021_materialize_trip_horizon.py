@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations
+from django.utils import timezone
+
+
+def materialize_horizon(apps, schema_editor):
+    """
+    Earlier migrations only created trips for existing bookings. Give every
+    schedule its trips over the horizon, as generate_trips would, so searches
+    and bookings find them right after migrating.
+    """
+    Schedule = apps.get_model('main', 'Schedule')
+    ServiceException = apps.get_model('main', 'ServiceException')
+    Trip = apps.get_model('main', 'Trip')
+    TripSegment = apps.get_model('main', 'TripSegment')
+
+    start = timezone.localdate()
+    dates = [start + timedelta(days=i) for i in range(getattr(settings, 'TRIP_HORIZON_DAYS', 60))]
+    closed, skipped = set(), set()
+    for schedule_id, day in ServiceException.objects.filter(date__gte=start).values_list('schedule_id', 'date'):
+        if schedule_id is None:
+            closed.add(day)
+        else:
+            skipped.add((schedule_id, day))
+    existing = set(Trip.objects.filter(service_date__gte=start).values_list('schedule_id', 'service_date'))
+
+    for schedule in Schedule.objects.select_related('bus', 'route'):
+        if schedule.date:
+            running = [schedule.date] if schedule.date >= start else []
+        else:
+            running = [day for day in dates if schedule.days_mask & (1 << day.weekday())]
+        running = [
+            day for day in running
+            if day not in closed and (schedule.pk, day) not in skipped and (schedule.pk, day) not in existing
+        ]
+        if not running:
+            continue
+        trips = Trip.objects.bulk_create([Trip(schedule=schedule, service_date=day) for day in running])
+        route = schedule.route
+        count = 1
+        if route is not None:
+            count = len([s for s in (route.stops or '').split(',') if s.strip()]) + 1
+        TripSegment.objects.bulk_create([
+            TripSegment(trip=trip, index=i, seats_remaining=schedule.bus.total_seats)
+            for trip in trips for i in range(count)
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(materialize_horizon, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,8 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 
+from .services import fares
+
 
 class Conductor(models.Model):
     user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, related_name='conductor')
@@ -34,16 +36,75 @@ class Bus(models.Model):
     def __str__(self):
         return f"{self.bus_name} ({self.registration_number})"
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            return
+        # fares depend on the bus class, so reprice the bus's routes
+        routes = list(self.routes.only("pk", "origin", "stops", "destination"))
+        for route in routes:
+            route.fare_matrix = route.build_fare_matrix(self)
+        Route.objects.bulk_update(routes, ["fare_matrix"])
+
 
 class Route(models.Model):
     bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name='routes')
     origin = models.CharField(max_length=150)
     destination = models.CharField(max_length=150)
     stops = models.TextField(blank=True, help_text='Comma-separated stops')
+    # packed upper-triangular fares between stop positions, see services/fares.py
+    fare_matrix = models.BinaryField(default=b"", editable=False)
 
     def __str__(self):
         return f"{self.origin} → {self.destination}"
 
+    def save(self, *args, **kwargs):
+        self.fare_matrix = self.build_fare_matrix(self.bus)
+        super().save(*args, **kwargs)
+
+    def stop_names(self):
+        return route_stop_names(self.origin, self.stops, self.destination)
+
+    def build_fare_matrix(self, bus):
+        return fares.build(len(self.stop_names()), bus.ac_type, bus.is_sleeper)
+
+    def fare(self, board=0, alight=None):
+        """Per-seat fare from stop position `board` to `alight` (the last stop by default)."""
+        matrix = bytes(self.fare_matrix or b"")
+        count = fares.stop_count(matrix)
+        alight = count - 1 if alight is None else alight
+        return fares.lookup(matrix, count, board, alight)
+
+
+def route_stop_names(origin, stops, destination):
+    """Return the stop sequence of a route: [origin, stops..., destination].
+    A stop's index in this list is its position; segment i runs from position i to i + 1."""
+    names = [origin or ""]
+    if stops:
+        names += [s.strip() for s in stops.split(",") if s.strip()]
+    names.append(destination or "")
+    return names
+
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def weekday_bit(day):
+    """Bit for a weekday name ("Mon", "monday", ...), Monday = 1. Unknown names give 0."""
+    abbr = (day or "").strip()[:3].capitalize()
+    if abbr not in WEEKDAYS:
+        return 0
+    return 1 << WEEKDAYS.index(abbr)
+
+
+def days_to_mask(days):
+    """Convert a days CSV such as "Mon,Wed,Fri" into a weekday bitmask."""
+    mask = 0
+    for day in (days or "").split(","):
+        mask |= weekday_bit(day)
+    return mask
+
 
 class Schedule(models.Model):
     bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name='schedules')
@@ -52,46 +113,214 @@ class Schedule(models.Model):
     departure_time = models.TimeField()
     arrival_time = models.TimeField()
     days = models.CharField(max_length=50, null=True, blank=True)  # Make optional for date-based schedules
+    days_mask = models.PositiveSmallIntegerField(default=0, db_index=True)  # bit 0 = Mon ... bit 6 = Sun, mirrors `days`
+
+    class Meta:
+        indexes = [
+            # most schedules are recurring (no date); index only the dated ones
+            models.Index(fields=['date'], condition=models.Q(date__isnull=False), name='schedule_dated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.bus.bus_name} {self.departure_time} → {self.arrival_time} ({self.days})"
 
+    def runs_on(self, day):
+        """True if this schedule operates on `day` (ignores service exceptions)."""
+        if self.date:
+            return self.date == day
+        return bool(self.days_mask & (1 << day.weekday()))
+
+
+class Trip(models.Model):
+    """One dated departure of a Schedule. Bookings and seat inventory are kept per trip."""
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name='trips')
+    service_date = models.DateField(db_index=True)
+    cancelled = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['schedule', 'service_date'], name='unique_trip_per_schedule_date'),
+        ]
+
+    def __str__(self):
+        return f"{self.schedule} on {self.service_date}"
+
+
+class TripSegment(models.Model):
+    """Seat inventory of a trip between route positions `index` and `index + 1`."""
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='segments')
+    index = models.PositiveSmallIntegerField()
+    seats_remaining = models.IntegerField(default=0)  # bus.total_seats minus bookings covering this segment, see services/inventory.py
+    seat_map = models.BinaryField(default=b'')  # bitset, bit n-1 set when seat n is taken, see services/seatmap.py
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(fields=['trip', 'index'], name='unique_segment_per_trip'),
+        ]
+
+    def __str__(self):
+        return f"{self.trip} segment {self.index}"
+
+
+class ServiceException(models.Model):
+    """A date a schedule does not run. Without a schedule it applies to every schedule (public holiday)."""
+    REASON_CHOICES = [("holiday", "Holiday"), ("cancelled", "Cancelled")]
+
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name='exceptions', null=True, blank=True)
+    date = models.DateField(db_index=True)
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES, default="cancelled")
+    note = models.CharField(max_length=200, blank=True)
+
+    def __str__(self):
+        return f"{self.get_reason_display()} on {self.date} ({self.schedule or 'all schedules'})"
+
+    def save(self, *args, **kwargs):
+        # trips already materialized on the date stop being bookable; a moved exception reopens its old date
+        from .services import trips
+        previous = None
+        if not self._state.adding:
+            previous = ServiceException.objects.filter(pk=self.pk).values_list("schedule_id", "date").first()
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if previous and previous != (self.schedule_id, self.date):
+                trips.lift_exception(*previous)
+            trips.apply_exception(self.schedule_id, self.date)
+
+    def delete(self, *args, **kwargs):
+        from .services import trips
+        with transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            trips.lift_exception(self.schedule_id, self.date)
+        return deleted
+
 User = get_user_model()
 
 
 class Booking(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bookings')
-    schedule = models.ForeignKey('Schedule', on_delete=models.CASCADE, related_name='bookings')
+    # both FKs lead a composite index below, which also serves plain FK lookups
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bookings', db_index=False)
+    schedule = models.ForeignKey('Schedule', on_delete=models.CASCADE, related_name='bookings', db_index=False)
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='bookings', null=True, blank=True)
     seats = models.PositiveIntegerField()
+    # route positions the passenger boards and alights at; empty means the whole route
+    board_order = models.PositiveSmallIntegerField(null=True, blank=True)
+    alight_order = models.PositiveSmallIntegerField(null=True, blank=True)
     seat_numbers = models.CharField(max_length=200, blank=True)  # CSV like "1,2,3"
     amount_paid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     paid = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     cancelled = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['schedule', 'cancelled'], name='booking_schedule_cancelled_idx'),
+            # live bookings of a trip, for availability and reconciliation
+            models.Index(fields=['trip'], condition=models.Q(cancelled=False), name='booking_live_trip_idx'),
+            # the user's history, newest first (keyset pages on created_at, pk)
+            models.Index(fields=['user', 'created_at'], name='booking_user_created_idx'),
+        ]
+
     def __str__(self):
         return f"Booking #{self.pk} by {self.user} for {self.schedule}"
 
 
+class SeatHold(models.Model):
+    """Seats taken by an unpaid booking. Released by the sweeper if payment does not finish by `expires_at`."""
+    booking = models.OneToOneField(Booking, on_delete=models.CASCADE, related_name='hold')
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Hold for booking #{self.booking_id} until {self.expires_at}"
+
+
 class Payment(models.Model):
     booking = models.OneToOneField(Booking, on_delete=models.CASCADE, related_name='payment')
     provider = models.CharField(max_length=50, blank=True)  # 'razorpay', 'stripe'
     provider_payment_id = models.CharField(max_length=200, blank=True, null=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    status = models.CharField(max_length=50, default='initiated')  # initiated, succeeded, failed
+    status = models.CharField(max_length=50, default='initiated')  # initiated, succeeded, failed, expired
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status'], name='payment_status_idx'),
+        ]
+
     def __str__(self):
         return f"Payment {self.provider} {self.status} for {self.booking}"
 
 
-from django.db.models import Sum
-def seats_booked_for_schedule(schedule):
-    booked = schedule.bookings.filter(cancelled=False).aggregate(total=Sum('seats'))['total'] or 0
+from django.db.models import Min, OuterRef, Q, QuerySet, Subquery, Sum
+from django.utils import timezone
+def seats_booked_for_trip(trip):
+    booked = trip.bookings.filter(cancelled=False).aggregate(total=Sum('seats'))['total'] or 0
     return int(booked)
 
-def seats_available(schedule):
-    return max(0, schedule.bus.total_seats - seats_booked_for_schedule(schedule))
+def segment_range(board=None, alight=None):
+    """Filter for the segments a journey from position `board` to `alight` covers (None = route end)."""
+    q = Q(index__gte=board or 0)
+    if alight is not None:
+        q &= Q(index__lt=alight)
+    return q
+
+def seats_available(trip, board=None, alight=None):
+    """Free seats on `trip` between two route positions: the minimum over the covered segments."""
+    free = trip.segments.filter(segment_range(board, alight)).aggregate(free=Min('seats_remaining'))['free']
+    return max(0, free or 0)
+
+def segment_availability(ranges):
+    """
+    Free seats for many trips in one query.
+    `ranges` maps trip_id -> (board, alight); returns {trip_id: available}.
+    """
+    free = {}
+    rows = TripSegment.objects.filter(trip_id__in=list(ranges)).values_list('trip_id', 'index', 'seats_remaining')
+    for trip_id, index, remaining in rows:
+        board, alight = ranges[trip_id]
+        if index < (board or 0) or (alight is not None and index >= alight):
+            continue
+        free[trip_id] = min(free.get(trip_id, remaining), remaining)
+    return {trip_id: max(0, free.get(trip_id, 0)) for trip_id in ranges}
+
+def bookable_trips(service_date=None, day_bit=None):
+    """
+    Trips a schedule (OuterRef) could be booked on, earliest first: the trip on
+    `service_date` if given, otherwise upcoming trips (only on the weekday in
+    `day_bit`, when given).
+    """
+    trips = Trip.objects.filter(schedule=OuterRef('pk'), cancelled=False)
+    if service_date:
+        return trips.filter(service_date=service_date)
+    trips = trips.filter(service_date__gte=timezone.localdate())
+    if day_bit:
+        trips = trips.filter(service_date__iso_week_day=day_bit.bit_length())
+    return trips.order_by('service_date')
+
+def annotate_bookable_trip(queryset, service_date=None, day_bit=None):
+    """
+    Annotate a Schedule queryset with the trip that would be booked (`trip_id`,
+    `service_date`); schedules without one get NULLs.
+    """
+    trips = bookable_trips(service_date, day_bit)
+    return queryset.annotate(
+        trip_id=Subquery(trips.values('pk')[:1]),
+        service_date=Subquery(trips.values('service_date')[:1]),
+    )
+
+def seats_available_bulk(schedules, service_date=None, day_bit=None):
+    """
+    Seats available over the whole route on the next bookable trip of many schedules, in two queries.
+    Accepts a Schedule queryset or an iterable of schedule ids and returns {schedule_id: available}.
+    """
+    if isinstance(schedules, QuerySet):
+        queryset = schedules.order_by()
+    else:
+        queryset = Schedule.objects.filter(pk__in=list(schedules))
+    trip_ids = dict(annotate_bookable_trip(queryset, service_date, day_bit).values_list('pk', 'trip_id'))
+    free = segment_availability({trip_id: (None, None) for trip_id in trip_ids.values() if trip_id})
+    return {schedule_id: free.get(trip_id, 0) for schedule_id, trip_id in trip_ids.items()}
 
 
 class Stop(models.Model):
@@ -102,6 +331,9 @@ class Stop(models.Model):
 
     class Meta:
         ordering = ["order"]
+        indexes = [
+            models.Index(fields=['route', 'order'], name='stop_route_order_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.time})"
\ No newline at end of file
@@ -1,39 +1,192 @@
+"""
+HTTP client for the Anthropic completion endpoint.
+
+One AnthropicClient per process (``get_client()``) keeps a pooled keep-alive
+requests.Session, so calls after the first skip the TCP and TLS handshakes.
+429, 5xx and connection errors are retried with jittered exponential backoff
+(honouring Retry-After) inside an overall deadline, and a circuit breaker
+fails calls immediately while the upstream keeps failing instead of tying up
+gunicorn workers on timeouts.
+
+``stream`` yields the completion piece by piece as the upstream sends it
+(``astream`` from asyncio, cancelling the upstream request when the consumer
+stops early). ``generate_many`` fans prompts out over a thread pool; ``agenerate`` and
+``agenerate_many`` are the asyncio versions, bounded by a semaphore of
+ANTHROPIC_MAX_CONCURRENCY. The module-level functions use the shared client
+and keep the original contract: they return text, never raise, and answer
+with a placeholder when no API key is configured.
+
+Deterministic calls are answered from services/llm_cache.py when possible:
+an in-process LRU, then a SQLite file shared by the workers, with concurrent
+identical prompts coalesced into one upstream call.
+
+main/services/anthropic_stub.py serves the same endpoint locally for tests.
+"""
+import asyncio
+import json
 import os
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
 import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import llm_cache
 
 API_URL = "https://api.anthropic.com/v1/complete"
+NOT_CONFIGURED = "[Anthropic API key not configured — set ANTHROPIC_API_KEY to enable AI responses]"
+RETRY_STATUSES = {429, 500, 502, 503, 504, 529}
 
 
-def generate(prompt: str, model: str = "claude-haiku-4.5", temperature: float = 0.0, max_tokens: int = 300):
-    """Simple HTTP client for Anthropic Claude-compatible endpoint.
+class AnthropicError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpen(AnthropicError):
+    pass
 
-    This function uses a very small HTTP wrapper. If `ANTHROPIC_API_KEY` is not set
-    it returns a helpful placeholder string so local development continues.
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects calls for
+    `reset_seconds`; then lets one trial call through (half-open), closing
+    again on success and reopening on failure.
     """
-    api_key = os.environ.get('ANTHROPIC_API_KEY') or getattr(settings, 'ANTHROPIC_API_KEY', '')
-    if not api_key:
-        return "[Anthropic API key not configured — set ANTHROPIC_API_KEY to enable AI responses]"
-
-    headers = {
-        'x-api-key': api_key,
-        'Content-Type': 'application/json',
-    }
-
-    payload = {
-        'model': model,
-        'prompt': prompt,
-        'max_tokens_to_sample': max_tokens,
-        'temperature': temperature,
-    }
 
+    def __init__(self, threshold=5, reset_seconds=30.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.clock() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+            self._trial = False
+
+
+def _retry_after(response):
+    """Seconds from a Retry-After header (delta or HTTP date), or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        r = requests.post(API_URL, json=payload, headers=headers, timeout=20)
-        r.raise_for_status()
-    except Exception as e:
-        return f"[Anthropic request failed: {e}]"
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
-    data = r.json()
+
+class StreamCancel:
+    """Lets another thread stop a stream(): flags it and closes the upstream connection."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._response = None
+        self._lock = threading.Lock()
+
+    def attach(self, response):
+        with self._lock:
+            self._response = response
+            cancelled = self.cancelled
+        if cancelled:
+            response.close()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            response = self._response
+        if response is not None:
+            response.close()
+
+
+def _chunks(response):
+    """
+    The body of a streaming response in pieces as they arrive. iter_content
+    waits to fill its chunk size, or with chunk_size=None reads a body that
+    is not chunk-encoded to the end, so read1 is used where urllib3 has it.
+    """
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:
+        yield from response.iter_content(chunk_size=None)
+        return
+    while True:
+        chunk = read1(8192, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _lines(response):
+    buffer = b""
+    for chunk in _chunks(response):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8", "replace")
+    if buffer:
+        yield buffer.decode("utf-8", "replace")
+
+
+def _sse_events(response):
+    """(event, data dict) for each server-sent event in a streaming response."""
+    event, data = None, []
+    for line in _lines(response):
+        if line:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+            continue
+        if data:
+            try:
+                payload = json.loads("\n".join(data))
+            except ValueError:
+                payload = {}
+            yield event or payload.get("type", "message"), payload
+        event, data = None, []
+
+
+def _completion_text(data):
     # best-effort: try common response shapes
     if 'completion' in data:
         return data['completion']
@@ -41,3 +194,261 @@ def generate(prompt: str, model: str = "claude-haiku-4.5", temperature: float =
         return data['output'].get('text', str(data))
     # fallback to raw json
     return str(data)
+
+
+class AnthropicClient:
+    def __init__(self, api_key, api_url=API_URL, connect_timeout=3.05, read_timeout=20.0, deadline=30.0,
+                 max_retries=3, backoff_base=0.5, backoff_cap=8.0, max_concurrency=8, breaker=None,
+                 cache=None, sleep=time.sleep):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker or CircuitBreaker()
+        self.cache = cache
+        self.sleep = sleep
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'x-api-key': api_key, 'Content-Type': 'application/json'})
+        self._semaphores = weakref.WeakKeyDictionary()  # one per event loop
+
+    def close(self):
+        self.session.close()
+
+    def backoff(self, attempt, retry_after=None):
+        """Full-jitter delay before retry `attempt` (0-based); a Retry-After from the server wins."""
+        if retry_after is not None:
+            return min(retry_after, self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def complete(self, prompt, model="claude-haiku-4.5", temperature=0.0, max_tokens=300):
+        """The completion text for `prompt`. Raises AnthropicError, or CircuitOpen without calling out."""
+        if self.cache is None:
+            return self._request(prompt, model, temperature, max_tokens)
+        return self.cache.get_or_compute(
+            model, prompt, temperature, max_tokens,
+            lambda: self._request(prompt, model, temperature, max_tokens),
+        )
+
+    @staticmethod
+    def _payload(prompt, model, temperature, max_tokens):
+        return {
+            'model': model,
+            'prompt': prompt,
+            'max_tokens_to_sample': max_tokens,
+            'temperature': temperature,
+        }
+
+    def _post(self, payload, stream=False):
+        """POST with retries and the breaker; the first successful response."""
+        give_up_at = time.monotonic() + self.deadline
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpen("Anthropic circuit open after repeated failures") from error
+            retry_after = None
+            try:
+                response = self.session.post(self.api_url, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = AnthropicError(f"{type(exc).__name__}: {exc}")
+            else:
+                if response.status_code < 400:
+                    self.breaker.record_success()
+                    return response
+                error = AnthropicError(f"HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    # our request was wrong; the upstream itself is fine
+                    self.breaker.record_success()
+                    raise error
+                retry_after = _retry_after(response)
+            self.breaker.record_failure()
+            if attempt == self.max_retries:
+                break
+            delay = self.backoff(attempt, retry_after)
+            if time.monotonic() + delay >= give_up_at:
+                break
+            self.sleep(delay)
+        raise error
+
+    def _request(self, prompt, model, temperature, max_tokens):
+        response = self._post(self._payload(prompt, model, temperature, max_tokens))
+        return _completion_text(response.json())
+
+    def stream(self, prompt, model="claude-haiku-4.5", temperature=0.0, max_tokens=300, cancel=None):
+        """
+        Yield the completion in pieces as they arrive. A cached answer comes
+        back as one piece, and a stream is cached only once it reports a stop
+        reason: one that breaks off early would otherwise be replayed whole.
+        `cancel` (a StreamCancel) lets another thread abort the upstream call.
+        Raises like complete().
+        """
+        if not self.api_key:
+            yield NOT_CONFIGURED
+            return
+        if self.cache is not None:
+            cached = self.cache.cached(model, prompt, temperature, max_tokens)
+            if cached is not None:
+                yield cached
+                return
+        payload = dict(self._payload(prompt, model, temperature, max_tokens), stream=True)
+        response = self._post(payload, stream=True)
+        if cancel is not None:
+            cancel.attach(response)
+        pieces, stop_reason = [], None
+        try:
+            for event, data in _sse_events(response):
+                if cancel is not None and cancel.cancelled:
+                    return
+                if event == "error":
+                    raise AnthropicError(f"stream error: {data.get('error', data)}")
+                # the final completion event carries it; message_delta does in the Messages API
+                stop_reason = data.get("stop_reason") or (data.get("delta") or {}).get("stop_reason") or stop_reason
+                if event == "completion" and data.get("completion"):
+                    pieces.append(data["completion"])
+                    yield data["completion"]
+        finally:
+            response.close()
+        if self.cache is not None and stop_reason:
+            self.cache.store(model, prompt, temperature, max_tokens, "".join(pieces))
+
+    def generate(self, prompt, model="claude-haiku-4.5", temperature=0.0, max_tokens=300):
+        """Like complete(), but failures come back as a bracketed message instead of an exception."""
+        if not self.api_key:
+            return NOT_CONFIGURED
+        try:
+            return self.complete(prompt, model, temperature, max_tokens)
+        except Exception as e:
+            return f"[Anthropic request failed: {e}]"
+
+    def generate_many(self, prompts, **kwargs):
+        """generate() for every prompt, at most `max_concurrency` at once; results in prompt order."""
+        prompts = list(prompts)
+        if len(prompts) <= 1:
+            return [self.generate(prompt, **kwargs) for prompt in prompts]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(prompts))) as pool:
+            return list(pool.map(lambda prompt: self.generate(prompt, **kwargs), prompts))
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def agenerate(self, prompt, **kwargs):
+        # the pooled session is blocking, so each call runs in a worker thread
+        async with self._semaphore():
+            return await asyncio.to_thread(self.generate, prompt, **kwargs)
+
+    async def agenerate_many(self, prompts, **kwargs):
+        return list(await asyncio.gather(*(self.agenerate(prompt, **kwargs) for prompt in prompts)))
+
+    async def astream(self, prompt, **kwargs):
+        """
+        stream() for asyncio. The blocking stream runs in a worker thread and
+        hands pieces over through a queue; if the consumer stops early (an
+        SSE client disconnecting cancels it) the upstream connection is
+        closed, so an abandoned completion stops generating.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancel = StreamCancel()
+        done = object()
+
+        def pump():
+            try:
+                for piece in self.stream(prompt, cancel=cancel, **kwargs):
+                    loop.call_soon_threadsafe(queue.put_nowait, piece)
+            except Exception as exc:
+                if not cancel.cancelled:
+                    loop.call_soon_threadsafe(queue.put_nowait, exc)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        async with self._semaphore():
+            loop.run_in_executor(None, pump)
+            try:
+                while (item := await queue.get()) is not done:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                cancel.cancel()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process-wide client, built from settings on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AnthropicClient(
+                api_key=os.environ.get('ANTHROPIC_API_KEY') or getattr(settings, 'ANTHROPIC_API_KEY', ''),
+                api_url=getattr(settings, 'ANTHROPIC_API_URL', API_URL),
+                read_timeout=getattr(settings, 'ANTHROPIC_TIMEOUT', 20.0),
+                deadline=getattr(settings, 'ANTHROPIC_DEADLINE', 30.0),
+                max_retries=getattr(settings, 'ANTHROPIC_MAX_RETRIES', 3),
+                max_concurrency=getattr(settings, 'ANTHROPIC_MAX_CONCURRENCY', 8),
+                breaker=CircuitBreaker(
+                    threshold=getattr(settings, 'ANTHROPIC_BREAKER_THRESHOLD', 5),
+                    reset_seconds=getattr(settings, 'ANTHROPIC_BREAKER_RESET_SECONDS', 30.0),
+                ),
+                cache=_build_cache(),
+            )
+        return _client
+
+
+def _build_cache():
+    if not getattr(settings, 'LLM_CACHE', True):
+        return None
+    path = getattr(settings, 'LLM_CACHE_PATH', '')
+    ttl = getattr(settings, 'LLM_CACHE_TTL', 7 * 24 * 3600)
+    return llm_cache.ResponseCache(
+        memory=llm_cache.LRU(getattr(settings, 'LLM_CACHE_MEMORY_ENTRIES', 1024), ttl=ttl),
+        disk=llm_cache.DiskCache(path, ttl=ttl, max_bytes=getattr(settings, 'LLM_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+        if path else None,
+        max_temperature=getattr(settings, 'LLM_CACHE_MAX_TEMPERATURE', 0.0),
+    )
+
+
+def reset_client():
+    """Drop the shared client so the next call rebuilds it from settings."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+
+
+def generate(prompt: str, model: str = "claude-haiku-4.5", temperature: float = 0.0, max_tokens: int = 300):
+    """Completion text for `prompt`, or a bracketed placeholder/error message; never raises."""
+    return get_client().generate(prompt, model, temperature, max_tokens)
+
+
+def generate_many(prompts, **kwargs):
+    return get_client().generate_many(prompts, **kwargs)
+
+
+async def agenerate(prompt, **kwargs):
+    return await get_client().agenerate(prompt, **kwargs)
+
+
+async def agenerate_many(prompts, **kwargs):
+    return await get_client().agenerate_many(prompts, **kwargs)
+
+
+def stream(prompt, **kwargs):
+    return get_client().stream(prompt, **kwargs)
+
+
+def astream(prompt, **kwargs):
+    return get_client().astream(prompt, **kwargs)
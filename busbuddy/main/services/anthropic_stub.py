@@ -0,0 +1,125 @@
+"""
+A local stand-in for the Anthropic completion endpoint, for tests and
+offline development:
+
+    with StubAnthropic(script=[(503, {}), (200, {"completion": "hi"})]) as stub:
+        client = AnthropicClient("test-key", api_url=stub.url)
+
+Scripted responses are served in order, then every request gets
+``{"completion": "echo: <prompt>"}``. The stub records each request and the
+client connections it saw, and can delay responses to simulate a slow
+upstream. Requests with ``"stream": true`` get the echo as server-sent
+``completion`` events, one word every ``chunk_delay`` seconds, and
+``truncate`` ends them without the final stop_reason event; ``aborted``
+counts streams whose client hung up part way.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubAnthropic:
+    def __init__(self, script=(), delay=0.0, chunk_delay=0.0, truncate=False):
+        self.script = list(script)  # (status, body dict[, headers dict])
+        self.delay = delay
+        self.chunk_delay = chunk_delay
+        self.truncate = truncate
+        self.aborted = 0
+        self.finished = threading.Event()  # set when a stream ends, completed or aborted
+        self.requests = []
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/complete"
+
+    def _next_response(self, payload):
+        with self._lock:
+            if self.script:
+                status, body, *headers = self.script.pop(0)
+                return status, body, headers[0] if headers else {}
+        return 200, {"completion": f"echo: {payload.get('prompt', '')}"}, {}
+
+    def handle(self, handler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        payload = json.loads(handler.rfile.read(length) or b"{}")
+        with self._lock:
+            self.requests.append({"headers": dict(handler.headers), "json": payload})
+            self.connections.add(handler.client_address)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            status, body, headers = self._next_response(payload)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        if payload.get("stream") and status == 200:
+            self.stream(handler, body.get("completion", ""))
+            return
+        data = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def stream(self, handler, text):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+        words = text.split(" ")
+        try:
+            for i, word in enumerate(words):
+                piece = word if i == 0 else " " + word
+                event = {"type": "completion", "completion": piece, "stop_reason": None}
+                handler.wfile.write(f"event: completion\ndata: {json.dumps(event)}\n\n".encode())
+                handler.wfile.flush()
+                if self.chunk_delay:
+                    time.sleep(self.chunk_delay)
+            if not self.truncate:
+                handler.wfile.write(b'event: completion\ndata: {"completion": "", "stop_reason": "stop_sequence"}\n\n')
+                handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            with self._lock:
+                self.aborted += 1
+        finally:
+            self.finished.set()
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse is observable
+
+            def do_POST(self):
+                stub.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
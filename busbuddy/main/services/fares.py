@@ -0,0 +1,67 @@
+"""
+Segment fare matrices.
+
+A route with ``n`` stop positions has a fare for every journey from position
+``i`` to a later position ``j``. Those ``n * (n - 1) / 2`` fares are stored as
+the upper triangle of the matrix, row by row, packed as little-endian uint32
+(a 10-stop route needs 180 bytes), so a fare is a single unpack at a
+computed offset.
+"""
+import math
+import struct
+
+BASE_FARE = 150
+PER_STOP = 80  # 40 km per stop at 2/km
+# class surcharges, in percent of the fare
+SLEEPER_PERCENT = 130
+AC_PERCENT = 120
+
+# a schedule without a route is sold at a flat fare
+FLAT_FARE = 200
+
+_FARE = struct.Struct("<I")
+
+
+def class_surcharges(ac_type, is_sleeper):
+    """Percent surcharges applying to a bus class. Only AC buses pay the AC one."""
+    surcharges = []
+    if is_sleeper:
+        surcharges.append(SLEEPER_PERCENT)
+    if ac_type == "AC":
+        surcharges.append(AC_PERCENT)
+    return surcharges
+
+
+def journey_fare(stops_travelled, surcharges=()):
+    """Fare for a journey calling at `stops_travelled` stops, boarding and alighting included."""
+    fare = BASE_FARE + stops_travelled * PER_STOP
+    divisor = 1
+    for percent in surcharges:
+        fare *= percent
+        divisor *= 100
+    return fare // divisor
+
+
+def _offset(count, board, alight):
+    return board * (2 * count - board - 1) // 2 + (alight - board - 1)
+
+
+def build(count, ac_type, is_sleeper):
+    """The packed fare matrix of a route with `count` stop positions."""
+    surcharges = class_surcharges(ac_type, is_sleeper)
+    fares = bytearray()
+    for board in range(count):
+        for alight in range(board + 1, count):
+            fares += _FARE.pack(journey_fare(alight - board + 1, surcharges))
+    return bytes(fares)
+
+
+def stop_count(matrix):
+    """Number of stop positions a packed matrix covers."""
+    entries = len(matrix) // _FARE.size
+    return (1 + math.isqrt(1 + 8 * entries)) // 2
+
+
+def lookup(matrix, count, board, alight):
+    """Fare from position `board` to `alight` in a packed matrix for `count` positions."""
+    return _FARE.unpack_from(matrix, _offset(count, board, alight) * _FARE.size)[0]
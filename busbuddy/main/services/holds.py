@@ -0,0 +1,129 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ..models import Booking, Payment, SeatHold
+from . import inventory, search_cache, seatmap
+
+
+def hold_ttl():
+    return timedelta(seconds=getattr(settings, "SEAT_HOLD_TTL_SECONDS", 600))
+
+
+def place_hold(booking):
+    """Hold the booking's seats until the TTL runs out."""
+    return SeatHold.objects.create(booking=booking, expires_at=timezone.now() + hold_ttl())
+
+
+def confirm(booking):
+    """
+    Turn a held booking into a paid one. Returns False if the hold was already
+    released (the booking is cancelled), in which case nothing changes.
+    """
+    with transaction.atomic():
+        confirmed = Booking.objects.filter(pk=booking.pk, cancelled=False).update(paid=True)
+        if confirmed:
+            SeatHold.objects.filter(booking_id=booking.pk).delete()
+    return bool(confirmed)
+
+
+def is_expired(booking, now=None):
+    now = now or timezone.now()
+    return SeatHold.objects.filter(booking_id=booking.pk, expires_at__lte=now).exists()
+
+
+def live_count(now=None):
+    """Holds currently counting against availability."""
+    return SeatHold.objects.filter(expires_at__gt=now or timezone.now()).count()
+
+
+def expired_count(now=None):
+    """Holds past their expiry that the sweeper has not released yet."""
+    return SeatHold.objects.filter(expires_at__lte=now or timezone.now()).count()
+
+
+def _release_batch(rows):
+    """
+    Release a batch of expired holds with bulk updates. Returns False (and
+    rolls back) if any booking changed underneath us, e.g. was paid meanwhile.
+    """
+    hold_ids = [row[0] for row in rows]
+    booking_ids = [row[1] for row in rows]
+    with transaction.atomic():
+        flipped = Booking.objects.filter(pk__in=booking_ids, paid=False, cancelled=False).update(cancelled=True)
+        if flipped != len(booking_ids):
+            transaction.set_rollback(True)
+            return False
+        Payment.objects.filter(booking_id__in=booking_ids, status="initiated").update(status="expired")
+
+        # one release per journey shape instead of one per booking
+        journeys = defaultdict(lambda: [0, []])
+        for _, _, trip_id, board, alight, seats, seat_numbers, _ in rows:
+            if trip_id is None:
+                continue
+            journey = journeys[(trip_id, board, alight)]
+            journey[0] += seats
+            journey[1] += seatmap.parse_seat_numbers(seat_numbers)
+        for (trip_id, board, alight), (seats, numbers) in journeys.items():
+            inventory.release_seats(trip_id, seats, board, alight, numbers)
+
+        SeatHold.objects.filter(pk__in=hold_ids).delete()
+        schedule_ids = {row[7] for row in rows}
+        transaction.on_commit(lambda: search_cache.bump_schedules(schedule_ids))
+    return True
+
+
+def _release_one(row):
+    hold_id, booking_id = row[0], row[1]
+    with transaction.atomic():
+        booking = Booking.objects.filter(pk=booking_id).first()
+        if booking is not None and not booking.paid and inventory.cancel_booking(booking):
+            Payment.objects.filter(booking_id=booking_id, status="initiated").update(status="expired")
+            transaction.on_commit(lambda: search_cache.bump_schedules([booking.schedule_id]))
+        SeatHold.objects.filter(pk=hold_id).delete()
+
+
+def release_expired(batch_size=500, now=None, trip_ids=None):
+    """
+    Release every hold that expired before `now`: cancel the booking, mark its
+    payment expired and return the seats. Works in batches of `batch_size`
+    with bulk updates; a batch that races with a payment is redone row by row.
+    Returns the number of holds released.
+    """
+    now = now or timezone.now()
+    expired = SeatHold.objects.filter(expires_at__lte=now)
+    if trip_ids is not None:
+        expired = expired.filter(booking__trip_id__in=trip_ids)
+
+    # holds left behind by bookings that were paid or cancelled some other way
+    expired.exclude(booking__paid=False, booking__cancelled=False).delete()
+
+    released = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                expired.select_for_update(of=("self",))
+                .order_by("expires_at")
+                .values_list(
+                    "pk",
+                    "booking_id",
+                    "booking__trip_id",
+                    "booking__board_order",
+                    "booking__alight_order",
+                    "booking__seats",
+                    "booking__seat_numbers",
+                    "booking__schedule_id",
+                )[:batch_size]
+            )
+            if not rows:
+                break
+            if not _release_batch(rows):
+                for row in rows:
+                    _release_one(row)
+        released += len(rows)
+        if len(rows) < batch_size:
+            break
+    return released
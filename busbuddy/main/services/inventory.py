@@ -0,0 +1,163 @@
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from ..models import Booking, Bus, SeatHold, Trip, TripSegment, segment_range
+from . import seatmap
+
+
+def reserve_seats(trip_id, seats, board=None, alight=None, seat_numbers=None):
+    """
+    Take `seats` on every segment a journey from position `board` to `alight`
+    covers (the whole route when both are None) and assign seat numbers.
+
+    One conditional UPDATE (``... WHERE seats_remaining >= seats``) over the
+    segment rows; if any segment is short, fewer rows match and the savepoint
+    is rolled back, so two requests racing for the last seat cannot both
+    succeed. That UPDATE also holds the write lock on the rows while their
+    seat maps are read and rewritten. `seat_numbers` are honoured if all of
+    them are free, otherwise adjacent seats are auto-assigned.
+
+    Returns the list of seat numbers taken, or None if the booking cannot be made.
+    """
+    if seat_numbers:
+        # a seat listed twice is one seat, as seatmap.allocate counts it
+        seat_numbers = sorted(set(seat_numbers))
+        seats = len(seat_numbers)
+    if seats <= 0:
+        return None
+    segments = TripSegment.objects.filter(segment_range(board, alight), trip_id=trip_id)
+    with transaction.atomic():
+        wanted = alight - (board or 0) if alight is not None else segments.count()
+        updated = segments.filter(seats_remaining__gte=seats).update(
+            seats_remaining=F("seats_remaining") - seats
+        )
+        if wanted <= 0 or updated != wanted:
+            transaction.set_rollback(True)
+            return None
+
+        rows = list(segments.values_list("pk", "seat_map", "trip__schedule__bus__total_seats"))
+        total_seats = rows[0][2]
+        occupied = 0
+        for _, seat_map, _ in rows:
+            occupied |= seatmap.from_bytes(seat_map)
+        chosen = seatmap.allocate(occupied, total_seats, seats, seat_numbers)
+        if chosen is None:
+            transaction.set_rollback(True)
+            return None
+        _write_seat_maps(rows, total_seats, set_bits=seatmap.mask(chosen))
+    return chosen
+
+
+def release_seats(trip_id, seats, board=None, alight=None, seat_numbers=None):
+    """Give `seats` back on the segments between `board` and `alight` and free their seat numbers."""
+    segments = TripSegment.objects.filter(segment_range(board, alight), trip_id=trip_id)
+    with transaction.atomic():
+        segments.update(seats_remaining=F("seats_remaining") + seats)
+        if seat_numbers:
+            rows = list(segments.values_list("pk", "seat_map", "trip__schedule__bus__total_seats"))
+            if rows:
+                _write_seat_maps(rows, rows[0][2], clear_bits=seatmap.mask(seat_numbers))
+
+
+def _write_seat_maps(rows, total_seats, set_bits=0, clear_bits=0):
+    updated = []
+    for pk, seat_map, _ in rows:
+        bits = (seatmap.from_bytes(seat_map) | set_bits) & ~clear_bits
+        updated.append(TripSegment(pk=pk, seat_map=seatmap.to_bytes(bits, total_seats)))
+    TripSegment.objects.bulk_update(updated, ["seat_map"])
+
+
+def cancel_booking(booking):
+    """
+    Cancel a booking and return its seats. Safe to call twice: only the call
+    that flips `cancelled` releases inventory. Returns True if it cancelled.
+    """
+    with transaction.atomic():
+        cancelled = Booking.objects.filter(pk=booking.pk, cancelled=False).update(cancelled=True)
+        SeatHold.objects.filter(booking_id=booking.pk).delete()
+        if cancelled and booking.trip_id:
+            release_seats(
+                booking.trip_id,
+                booking.seats,
+                booking.board_order,
+                booking.alight_order,
+                seatmap.parse_seat_numbers(booking.seat_numbers),
+            )
+    booking.cancelled = True
+    return bool(cancelled)
+
+
+def journey_seat_map(trip, board=None, alight=None):
+    """Occupancy bits for a journey on `trip`: one query over its covered segments."""
+    occupied = 0
+    for seat_map in trip.segments.filter(segment_range(board, alight)).values_list("seat_map", flat=True):
+        occupied |= seatmap.from_bytes(seat_map)
+    return occupied
+
+
+def expected_seats_remaining():
+    """Expression for a segment's true remaining seats: bus capacity minus live bookings covering it."""
+    booked = (
+        Booking.objects.filter(trip=OuterRef("trip_id"), cancelled=False)
+        .filter(Q(board_order__isnull=True) | Q(board_order__lte=OuterRef("index")))
+        .filter(Q(alight_order__isnull=True) | Q(alight_order__gt=OuterRef("index")))
+        .values("trip")
+        .annotate(total=Sum("seats"))
+        .values("total")
+    )
+    total_seats = Bus.objects.filter(schedules__trips=OuterRef("trip_id")).values("total_seats")[:1]
+    return Subquery(total_seats) - Coalesce(Subquery(booked), Value(0))
+
+
+def drifted_segments(queryset=None):
+    """Segments whose `seats_remaining` disagrees with the Booking table, annotated with `expected`."""
+    queryset = TripSegment.objects.all() if queryset is None else queryset
+    return queryset.annotate(expected=expected_seats_remaining()).exclude(seats_remaining=F("expected"))
+
+
+def rebuild_seats_remaining(queryset=None):
+    """
+    Recompute segment `seats_remaining` from the Booking table in one UPDATE statement.
+    Returns the number of segments whose counter had drifted.
+    """
+    queryset = TripSegment.objects.all() if queryset is None else queryset
+    drifted = drifted_segments(queryset).count()
+    queryset.update(seats_remaining=expected_seats_remaining())
+    return drifted
+
+
+def rebuild_seat_maps(trips=None, batch_size=500):
+    """
+    Recompute segment seat maps from Booking.seat_numbers, a batch of trips
+    at a time. Returns the number of segments rewritten.
+    """
+    trips = Trip.objects.all() if trips is None else trips
+    trip_ids = list(trips.values_list("pk", flat=True))
+    rewritten = 0
+    for start in range(0, len(trip_ids), batch_size):
+        batch = trip_ids[start:start + batch_size]
+        bookings = {}
+        rows = Booking.objects.filter(trip_id__in=batch, cancelled=False).values_list(
+            "trip_id", "board_order", "alight_order", "seat_numbers"
+        )
+        for trip_id, board, alight, seat_numbers in rows:
+            bits = seatmap.mask(seatmap.parse_seat_numbers(seat_numbers))
+            if bits:
+                bookings.setdefault(trip_id, []).append((board or 0, alight, bits))
+
+        segments = []
+        rows = TripSegment.objects.filter(trip_id__in=batch).values_list(
+            "pk", "trip_id", "index", "seat_map", "trip__schedule__bus__total_seats"
+        )
+        for pk, trip_id, index, seat_map, total_seats in rows:
+            bits = 0
+            for board, alight, seats in bookings.get(trip_id, []):
+                if board <= index and (alight is None or index < alight):
+                    bits |= seats
+            expected = seatmap.to_bytes(bits, total_seats)
+            if bytes(seat_map or b"") != expected:
+                segments.append(TripSegment(pk=pk, seat_map=expected))
+        TripSegment.objects.bulk_update(segments, ["seat_map"], batch_size=batch_size)
+        rewritten += len(segments)
+    return rewritten
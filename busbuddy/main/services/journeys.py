@@ -0,0 +1,255 @@
+"""
+Multi-leg journey planning with the Connection Scan Algorithm.
+
+The timetable is flattened into connections, one per pair of consecutive
+stops of a schedule, timed from the schedule's departure, the route's Stop
+rows and the arrival. For a service date, the connections of every trip
+running that day and the next (overnight buses, late transfers) are kept in
+parallel arrays sorted by departure minute; a query is a single forward scan
+over them with one label per stop and number of legs, which gives the
+earliest arrival for each number of transfers at once.
+
+The arrays are rebuilt when the search catalog version changes (new routes
+or schedules bump it); cancelled trips and service exceptions are read per
+query so they apply immediately.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+
+from ..models import Schedule, ServiceException, Stop, Trip, route_stop_names
+from . import search_cache
+from .route_index import normalize
+
+DAY = 24 * 60
+INF = 1 << 30
+
+# how many service dates keep their connection arrays in memory
+CACHED_DAYS = 14
+
+
+def min_transfer_minutes():
+    return getattr(settings, "MIN_TRANSFER_MINUTES", 10)
+
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+
+class _Day:
+    """The connections of one service date (plus the following day) as compact arrays."""
+
+    def __init__(self, rows, trips):
+        self.departures = array("i", [row[0] for row in rows])
+        self.arrivals = array("i", [row[1] for row in rows])
+        self.origins = array("i", [row[2] for row in rows])
+        self.targets = array("i", [row[3] for row in rows])
+        self.trips = array("i", [row[4] for row in rows])
+        self.boards = array("h", [row[5] for row in rows])
+        self.alights = array("h", [row[6] for row in rows])
+        # trip index -> (schedule_id, service_date)
+        self.trip_keys = trips
+
+
+class Timetable:
+    """Per-process journey planner; see the module docstring."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._version = None
+        self._stop_ids = {}
+        self._stop_names = []
+        self._patterns = []
+        self._days = {}
+
+    def _stop_id(self, name):
+        key = normalize(name)
+        stop_id = self._stop_ids.get(key)
+        if stop_id is None:
+            stop_id = self._stop_ids[key] = len(self._stop_names)
+            self._stop_names.append(" ".join(name.split()))
+        return stop_id
+
+    def _pattern(self, events):
+        """
+        [(from, to, departure, arrival, from_position, to_position)] for one
+        schedule from its timed ``(route_position, name, time)`` events, in
+        minutes from the start of its service day.
+        """
+        legs, previous = [], None
+        for position, name, at in events:
+            stop, minute = self._stop_id(name), _minutes(at)
+            if previous is not None:
+                # past midnight: times keep increasing into the next day
+                while minute < previous[2]:
+                    minute += DAY
+                legs.append((previous[0], stop, previous[2], minute, previous[1], position))
+            previous = (stop, position, minute)
+        return legs
+
+    def rebuild(self):
+        """Reload every schedule's stop pattern from the database."""
+        with self._lock:
+            self._stop_ids, self._stop_names, self._patterns, self._days = {}, [], [], {}
+            stops = {}
+            for route_id, name, at in Stop.objects.order_by("route_id", "order").values_list("route_id", "name", "time"):
+                stops.setdefault(route_id, []).append((name, at))
+            rows = Schedule.objects.filter(route__isnull=False).values_list(
+                "pk", "date", "days_mask", "departure_time", "arrival_time",
+                "route_id", "route__origin", "route__stops", "route__destination",
+            )
+            for pk, date, days_mask, departure, arrival, route_id, origin, stops_csv, destination in rows:
+                timed = stops.get(route_id, [])
+                last = len(route_stop_names(origin, stops_csv, destination)) - 1
+                if len(timed) != last - 1:
+                    # Stop rows out of step with the route: only the end-to-end ride is reliable
+                    timed = []
+                events = [(0, origin, departure)]
+                events += [(position, name, at) for position, (name, at) in enumerate(timed, start=1)]
+                events.append((last, destination, arrival))
+                self._patterns.append((pk, date, days_mask, self._pattern(events)))
+
+    def _refresh(self):
+        version = search_cache.versions().get(search_cache.CATALOG)
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self.rebuild()
+                    self._version = version
+
+    def _day(self, day):
+        with self._lock:
+            data = self._days.get(day)
+            if data is not None:
+                return data
+            rows, trips = [], []
+            for offset in (0, 1):
+                date = day + timedelta(days=offset)
+                bit = 1 << date.weekday()
+                for schedule_id, schedule_date, days_mask, legs in self._patterns:
+                    if not (schedule_date == date if schedule_date else days_mask & bit):
+                        continue
+                    trip = len(trips)
+                    trips.append((schedule_id, date))
+                    for origin, target, departure, arrival, board, alight in legs:
+                        shift = offset * DAY
+                        rows.append((departure + shift, arrival + shift, origin, target, trip, board, alight))
+            rows.sort()
+            if len(self._days) >= CACHED_DAYS:
+                self._days.pop(next(iter(self._days)))
+            data = self._days[day] = _Day(rows, trips)
+            return data
+
+    @staticmethod
+    def _excluded(day):
+        """(schedule_id, date) pairs not running on `day` or the day after: cancelled trips and exceptions."""
+        dates = [day, day + timedelta(days=1)]
+        excluded = set(
+            Trip.objects.filter(service_date__in=dates, cancelled=True).values_list("schedule_id", "service_date")
+        )
+        closed = set()
+        for schedule_id, date in ServiceException.objects.filter(date__in=dates).values_list("schedule_id", "date"):
+            if schedule_id is None:
+                closed.add(date)
+            else:
+                excluded.add((schedule_id, date))
+        return excluded, closed
+
+    def plan(self, source, destination, day, depart_after=0, max_legs=3):
+        """
+        Itineraries from `source` to `destination` leaving on `day` at or
+        after `depart_after` (minutes past midnight), using at most
+        `max_legs` buses. Returns the Pareto set on (arrival, transfers):
+        the fastest journey, then each journey with fewer transfers that
+        arrives later, fewest transfers last.
+        """
+        self._refresh()
+        with self._lock:
+            src = self._stop_ids.get(normalize(source))
+            dst = self._stop_ids.get(normalize(destination))
+            if src is None or dst is None or src == dst:
+                return []
+            data = self._day(day)
+            names = self._stop_names
+        excluded, closed = self._excluded(day)
+        skip = {i for i, key in enumerate(data.trip_keys) if key in excluded or key[1] in closed}
+
+        transfer = min_transfer_minutes()
+        departures, arrivals = data.departures, data.arrivals
+        origins, targets, trips = data.origins, data.targets, data.trips
+        legs_range = range(1, max_legs + 1)
+        arrival = [[INF] * len(names) for _ in range(max_legs + 1)]
+        arrival[0][src] = depart_after
+        via = [{} for _ in range(max_legs + 1)]
+        boarded = [{} for _ in range(max_legs + 1)]
+        # bound[k]: earliest arrival at dst with at most k legs. A connection leaving at or
+        # after it cannot give a k-leg journey on the Pareto set; bounds shrink as k grows,
+        # so the scan is over once it passes bound[1] (a later direct bus may still win)
+        bound = [INF] * (max_legs + 1)
+
+        for i in range(bisect_left(departures, depart_after), len(departures)):
+            departure = departures[i]
+            if departure >= bound[1]:
+                break
+            trip = trips[i]
+            if trip in skip:
+                continue
+            origin, target, arrives = origins[i], targets[i], arrivals[i]
+            for legs in legs_range:
+                if departure >= bound[legs]:
+                    break
+                on_trip = boarded[legs]
+                if trip not in on_trip:
+                    ready = arrival[legs - 1][origin]
+                    if legs > 1:
+                        ready += transfer
+                    if ready > departure:
+                        continue
+                    on_trip[trip] = i
+                if arrives < arrival[legs][target]:
+                    arrival[legs][target] = arrives
+                    via[legs][target] = (on_trip[trip], i)
+                    if target == dst:
+                        for k in range(legs, max_legs + 1):
+                            bound[k] = min(bound[k], arrives)
+
+        itineraries = []
+        fastest = INF
+        for legs in legs_range:
+            if arrival[legs][dst] < fastest:
+                fastest = arrival[legs][dst]
+                itineraries.append(self._itinerary(data, via, legs, dst, day))
+        itineraries.reverse()  # fastest first
+        return itineraries
+
+    def _itinerary(self, data, via, legs, stop, day):
+        start = datetime.combine(day, time())
+        trip_legs = []
+        while legs:
+            first, last = via[legs][stop]
+            schedule_id, service_date = data.trip_keys[data.trips[first]]
+            trip_legs.append({
+                "schedule_id": schedule_id,
+                "service_date": service_date.strftime("%Y-%m-%d"),
+                "from_stop": self._stop_names[data.origins[first]],
+                "to_stop": self._stop_names[data.targets[last]],
+                "board": data.boards[first],
+                "alight": data.alights[last],
+                "departure": (start + timedelta(minutes=data.departures[first])).strftime("%Y-%m-%dT%H:%M"),
+                "arrival": (start + timedelta(minutes=data.arrivals[last])).strftime("%Y-%m-%dT%H:%M"),
+            })
+            stop = data.origins[first]
+            legs -= 1
+        trip_legs.reverse()
+        return {
+            "departure": trip_legs[0]["departure"],
+            "arrival": trip_legs[-1]["arrival"],
+            "transfers": len(trip_legs) - 1,
+            "legs": trip_legs,
+        }
+
+
+timetable = Timetable()
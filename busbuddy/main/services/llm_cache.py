@@ -0,0 +1,260 @@
+"""
+Two-tier cache for LLM completions, keyed on (model, prompt, temperature, max_tokens).
+
+Tier one is an in-process LRU; tier two a SQLite file shared by every worker
+on the host, with a TTL and eviction of the least recently used entries once
+the file holds more than ``max_bytes`` of responses. A disk hit is promoted
+into the LRU. Concurrent calls for the same key in one process are coalesced:
+the first computes, the others wait for its answer (or its exception; errors
+are never cached).
+
+Only calls at or below LLM_CACHE_MAX_TEMPERATURE (default 0.0, the
+deterministic ones) are cached. Lookups are counted in ``stats()`` and in the
+Prometheus export as ``busbuddy_llm_cache_total{result=...}``.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from . import metrics
+
+logger = logging.getLogger("busbuddy.llm_cache")
+
+RESULTS = ("memory_hit", "disk_hit", "miss", "coalesced")
+
+
+def cache_key(model, prompt, temperature, max_tokens):
+    raw = json.dumps([model, prompt, float(temperature), int(max_tokens)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class LRU:
+    """A thread-safe LRU of at most `maxsize` entries, each expiring `ttl` seconds after it was stored."""
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        if expires_at is None and self.ttl:
+            expires_at = self.clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache:
+    """
+    Completions in a SQLite file with a TTL, evicting least recently read
+    entries when their total size passes `max_bytes`. Safe to share between
+    processes; each thread uses its own connection.
+    """
+
+    EVICT_EVERY = 64  # writes between size checks
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_bytes=64 * 1024 * 1024, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires_at)")
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=wal")
+            db.execute("PRAGMA synchronous=normal")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        """(value, expires_at) or None."""
+        db = self._connect()
+        now = self.clock()
+        row = db.execute("SELECT value, expires_at FROM entries WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            return None
+        db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return row
+
+    def set(self, key, value):
+        now = self.clock()
+        expires_at = now + self.ttl
+        self._connect().execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value.encode()), expires_at, now),
+        )
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.EVICT_EVERY == 0
+        if due:
+            self.evict()
+        return expires_at
+
+    def evict(self):
+        """Drop expired entries, then the least recently read ones until under `max_bytes`. Returns rows removed."""
+        db = self._connect()
+        removed = db.execute("DELETE FROM entries WHERE expires_at <= ?", (self.clock(),)).rowcount
+        rows, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if total > self.max_bytes and rows:
+            # go 10% under the bound so eviction does not run on every write
+            excess = total - int(self.max_bytes * 0.9)
+            count = max(1, -(-rows * excess // total))
+            removed += db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)", (count,)
+            ).rowcount
+        return removed
+
+    def size(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def clear(self):
+        self._connect().execute("DELETE FROM entries")
+
+
+class ResponseCache:
+    def __init__(self, memory, disk=None, max_temperature=0.0):
+        self.memory = memory
+        self.disk = disk
+        self.max_temperature = max_temperature
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(RESULTS, 0)
+
+    def _count(self, result):
+        with self._lock:
+            self._stats[result] += 1
+        metrics.count("busbuddy_llm_cache_total", (("result", result),))
+        metrics.record_cache("llm", result != "miss")
+
+    def lookup(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hit")
+            return value
+        if self.disk is not None:
+            row = self.disk.get(key)
+            if row is not None:
+                value, expires_at = row
+                self.memory.set(key, value, expires_at)
+                self._count("disk_hit")
+                return value
+        return None
+
+    def cacheable(self, temperature):
+        return temperature <= self.max_temperature
+
+    def cached(self, model, prompt, temperature, max_tokens):
+        """The stored completion, or None (also for calls that are never cached)."""
+        if not self.cacheable(temperature):
+            return None
+        value = self.lookup(cache_key(model, prompt, temperature, max_tokens))
+        if value is None:
+            self._count("miss")
+        return value
+
+    def store(self, model, prompt, temperature, max_tokens, value):
+        if not self.cacheable(temperature):
+            return
+        self._save(cache_key(model, prompt, temperature, max_tokens), value)
+
+    def _save(self, key, value):
+        """Keep `value` in both tiers. A failing disk write (locked, full) only costs the disk copy."""
+        expires_at = None
+        if self.disk is not None:
+            try:
+                expires_at = self.disk.set(key, value)
+            except (sqlite3.Error, OSError):
+                logger.warning("LLM cache disk write failed", exc_info=True)
+        self.memory.set(key, value, expires_at)
+
+    def get_or_compute(self, model, prompt, temperature, max_tokens, compute):
+        """The cached completion, or compute() once for every concurrent caller of the same key."""
+        if not self.cacheable(temperature):
+            return compute()
+        key = cache_key(model, prompt, temperature, max_tokens)
+        value = self.lookup(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            self._count("coalesced")
+            return future.result()
+
+        self._count("miss")
+        try:
+            value = compute()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            # followers get the value first, whatever happens to the write
+            future.set_result(value)
+            self._save(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._stats)
+        hits = counters["memory_hit"] + counters["disk_hit"] + counters["coalesced"]
+        lookups = hits + counters["miss"]
+        counters["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+        counters["memory_entries"] = len(self.memory)
+        return counters
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
@@ -0,0 +1,251 @@
+"""
+Request metrics aggregated across worker processes.
+
+RequestTimingMiddleware (main/instrumentation.py) records each request here:
+a latency histogram, DB time, query count, template render time and cache
+hits and misses, labelled by view. Every worker keeps its own counters in
+memory and writes them to ``METRICS_DIR/<host>-<pid>.json`` at most every
+``METRICS_FLUSH_SECONDS`` (write-then-rename, so readers never see a partial
+file). ``collect()`` sums the files of every worker, so any worker can serve
+the totals for the whole gunicorn pool; the newest few seconds of another
+worker may be missing. It also deletes the files of workers that are gone:
+those of this host whose pid no longer runs (recycled by max_requests, or
+from before a restart), and any not written for ``METRICS_STALE_SECONDS``.
+"""
+import contextvars
+import json
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# family name -> (type, help); samples carry the family name plus a suffix
+FAMILIES = {
+    "busbuddy_request_duration_seconds": ("histogram", "Request latency by view."),
+    "busbuddy_responses_total": ("counter", "Responses by view and status class."),
+    "busbuddy_db_seconds_total": ("counter", "Time spent in SQL queries by view."),
+    "busbuddy_db_queries_total": ("counter", "SQL queries run by view."),
+    "busbuddy_template_seconds_total": ("counter", "Template render time by view."),
+    "busbuddy_cache_requests_total": ("counter", "Cache lookups by view, cache and result."),
+    "busbuddy_llm_cache_total": ("counter", "LLM response cache lookups by result."),
+    "busbuddy_query_parser_total": ("counter", "Typed trip queries by what parsed them (rules, memo, llm)."),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_pid = os.getpid()
+_host = socket.gethostname()
+_last_flush = 0.0
+_current = contextvars.ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+    """What one request spent, filled in while it runs."""
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.template_seconds = 0.0
+        self.cache = {}  # (cache name, "hit" | "miss") -> count
+
+    def cache_counts(self):
+        hits = sum(n for (_, result), n in self.cache.items() if result == "hit")
+        return hits, sum(self.cache.values()) - hits
+
+
+def start():
+    """Begin collecting timings for the current request; pass the token to finish()."""
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def finish(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def add_template_time(seconds):
+    timings = _current.get()
+    if timings is not None:
+        timings.template_seconds += seconds
+
+
+def record_cache(name, hit):
+    """Count a cache lookup against the running request, if there is one."""
+    timings = _current.get()
+    if timings is not None:
+        key = (name, "hit" if hit else "miss")
+        timings.cache[key] = timings.cache.get(key, 0) + 1
+
+
+def _directory():
+    return getattr(settings, "METRICS_DIR", None)
+
+
+def _filename(pid):
+    return f"{_host}-{pid}.json"
+
+
+def _running(pid):
+    """True unless `pid` is certainly not a live process on this host."""
+    if os.name != "posix":
+        return True  # os.kill(pid, 0) would terminate it elsewhere
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # alive, but not ours to signal
+    return True
+
+
+def _gone(path, filename, now):
+    """Whether the worker that wrote `filename` has exited or stopped writing."""
+    if now - os.path.getmtime(path) > getattr(settings, "METRICS_STALE_SECONDS", 24 * 3600):
+        return True
+    host, _, pid = filename[:-len(".json")].rpartition("-")
+    # "<pid>.json" is the name older releases wrote
+    return host in (_host, "") and pid.isdigit() and not _running(int(pid))
+
+
+def _inc(name, labels, value=1):
+    key = (name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def _check_fork():
+    """A forked worker starts from zero rather than re-reporting its parent's counters."""
+    global _pid, _last_flush
+    if os.getpid() != _pid:
+        _pid = os.getpid()
+        _counters.clear()
+        _last_flush = 0.0
+
+
+def count(name, labels=(), value=1):
+    """Add to a process-wide counter that is not tied to a request (exported the same way)."""
+    with _lock:
+        _check_fork()
+        _inc(name, labels, value)
+
+
+def observe(view, method, status, seconds, timings):
+    """Add one finished request to this process's counters."""
+    labels = (("view", view), ("method", method))
+    with _lock:
+        _check_fork()
+        for bound in BUCKETS:
+            _inc("busbuddy_request_duration_seconds_bucket", labels + (("le", repr(bound)),), int(seconds <= bound))
+        _inc("busbuddy_request_duration_seconds_bucket", labels + (("le", "+Inf"),))
+        _inc("busbuddy_request_duration_seconds_sum", labels, seconds)
+        _inc("busbuddy_request_duration_seconds_count", labels)
+        _inc("busbuddy_responses_total", (("view", view), ("status", f"{status // 100}xx")))
+        _inc("busbuddy_db_seconds_total", (("view", view),), timings.db_seconds)
+        _inc("busbuddy_db_queries_total", (("view", view),), timings.queries)
+        _inc("busbuddy_template_seconds_total", (("view", view),), timings.template_seconds)
+        for (cache, result), n in timings.cache.items():
+            _inc("busbuddy_cache_requests_total", (("view", view), ("cache", cache), ("result", result)), n)
+    flush()
+
+
+def flush(force=False):
+    """Write this process's counters to METRICS_DIR, at most every METRICS_FLUSH_SECONDS unless forced."""
+    global _last_flush
+    directory = _directory()
+    if not directory:
+        return
+    now = time.monotonic()
+    with _lock:
+        _check_fork()
+        if not force and now - _last_flush < getattr(settings, "METRICS_FLUSH_SECONDS", 5):
+            return
+        _last_flush = now
+        rows = [[name, list(labels), value] for (name, labels), value in _counters.items()]
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, _filename(_pid))
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(rows, fh)
+    os.replace(tmp, path)
+
+
+def collect():
+    """({(name, labels): value} summed over every worker, number of workers reporting)."""
+    directory = _directory()
+    if not directory:
+        with _lock:
+            return dict(_counters), 1
+    flush(force=True)
+    totals, workers = {}, 0
+    now = time.time()
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if _gone(path, filename, now):
+                os.remove(path)
+                continue
+            with open(path) as fh:
+                rows = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        workers += 1
+        for name, labels, value in rows:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            totals[key] = totals.get(key, 0) + value
+    return totals, workers
+
+
+def _family(name):
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[: -len(suffix)] in FAMILIES:
+            return name[: -len(suffix)]
+    return name
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _bucket_order(item):
+    (name, labels), _ = item
+    bound = dict(labels).get("le")
+    return name, [pair for pair in labels if pair[0] != "le"], float(bound) if bound else 0.0
+
+
+def prometheus_text():
+    """Every worker's counters in the Prometheus text exposition format."""
+    totals, workers = collect()
+    by_family = {}
+    for item in sorted(totals.items(), key=_bucket_order):
+        by_family.setdefault(_family(item[0][0]), []).append(item)
+
+    lines = [
+        "# HELP busbuddy_metrics_workers Worker processes whose metrics are included.",
+        "# TYPE busbuddy_metrics_workers gauge",
+        f"busbuddy_metrics_workers {workers}",
+    ]
+    for family, (kind, help_text) in FAMILIES.items():
+        lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+        for (name, labels), value in by_family.get(family, []):
+            rendered = ",".join(f'{key}="{_escape(val)}"' for key, val in labels)
+            lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Forget this process's counters and its file (tests)."""
+    with _lock:
+        _counters.clear()
+    directory = _directory()
+    path = os.path.join(directory, _filename(_pid)) if directory else None
+    if path and os.path.exists(path):
+        os.remove(path)
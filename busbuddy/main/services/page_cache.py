@@ -0,0 +1,144 @@
+"""
+Whole-page cache with conditional GET for the pages whose content only
+changes on deploy: index, search, sectors, connected and who_we_are.
+
+A page is rendered once per deploy and URL and kept in the default cache.
+The only per-user part, the header actions (the login button or the user's
+name), sits between fragment markers (main/header_actions.html). It is
+spliced into the cached page on every hit from a fragment cached per user.
+
+Responses carry an ETag built from the deploy version, the URL and the
+user. Anonymous ones also get a Last-Modified of the newest template or
+static file. A revalidating browser or crawler gets its 304 before anything
+renders. For an anonymous client that takes no queries at all.
+
+The deploy version is PAGE_CACHE_VERSION when set (e.g. the release
+commit). Otherwise it is a hash of the app's template and static files, so
+a deploy that changes them starts from empty entries.
+"""
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from . import metrics
+
+FRAGMENT_TEMPLATE = "main/header_actions.html"
+FRAGMENT = re.compile(rb"<!--fragment:header-actions-->.*?<!--/fragment:header-actions-->", re.S)
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_deploy = None
+_deploy_lock = threading.Lock()
+
+
+def _enabled():
+    return getattr(settings, "PAGE_CACHE", True)
+
+
+def deploy():
+    """(version, last modified) of the templates and static files this process serves."""
+    global _deploy
+    with _deploy_lock:
+        if _deploy is None:
+            files = []
+            for folder in ("templates", "static"):
+                for root, _, names in os.walk(os.path.join(APP_DIR, folder)):
+                    for name in names:
+                        path = os.path.join(root, name)
+                        stat = os.stat(path)
+                        files.append((os.path.relpath(path, APP_DIR), stat.st_mtime_ns, stat.st_size))
+            files.sort()
+            version = getattr(settings, "PAGE_CACHE_VERSION", "") or hashlib.sha1(repr(files).encode()).hexdigest()[:12]
+            newest = max((mtime for _, mtime, _ in files), default=0) // 10**9
+            _deploy = (version, datetime.fromtimestamp(newest, tz=dt_timezone.utc))
+        return _deploy
+
+
+def reset():
+    """Recompute the deploy version on next use (tests)."""
+    global _deploy
+    with _deploy_lock:
+        _deploy = None
+
+
+def _variant(request):
+    """Who the header fragment is for; the name is part of it, so renaming yourself changes the ETag."""
+    user = request.user
+    if not user.is_authenticated:
+        return "anon"
+    return f"user:{user.pk}:{user.get_username()}:{user.first_name}"
+
+
+def _digest(*parts):
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+
+def _etag(request, *args, **kwargs):
+    if not _enabled():
+        return None
+    version, _ = deploy()
+    return _digest(version, request.get_full_path(), _variant(request))[:20]
+
+
+def _last_modified(request, *args, **kwargs):
+    # If-Modified-Since cannot tell users apart, so signed-in pages revalidate on the ETag alone
+    if not _enabled() or request.user.is_authenticated:
+        return None
+    return deploy()[1]
+
+
+def _fragment(request):
+    version, _ = deploy()
+    variant = _variant(request)
+    key = f"page:fragment:{_digest(version, variant)}"
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = render_to_string(FRAGMENT_TEMPLATE, {"user": request.user}).encode()
+        cache.set(key, fragment, timeout=getattr(settings, "PAGE_CACHE_TIMEOUT", 24 * 3600))
+    return fragment
+
+
+def cached_page(view_func):
+    """Serve a GET-only page from the page cache and answer conditional requests with 304."""
+
+    def render(request, *args, **kwargs):
+        if not _enabled() or request.method not in ("GET", "HEAD"):
+            return view_func(request, *args, **kwargs)
+        version, _ = deploy()
+        key = f"page:entry:{_digest(version, request.get_full_path())}"
+        entry = cache.get(key)
+        metrics.record_cache("page", entry is not None)
+        if entry is None:
+            response = view_func(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                cache.set(key, (response.content, response["Content-Type"]),
+                          timeout=getattr(settings, "PAGE_CACHE_TIMEOUT", 24 * 3600))
+            return response
+        content, content_type = entry
+        fragment = _fragment(request)
+        return HttpResponse(FRAGMENT.sub(lambda match: fragment, content, count=1), content_type=content_type)
+
+    conditional = condition(etag_func=_etag, last_modified_func=_last_modified)(render)
+
+    @wraps(view_func)
+    def page(request, *args, **kwargs):
+        response = conditional(request, *args, **kwargs)
+        # 304s carry the same caching headers as the page they stand for
+        if _enabled() and request.method in ("GET", "HEAD") and response.status_code in (200, 304):
+            patch_vary_headers(response, ["Cookie"])
+            if request.user.is_authenticated:
+                patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+            else:
+                patch_cache_control(response, public=True, max_age=getattr(settings, "PAGE_CACHE_MAX_AGE", 300))
+        return response
+
+    return page
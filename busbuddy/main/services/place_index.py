@@ -0,0 +1,206 @@
+"""
+Typo-tolerant autocomplete over stop and city names.
+
+Every distinct place (route origins, destinations, the stops CSV and Stop
+rows) is indexed in memory by the trigrams of each of its words, front
+padded so that "pun" and "pune" share "  p", " pu" and "pun". A typo breaks
+at most three of the query's trigrams, so candidates are the names sharing
+enough of them, and never fewer than two: a lone shared first letter is no
+match. At most MAX_CANDIDATES of them are ranked by prefix edit distance,
+then popularity (how many routes call there). Answering never touches the
+database: new routes are added on commit by the views and other workers'
+routes are picked up by a throttled sync. ``place()`` looks up whole names
+for the query parser.
+"""
+import heapq
+import re
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from ..models import Route, Stop, route_stop_names
+from .route_index import normalize
+
+# queries this short only complete word prefixes, with no typo tolerance
+SHORT_QUERY = 2
+
+# most names a query's edit distance is computed against: those sharing the most trigrams, then the most popular
+MAX_CANDIDATES = 200
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def phrase(text):
+    """The words of a name without punctuation, as the query parser matches them."""
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def _word_starts(name):
+    return [0] + [i + 1 for i, char in enumerate(name) if char == " "]
+
+
+def _trigrams(text):
+    padded = "  " + text
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _max_typos(query):
+    if len(query) < 4:
+        return 0
+    return 1 if len(query) < 8 else 2
+
+
+def prefix_distance(query, name, limit):
+    """
+    Smallest edit distance (with adjacent transpositions) between `query` and
+    a prefix of any word-aligned suffix of `name`, so "kolhapr" is one edit
+    from "kolhapur station" and "station" zero from it. Values above `limit`
+    are reported as ``limit + 1``.
+    """
+    best = limit + 1
+    width = len(query) + limit
+    for start in _word_starts(name):
+        target = name[start:start + width]
+        previous, current = None, list(range(len(target) + 1))
+        for i in range(1, len(query) + 1):
+            row = [i] + [0] * len(target)
+            for j in range(1, len(target) + 1):
+                cost = query[i - 1] != target[j - 1]
+                row[j] = min(row[j - 1] + 1, current[j] + 1, current[j - 1] + cost)
+                if (previous is not None and i > 1 and j > 1
+                        and query[i - 1] == target[j - 2] and query[i - 2] == target[j - 1]):
+                    row[j] = min(row[j], previous[j - 2] + 1)
+            previous, current = current, row
+        best = min(best, min(current))
+        if best == 0:
+            break
+    return best
+
+
+class PlaceIndex:
+    """Per-process autocomplete index; see the module docstring."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._display = {}
+        self._routes = {}
+        self._grams = {}
+        self._short = {}
+        self._phrases = {}
+        self.longest_phrase = 1
+        self._high_water = 0
+        self._synced_at = None
+
+    def add_name(self, name, route_id):
+        key = normalize(name)
+        if not key:
+            return
+        with self._lock:
+            routes = self._routes.get(key)
+            if routes is None:
+                routes = self._routes[key] = set()
+                self._display[key] = " ".join(name.split())
+                for start in _word_starts(key):
+                    for gram in _trigrams(key[start:]):
+                        self._grams.setdefault(gram, set()).add(key)
+                    for end in range(start + 1, min(start + SHORT_QUERY, len(key)) + 1):
+                        self._short.setdefault(key[start:end], set()).add(key)
+                words = phrase(key)
+                if words:
+                    self._phrases.setdefault(words, key)
+                    self.longest_phrase = max(self.longest_phrase, words.count(" ") + 1)
+            routes.add(route_id)
+
+    def add(self, route, stop_names=()):
+        for name in list(route.stop_names()) + list(stop_names):
+            self.add_name(name, route.pk)
+
+    def sync(self, force=False):
+        """Pull routes created since the last sync, at most every AUTOCOMPLETE_SYNC_SECONDS."""
+        interval = getattr(settings, "AUTOCOMPLETE_SYNC_SECONDS", 30)
+        if not force and self._synced_at is not None and time.monotonic() - self._synced_at < interval:
+            return
+        with self._lock:
+            start = self._high_water
+            rows = list(
+                Route.objects.filter(pk__gt=start)
+                .order_by("pk")
+                .values_list("pk", "origin", "stops", "destination")
+            )
+            if rows:
+                end = rows[-1][0]
+                for pk, origin, stops, destination in rows:
+                    for name in route_stop_names(origin, stops, destination):
+                        self.add_name(name, pk)
+                stops = Stop.objects.filter(route_id__gt=start, route_id__lte=end).values_list("route_id", "name")
+                for route_id, name in stops:
+                    self.add_name(name, route_id)
+                self._high_water = end
+            self._synced_at = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._display = {}
+            self._routes = {}
+            self._grams = {}
+            self._short = {}
+            self._phrases = {}
+            self.longest_phrase = 1
+            self._high_water = 0
+            self._synced_at = None
+
+    def names(self):
+        with self._lock:
+            return list(self._display.values())
+
+    def place(self, words):
+        """The display name of the place whose phrase() is exactly `words`, or None."""
+        key = self._phrases.get(words)
+        return self._display[key] if key is not None else None
+
+    def _candidates(self, query, typos):
+        """Names that can be within `typos` edits of `query`, judged by shared trigrams and length."""
+        grams = _trigrams(query)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._grams.get(gram, ()))
+        needed = max(2, len(grams) - 3 * typos)
+        shortest = len(query) - typos
+        candidates = [key for key, count in shared.items() if count >= needed and len(key) >= shortest]
+        if len(candidates) > MAX_CANDIDATES:
+            candidates = heapq.nlargest(
+                MAX_CANDIDATES, candidates, key=lambda key: (shared[key], len(self._routes[key]))
+            )
+        return candidates
+
+    def suggest(self, query, limit=8):
+        """
+        Up to `limit` places for a partly typed `query`, best first, as
+        ``[{"name": ..., "routes": ...}]`` where routes is the popularity.
+        """
+        self.sync()
+        query = normalize(query)
+        if not query:
+            return []
+        typos = _max_typos(query)
+        with self._lock:
+            if len(query) <= SHORT_QUERY:
+                candidates = self._short.get(query, ())
+            else:
+                candidates = self._candidates(query, typos)
+
+            ranked = []
+            for key in candidates:
+                distance = prefix_distance(query, key, typos)
+                if distance <= typos:
+                    ranked.append((distance, not key.startswith(query), -len(self._routes[key]), key))
+            ranked.sort()
+            return [
+                {"name": self._display[key], "routes": -popularity}
+                for _, _, popularity, key in ranked[:limit]
+            ]
+
+
+index = PlaceIndex()
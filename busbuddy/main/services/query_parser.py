@@ -0,0 +1,337 @@
+"""
+Turns a typed trip request such as "sleeper AC from Pune to Goa next Friday
+evening" into search_buses parameters.
+
+A rule-based pass handles the usual phrasings without leaving the process.
+Places are matched against the place index vocabulary, longest run of words
+first, and a single unknown word may be one typo away from a place. Day
+words resolve against the calendar, and filter words map to the values
+search_buses accepts. Only a query the rules cannot place (source or
+destination missing, with words left over) is sent to the model. The
+model's answer is memoized per normalized query; relative days in it are
+resolved on every call, so a memoized "tomorrow" stays right.
+"""
+import json
+import re
+import threading
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import anthropic_client, metrics, place_index
+from .llm_cache import LRU
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+
+# word -> (field, value); words the filters of search_buses understand
+FILTER_WORDS = {
+    "ac": ("bus_type", "AC"),
+    "nonac": ("bus_type", "Non-AC"),
+    "sleeper": ("sleeper_type", "Sleeper"),
+    "sleepers": ("sleeper_type", "Sleeper"),
+    "berth": ("sleeper_type", "Sleeper"),
+    "seater": ("sleeper_type", "Seater"),
+    "seaters": ("sleeper_type", "Seater"),
+    "sitting": ("sleeper_type", "Seater"),
+    "women": ("is_woman_safe", "on"),
+    "woman": ("is_woman_safe", "on"),
+    "ladies": ("is_woman_safe", "on"),
+    "lady": ("is_woman_safe", "on"),
+}
+TIMES_OF_DAY = {
+    "morning": "morning", "afternoon": "afternoon", "evening": "evening",
+    "night": "night", "overnight": "night",
+}
+PARAMS = ("source", "destination", "travel_date", "bus_type", "sleeper_type", "is_woman_safe")
+ROLE_WORDS = {"from": "source", "to": "destination", "towards": "destination", "till": "destination"}
+FILLER = set(
+    "a an the i me my we us need want wanna looking find show get give book booking ticket tickets "
+    "bus buses coach coaches seat seats journey trip travel travelling traveling going go leaving "
+    "departing depart on at in for of by with and or any some please pls via between cheap cheapest "
+    "safe only one two 1 2 day this".split()
+)
+
+_DAY_ALIASES = {name[:3]: i for i, name in enumerate(WEEKDAYS)}
+_DAY_ALIASES.update({name: i for i, name in enumerate(WEEKDAYS)})
+_DAY_ALIASES.update({"tues": 1, "weds": 2, "thur": 3, "thurs": 3})
+_KEYWORDS = set(FILTER_WORDS) | set(TIMES_OF_DAY) | set(ROLE_WORDS) | set(_DAY_ALIASES) | FILLER | {
+    "today", "tonight", "tomorrow", "tmrw", "next", "coming", "after",
+}
+
+# spellings folded before the text is split into words
+_REWRITES = [
+    (re.compile(r"\bnon[\s-]*(?:a\.?/?c\.?|air[\s-]*condition(?:ed|ing)?)(?=\W|$)"), " nonac "),
+    (re.compile(r"\b(?:a\.?/?c\.?|air[\s-]*condition(?:ed|ing)?)(?=\W|$)"), " ac "),
+]
+_ISO_DATE = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+_DMY_DATE = re.compile(r"\b(\d{1,2})[/.](\d{1,2})(?:[/.](\d{2,4}))?\b")
+_MONTH = r"(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*"
+_DAY_MONTH = re.compile(rf"\b(\d{{1,2}})(?:st|nd|rd|th)?\s+(?:of\s+)?{_MONTH}\b")
+_MONTH_DAY = re.compile(rf"\b{_MONTH}\s+(\d{{1,2}})(?:st|nd|rd|th)?\b")
+_WORD = re.compile(r"[a-z0-9]+")
+
+LLM_PROMPT = (
+    "\n\nHuman: Extract a bus search from the request below. Reply with one JSON object and nothing else, "
+    'with the keys "source", "destination" (place names as written, or null), "day" ("today", "tomorrow", '
+    'a weekday name, "next <weekday>", a YYYY-MM-DD date, or null), "bus_type" ("AC", "Non-AC" or null), '
+    '"sleeper_type" ("Sleeper", "Seater" or null) and "time_of_day" ("morning", "afternoon", "evening", '
+    '"night" or null).\n\nRequest: {query}\n\nAssistant:'
+)
+
+_memo = None
+_memo_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"rules": 0, "memo": 0, "llm": 0}
+
+
+def _memo_cache():
+    global _memo
+    with _memo_lock:
+        if _memo is None:
+            _memo = LRU(
+                getattr(settings, "QUERY_PARSER_MEMO_ENTRIES", 4096),
+                ttl=getattr(settings, "QUERY_PARSER_MEMO_TTL", 24 * 3600),
+            )
+        return _memo
+
+
+def _date_or_none(year, month, day, today):
+    try:
+        value = date(year, month, day)
+    except ValueError:
+        return None
+    # "23 Jan" typed in December means next January
+    if value < today and year == today.year:
+        try:
+            value = value.replace(year=year + 1)
+        except ValueError:
+            return None
+    return value
+
+
+def _take_date(text, today):
+    """(date or None, text with the date removed) for a calendar date written in the query."""
+    for pattern in (_ISO_DATE, _DMY_DATE, _DAY_MONTH, _MONTH_DAY):
+        match = pattern.search(text)
+        if match is None:
+            continue
+        if pattern is _ISO_DATE:
+            year, month, day = (int(g) for g in match.groups())
+        elif pattern is _DMY_DATE:
+            day, month = int(match.group(1)), int(match.group(2))
+            year = int(match.group(3)) if match.group(3) else today.year
+            year += 2000 if year < 100 else 0
+        elif pattern is _DAY_MONTH:
+            day, month, year = int(match.group(1)), MONTHS.index(match.group(2)) + 1, today.year
+        else:
+            month, day, year = MONTHS.index(match.group(1)) + 1, int(match.group(2)), today.year
+        value = _date_or_none(year, month, day, today)
+        if value is not None:
+            return value, text[:match.start()] + " " + text[match.end():]
+    return None, text
+
+
+def weekday_date(weekday, today, following=False):
+    """The next `weekday` (0 = Monday) on or after today; `following` ("next Friday") skips today."""
+    ahead = (weekday - today.weekday()) % 7
+    if ahead == 0 and following:
+        ahead = 7
+    return today + timedelta(days=ahead)
+
+
+def _fuzzy_place(word):
+    """A one-word place one edit away from `word`, for typos like "kolhapr"."""
+    if len(word) < 5:
+        return None
+    for suggestion in place_index.index.suggest(word, 3):
+        key = place_index.phrase(suggestion["name"])
+        if " " not in key and abs(len(key) - len(word)) <= 1 \
+                and place_index.prefix_distance(word, key, 1) <= 1:
+            return suggestion["name"]
+    return None
+
+
+def _match_place(words, i):
+    """(display name, words used) for the longest place starting at words[i], or (None, 0)."""
+    index = place_index.index
+    for n in range(min(index.longest_phrase, len(words) - i), 0, -1):
+        if n == 1 and words[i] in _KEYWORDS:
+            break
+        name = index.place(" ".join(words[i:i + n]))
+        if name is not None:
+            return name, n
+    return None, 0
+
+
+def parse_rules(text, today):
+    """
+    The rule-based pass: (params, time_of_day, leftover words). `params`
+    holds only what was recognised, named as search_buses expects.
+    """
+    text = " ".join((text or "").lower().split())
+    params = {}
+    travel_date, text = _take_date(text, today)
+    for pattern, replacement in _REWRITES:
+        text = pattern.sub(replacement, text)
+    words = _WORD.findall(text)
+
+    places, leftover = [], []
+    role, following, time_of_day = None, False, None
+    i = 0
+    while i < len(words):
+        word = words[i]
+        name, used = _match_place(words, i)
+        if name is not None:
+            places.append((role, name))
+            role = None
+            i += used
+            continue
+        i += 1
+        if word in ROLE_WORDS:
+            role = ROLE_WORDS[word]
+        elif word in ("next", "coming"):
+            following = True
+        elif word in _DAY_ALIASES:
+            travel_date = weekday_date(_DAY_ALIASES[word], today, following)
+        elif word in ("today", "tonight"):
+            travel_date = today
+            time_of_day = time_of_day or ("night" if word == "tonight" else None)
+        elif word in ("tomorrow", "tmrw"):
+            travel_date = today + timedelta(days=1)
+        elif word == "after" and words[i:i + 1] in (["tomorrow"], ["tmrw"]):
+            # "day after tomorrow"
+            travel_date = today + timedelta(days=2)
+            i += 1
+        elif word in FILTER_WORDS:
+            field, value = FILTER_WORDS[word]
+            params[field] = value
+        elif word in TIMES_OF_DAY:
+            time_of_day = TIMES_OF_DAY[word]
+        elif word in FILLER:
+            continue
+        else:
+            fuzzy = _fuzzy_place(word)
+            if fuzzy is not None:
+                places.append((role, fuzzy))
+                role = None
+            else:
+                leftover.append(word)
+
+    # "from"/"to" decide first; places without one fill whatever is still missing, in order
+    for place_role, name in places:
+        if place_role is not None:
+            params.setdefault(place_role, name)
+    rest = [name for _, name in places if name not in (params.get("source"), params.get("destination"))]
+    for wanted in ("source", "destination"):
+        if wanted not in params and rest:
+            params[wanted] = rest.pop(0)
+    if travel_date is not None:
+        params["travel_date"] = travel_date.isoformat()
+    return params, time_of_day, leftover
+
+
+def _llm_fields(query):
+    """The model's reading of `query` as a dict, memoized; None if it gave no usable answer."""
+    memo = _memo_cache()
+    fields = memo.get(query)
+    if fields is not None:
+        return fields, "memo"
+    answer = anthropic_client.generate(LLM_PROMPT.format(query=query), max_tokens=150)
+    start, end = answer.find("{"), answer.rfind("}")
+    try:
+        fields = json.loads(answer[start:end + 1]) if start != -1 else None
+    except ValueError:
+        fields = None
+    if not isinstance(fields, dict):
+        return None, "llm"  # failures are retried next time rather than memoized
+    memo.set(query, fields)
+    return fields, "llm"
+
+
+def _resolve_place(name):
+    if not isinstance(name, str):
+        return None
+    words = place_index.phrase(name)
+    return place_index.index.place(words) or _fuzzy_place(words)
+
+
+def _resolve_day(value, today):
+    if not isinstance(value, str):
+        return None
+    value = value.strip().lower()
+    if value in ("today", "tonight"):
+        return today
+    if value == "tomorrow":
+        return today + timedelta(days=1)
+    found, _ = _take_date(value, today)
+    if found is not None:
+        return found
+    following = value.startswith("next ")
+    weekday = _DAY_ALIASES.get(value.split()[-1]) if value else None
+    return weekday_date(weekday, today, following) if weekday is not None else None
+
+
+def _merge_llm(params, time_of_day, fields, today):
+    """Fill what the rules missed from the model's answer, keeping only values search_buses accepts."""
+    for field in ("source", "destination"):
+        if field not in params:
+            name = _resolve_place(fields.get(field))
+            if name is not None and name != params.get("source"):
+                params[field] = name
+    if "travel_date" not in params:
+        day = _resolve_day(fields.get("day"), today)
+        if day is not None:
+            params["travel_date"] = day.isoformat()
+    if fields.get("bus_type") in ("AC", "Non-AC"):
+        params.setdefault("bus_type", fields["bus_type"])
+    if fields.get("sleeper_type") in ("Sleeper", "Seater"):
+        params.setdefault("sleeper_type", fields["sleeper_type"])
+    if time_of_day is None and fields.get("time_of_day") in set(TIMES_OF_DAY.values()):
+        time_of_day = fields["time_of_day"]
+    return params, time_of_day
+
+
+def _count(via):
+    with _stats_lock:
+        _stats[via] += 1
+    metrics.count("busbuddy_query_parser_total", (("via", via),))
+
+
+def parse(text, today=None, fallback=True):
+    """
+    Read a typed trip request. Returns a dict with `params` (search_buses
+    parameters), `time_of_day`, the `unparsed` words and `via`: "rules",
+    "memo" or "llm", whichever answered.
+    """
+    today = today or timezone.localdate()
+    place_index.index.sync()
+    params, time_of_day, leftover = parse_rules(text, today)
+    via = "rules"
+    if fallback and leftover and not ("source" in params and "destination" in params):
+        fields, via = _llm_fields(" ".join((text or "").lower().split()))
+        if fields is not None:
+            params, time_of_day = _merge_llm(params, time_of_day, fields, today)
+    _count(via)
+    params = {name: params[name] for name in PARAMS if name in params}
+    return {"params": params, "time_of_day": time_of_day, "unparsed": leftover, "via": via}
+
+
+def stats():
+    """How queries were answered by this worker process."""
+    with _stats_lock:
+        counters = dict(_stats)
+    total = sum(counters.values())
+    counters["rules_rate"] = round(counters["rules"] / total, 4) if total else 0.0
+    return counters
+
+
+def reset():
+    """Forget the memo and the counters (tests)."""
+    global _memo
+    with _memo_lock:
+        _memo = None
+    with _stats_lock:
+        for via in _stats:
+            _stats[via] = 0
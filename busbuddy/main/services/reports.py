@@ -0,0 +1,84 @@
+from decimal import Decimal
+
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from ..models import Booking, Schedule, Trip
+
+
+def _empty_schedule_stats():
+    return {
+        "seats_sold": 0,
+        "revenue": Decimal("0"),
+        "upcoming_trips": 0,
+        "upcoming_seats": 0,
+        "occupancy": 0,
+    }
+
+
+def schedule_stats(schedule_ids, today=None):
+    """
+    Sales figures for many schedules in two grouped queries:
+    ``{schedule_id: {seats_sold, revenue, upcoming_trips, upcoming_seats, occupancy}}``.
+
+    seats_sold and revenue cover paid bookings; upcoming_seats counts every live
+    booking (paid or held) on trips from `today` on, and occupancy is that as a
+    percentage of the upcoming trips' capacity.
+    """
+    today = today or timezone.localdate()
+    stats = {schedule_id: _empty_schedule_stats() for schedule_id in schedule_ids}
+    upcoming = Q(trip__service_date__gte=today)
+
+    bookings = (
+        Booking.objects.filter(schedule_id__in=list(stats), cancelled=False)
+        .order_by()
+        .values("schedule_id")
+        .annotate(
+            seats_sold=Sum("seats", filter=Q(paid=True)),
+            revenue=Sum("amount_paid", filter=Q(paid=True)),
+            upcoming_seats=Sum("seats", filter=upcoming),
+        )
+    )
+    for row in bookings:
+        entry = stats[row["schedule_id"]]
+        entry["seats_sold"] = row["seats_sold"] or 0
+        entry["revenue"] = row["revenue"] or Decimal("0")
+        entry["upcoming_seats"] = row["upcoming_seats"] or 0
+
+    trips = (
+        Trip.objects.filter(schedule_id__in=list(stats), service_date__gte=today, cancelled=False)
+        .order_by()
+        .values("schedule_id")
+        .annotate(trips=Count("pk"), capacity=Sum("schedule__bus__total_seats"))
+    )
+    for row in trips:
+        entry = stats[row["schedule_id"]]
+        entry["upcoming_trips"] = row["trips"]
+        if row["capacity"]:
+            entry["occupancy"] = round(100 * entry["upcoming_seats"] / row["capacity"])
+    return stats
+
+
+def bus_stats(bus_ids):
+    """``{bus_id: {schedules, seats_sold, revenue}}`` over all of each bus's schedules, in two grouped queries."""
+    stats = {bus_id: {"schedules": 0, "seats_sold": 0, "revenue": Decimal("0")} for bus_id in bus_ids}
+    schedules = (
+        Schedule.objects.filter(bus_id__in=list(stats))
+        .order_by()
+        .values("bus_id")
+        .annotate(n=Count("pk"))
+        .values_list("bus_id", "n")
+    )
+    for bus_id, count in schedules:
+        stats[bus_id]["schedules"] = count
+    sales = (
+        Booking.objects.filter(schedule__bus_id__in=list(stats), cancelled=False, paid=True)
+        .order_by()
+        .values("schedule__bus_id")
+        .annotate(seats_sold=Sum("seats"), revenue=Sum("amount_paid"))
+    )
+    for row in sales:
+        entry = stats[row["schedule__bus_id"]]
+        entry["seats_sold"] = row["seats_sold"] or 0
+        entry["revenue"] = row["revenue"] or Decimal("0")
+    return stats
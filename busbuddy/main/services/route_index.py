@@ -0,0 +1,106 @@
+import threading
+from bisect import bisect_right
+
+from ..models import Route, route_stop_names
+
+
+def normalize(name):
+    """Lowercase a stop name and collapse internal whitespace."""
+    return " ".join((name or "").lower().split())
+
+
+def _substrings(name):
+    """Every substring of the name.
+
+    The search this index replaced matched ``term in stop``, so "une" finds
+    "pune station" as well as "pune" and "station" do.
+    """
+    return {name[start:end] for start in range(len(name)) for end in range(start + 1, len(name) + 1)}
+
+
+class RouteIndex:
+    """
+    Per-process inverted index from normalized stop names to routes.
+
+    Each posting maps a name substring to ``{route_id: [positions]}`` where the
+    position is the index of the stop in [origin, stops..., destination].
+    The index loads every route on first use and afterwards only pulls routes
+    with a primary key above the highest one it has seen, so routes created by
+    other worker processes show up on the next search.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}
+        self._lengths = {}
+        self._high_water = 0
+
+    def add_route(self, route_id, names):
+        with self._lock:
+            if route_id in self._lengths:
+                return
+            self._lengths[route_id] = len(names)
+            for position, name in enumerate(names):
+                for key in _substrings(normalize(name)):
+                    routes = self._postings.setdefault(key, {})
+                    positions = routes.setdefault(route_id, [])
+                    if not positions or positions[-1] != position:
+                        positions.append(position)
+
+    def add(self, route):
+        self.add_route(route.pk, route_stop_names(route.origin, route.stops, route.destination))
+
+    def sync(self):
+        rows = (
+            Route.objects.filter(pk__gt=self._high_water)
+            .order_by("pk")
+            .values_list("pk", "origin", "stops", "destination")
+        )
+        with self._lock:
+            for pk, origin, stops, destination in rows:
+                self.add_route(pk, route_stop_names(origin, stops, destination))
+                self._high_water = max(self._high_water, pk)
+
+    def clear(self):
+        with self._lock:
+            self._postings = {}
+            self._lengths = {}
+            self._high_water = 0
+
+    def match(self, source, destination):
+        """
+        Return ``{route_id: (source_position, destination_position)}`` for
+        routes that visit ``source`` and then, later on, ``destination``.
+
+        Matching mirrors the old linear scan: a term matches any stop it is a
+        substring of; the first stop matching the source is used, and the
+        first stop after it matching the destination.
+        An empty term matches the first stop (source) or the stop right after
+        the source (destination).
+        """
+        self.sync()
+        source = normalize(source)
+        destination = normalize(destination)
+        with self._lock:
+            if source:
+                src = {rid: positions[0] for rid, positions in self._postings.get(source, {}).items()}
+            else:
+                src = dict.fromkeys(self._lengths, 0)
+            dst_postings = self._postings.get(destination, {}) if destination else None
+
+            matches = {}
+            for route_id, s in src.items():
+                if dst_postings is None:
+                    if s + 1 < self._lengths[route_id]:
+                        matches[route_id] = (s, s + 1)
+                    continue
+                positions = dst_postings.get(route_id)
+                if not positions:
+                    continue
+                i = bisect_right(positions, s)
+                if i < len(positions):
+                    matches[route_id] = (s, positions[i])
+            return matches
+
+
+index = RouteIndex()
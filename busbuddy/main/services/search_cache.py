@@ -0,0 +1,130 @@
+"""
+Search results cache with write-triggered invalidation.
+
+Entries are keyed on the normalized query and remember the version token of
+everything they were computed from: the global catalog (bumped when routes,
+schedules or trips are added), every route and every schedule examined.
+A read compares those tokens with the current ones in one get_many, so a
+booking on one schedule invalidates exactly the searches that looked at it
+and entries can otherwise live for a long time.
+
+The tokens live in the "search_versions" cache, which every worker shares,
+while the entries stay in the default cache: a bump made by one worker then
+makes the entries of all of them stale, even when each keeps its own.
+"""
+import hashlib
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache, caches
+
+from . import metrics
+
+CATALOG = "search:v:catalog"
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stale": 0}
+
+
+def _route_key(route_id):
+    return f"search:v:route:{route_id}"
+
+
+def _schedule_key(schedule_id):
+    return f"search:v:schedule:{schedule_id}"
+
+
+def _entry_key(query):
+    raw = repr(sorted(query.items())).encode()
+    return "search:entry:" + hashlib.sha1(raw).hexdigest()
+
+
+def _tokens():
+    return caches["search_versions"]
+
+
+def _timeout():
+    return getattr(settings, "SEARCH_CACHE_TIMEOUT", 3600)
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _current_versions(keys):
+    """
+    Current token for each version key. Missing keys (never bumped, or evicted)
+    get a fresh token, so an evicted counter can never match an old entry.
+    """
+    shared = _tokens()
+    versions = shared.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        fresh = {key: uuid.uuid4().hex for key in missing}
+        for key, token in fresh.items():
+            shared.add(key, token, timeout=None)
+        versions.update(shared.get_many(missing))
+    return versions
+
+
+def lookup(query):
+    """Cached results for `query`, or None on a miss or a stale entry."""
+    entry = cache.get(_entry_key(query))
+    if entry is None:
+        _count("misses")
+        metrics.record_cache("search", False)
+        return None
+    snapshot, results = entry
+    if _current_versions(list(snapshot)) != snapshot:
+        _count("stale")
+        _count("misses")
+        metrics.record_cache("search", False)
+        return None
+    _count("hits")
+    metrics.record_cache("search", True)
+    return results
+
+
+def versions(route_ids=(), schedule_ids=(), catalog=True):
+    """
+    Snapshot the version tokens a result depends on. Take the snapshot before
+    reading the data it covers: a bump that lands afterwards then leaves the
+    entry stale instead of hiding the change.
+    """
+    keys = [CATALOG] if catalog else []
+    keys += [_route_key(pk) for pk in route_ids] + [_schedule_key(pk) for pk in schedule_ids]
+    return _current_versions(keys)
+
+
+def store(query, snapshot, results):
+    """Store `results` for `query` along with the version `snapshot` they were computed under."""
+    cache.set(_entry_key(query), (snapshot, results), _timeout())
+
+
+def _bump(keys):
+    if keys:
+        _tokens().set_many({key: uuid.uuid4().hex for key in keys}, timeout=None)
+
+
+def bump_catalog():
+    """New routes, schedules or trips: any search may now have more results."""
+    _bump([CATALOG])
+
+
+def bump_routes(route_ids):
+    _bump([_route_key(pk) for pk in route_ids])
+
+
+def bump_schedules(schedule_ids):
+    """Availability or details of these schedules changed."""
+    _bump([_schedule_key(pk) for pk in schedule_ids])
+
+
+def stats():
+    with _lock:
+        counters = dict(_stats)
+    lookups = counters["hits"] + counters["misses"]
+    counters["hit_rate"] = round(counters["hits"] / lookups, 4) if lookups else 0.0
+    return counters
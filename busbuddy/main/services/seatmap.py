@@ -0,0 +1,74 @@
+"""
+Compact seat maps.
+
+A seat map is an int used as a bitset: bit ``n - 1`` is set when seat ``n`` is
+taken. On a TripSegment it is stored as little-endian bytes (one bit per seat,
+so a 50-seat bus needs 7 bytes). A journey's occupancy is the OR of the maps
+of the segments it covers.
+"""
+
+
+def from_bytes(data):
+    return int.from_bytes(bytes(data or b""), "little")
+
+
+def to_bytes(bits, total_seats):
+    return bits.to_bytes((max(total_seats, bits.bit_length()) + 7) // 8, "little")
+
+
+def is_taken(bits, seat):
+    return bool(bits >> (seat - 1) & 1)
+
+
+def mask(seats):
+    bits = 0
+    for seat in seats:
+        bits |= 1 << (seat - 1)
+    return bits
+
+
+def free_seats(bits, total_seats):
+    return [seat for seat in range(1, total_seats + 1) if not is_taken(bits, seat)]
+
+
+def parse_seat_numbers(value):
+    """Seat numbers from a CSV such as "1,2,3" (the Booking.seat_numbers format)."""
+    seats = []
+    for part in (value or "").split(","):
+        part = part.strip()
+        if part.isdigit():
+            seats.append(int(part))
+    return seats
+
+
+def format_seat_numbers(seats):
+    return ",".join(str(seat) for seat in sorted(seats))
+
+
+def allocate(bits, total_seats, count, requested=None):
+    """
+    Pick seats for a booking given the journey's occupancy `bits`.
+
+    With `requested` seat numbers, returns them if they all exist and are free.
+    Otherwise returns the first run of `count` adjacent free seats, or failing
+    that the lowest `count` free seats. Returns None when it cannot be done.
+    """
+    if requested:
+        requested = sorted(set(requested))
+        if any(seat < 1 or seat > total_seats or is_taken(bits, seat) for seat in requested):
+            return None
+        return requested
+
+    run = []
+    for seat in range(1, total_seats + 1):
+        if is_taken(bits, seat):
+            run = []
+            continue
+        run.append(seat)
+        if len(run) == count:
+            return run
+
+    available = free_seats(bits, total_seats)
+    if len(available) < count:
+        return None
+    return available[:count]
@@ -0,0 +1,220 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from ..models import Schedule, ServiceException, Trip, TripSegment, route_stop_names
+from . import search_cache
+
+
+def horizon_days():
+    return getattr(settings, "TRIP_HORIZON_DAYS", 60)
+
+
+def _exception_dates(start, end, schedule_ids=None):
+    """Return ({dates closed for everyone}, {schedule_id: {dates}}) within [start, end]."""
+    exceptions = ServiceException.objects.filter(date__gte=start, date__lte=end)
+    if schedule_ids is not None:
+        exceptions = exceptions.filter(Q(schedule__isnull=True) | Q(schedule_id__in=schedule_ids))
+    closed, per_schedule = set(), {}
+    for schedule_id, day in exceptions.values_list("schedule_id", "date"):
+        if schedule_id is None:
+            closed.add(day)
+        else:
+            per_schedule.setdefault(schedule_id, set()).add(day)
+    return closed, per_schedule
+
+
+def segment_count(route):
+    """Number of inventory segments on a route (a schedule without a route has one)."""
+    if route is None:
+        return 1
+    return len(route.stop_names()) - 1
+
+
+def _create_missing_segments(trips, batch_size=1000):
+    """Give every trip in the queryset that has no segments a full set at bus capacity."""
+    rows = trips.filter(segments__isnull=True).values_list(
+        "pk",
+        "schedule__bus__total_seats",
+        "schedule__route__origin",
+        "schedule__route__stops",
+        "schedule__route__destination",
+    )
+    segments = []
+    for trip_id, total_seats, origin, stops, destination in rows:
+        count = len(route_stop_names(origin, stops, destination)) - 1 if origin is not None else 1
+        segments += [TripSegment(trip_id=trip_id, index=i, seats_remaining=total_seats) for i in range(count)]
+    TripSegment.objects.bulk_create(segments, batch_size=batch_size, ignore_conflicts=True)
+
+
+def materialize_trips(start=None, days=None, schedules=None, batch_size=1000):
+    """
+    Create the Trip rows for every schedule running in [start, start + days).
+
+    Recurring schedules expand their weekday mask, dated schedules produce the
+    single trip on their date, and service exceptions are skipped. `schedules`
+    narrows the run to a Schedule queryset. Existing trips are left alone, so
+    this is safe to run repeatedly (e.g. nightly to roll the horizon forward).
+    Returns the number of trips attempted.
+    """
+    start = start or timezone.localdate()
+    days = horizon_days() if days is None else days
+    end = start + timedelta(days=days - 1)
+
+    queryset = Schedule.objects.all() if schedules is None else schedules
+    rows = list(
+        queryset.filter(Q(date__isnull=True, days_mask__gt=0) | Q(date__gte=start, date__lte=end))
+        .values_list("pk", "date", "days_mask")
+    )
+    closed, per_schedule = _exception_dates(start, end, None if schedules is None else [r[0] for r in rows])
+
+    dates = [start + timedelta(days=i) for i in range(days)]
+    trips = []
+    for schedule_id, date, days_mask in rows:
+        skipped = per_schedule.get(schedule_id, set())
+        running = [date] if date else [d for d in dates if days_mask & (1 << d.weekday())]
+        for day in running:
+            if day in closed or day in skipped:
+                continue
+            trips.append(Trip(schedule_id=schedule_id, service_date=day))
+
+    Trip.objects.bulk_create(trips, batch_size=batch_size, ignore_conflicts=True)
+    window = Trip.objects.filter(service_date__gte=start, service_date__lte=end)
+    if schedules is not None:
+        window = window.filter(schedule__in=queryset.values("pk"))
+    _create_missing_segments(window, batch_size=batch_size)
+    return len(trips)
+
+
+def apply_service_exceptions(start=None):
+    """Mark already-materialized trips that fall on an exception date as cancelled."""
+    start = start or timezone.localdate()
+    cancelled = 0
+    for schedule_id, day in ServiceException.objects.filter(date__gte=start).values_list("schedule_id", "date"):
+        cancelled += apply_exception(schedule_id, day)
+    return cancelled
+
+
+def _trips_on(schedule_id, day):
+    trips = Trip.objects.filter(service_date=day)
+    return trips if schedule_id is None else trips.filter(schedule_id=schedule_id)
+
+
+def apply_exception(schedule_id, day):
+    """Cancel the trips already materialized on an exception's date (every schedule's if `schedule_id` is None)."""
+    cancelled = _trips_on(schedule_id, day).filter(cancelled=False).update(cancelled=True)
+    # searches also offer dates with no trip yet, so the schedule changes even when nothing was cancelled
+    if schedule_id is None:
+        transaction.on_commit(search_cache.bump_catalog)
+    else:
+        transaction.on_commit(lambda: search_cache.bump_schedules([schedule_id]))
+    return cancelled
+
+
+def lift_exception(schedule_id, day):
+    """Reopen the trips a removed or moved exception cancelled, unless another exception still covers them."""
+    others = ServiceException.objects.filter(date=day)
+    if others.filter(schedule__isnull=True).exists():
+        return 0
+    trips = _trips_on(schedule_id, day).filter(cancelled=True).exclude(
+        schedule_id__in=others.filter(schedule__isnull=False).values("schedule_id")
+    )
+    reopened = trips.update(cancelled=False)
+    if reopened:
+        # searches that skipped these schedules did not record their versions
+        transaction.on_commit(search_cache.bump_catalog)
+    return reopened
+
+
+def unmaterialized(day):
+    """
+    Schedule filter for schedules with no trip on `day` and no exception
+    closing it: the horizon has not reached the date yet. Their trip is
+    created by the booking that needs it, so reads never write; every seat
+    on them is still free.
+    """
+    return (
+        ~Exists(Trip.objects.filter(schedule=OuterRef("pk"), service_date=day))
+        & ~Exists(ServiceException.objects.filter(Q(schedule__isnull=True) | Q(schedule=OuterRef("pk")), date=day))
+    )
+
+
+def is_excepted(schedule, day):
+    return ServiceException.objects.filter(
+        Q(schedule__isnull=True) | Q(schedule=schedule), date=day
+    ).exists()
+
+
+def get_trip(schedule, service_date, create=True):
+    """
+    The trip of `schedule` on `service_date`, creating it on demand when the
+    date lies beyond the materialized horizon. None if the bus does not run.
+    With create=False such a trip is returned unsaved instead, for reads.
+    """
+    if service_date < timezone.localdate():
+        return None
+    trip = Trip.objects.filter(schedule=schedule, service_date=service_date).first()
+    if trip is not None:
+        return None if trip.cancelled else trip
+    if not schedule.runs_on(service_date):
+        return None
+    if is_excepted(schedule, service_date):
+        return None
+    if not create:
+        return Trip(schedule=schedule, service_date=service_date)
+    try:
+        with transaction.atomic():
+            trip = Trip.objects.create(schedule=schedule, service_date=service_date)
+            TripSegment.objects.bulk_create([
+                TripSegment(trip=trip, index=i, seats_remaining=schedule.bus.total_seats)
+                for i in range(segment_count(schedule.route))
+            ])
+            return trip
+    except IntegrityError:
+        return Trip.objects.get(schedule=schedule, service_date=service_date)
+
+
+def next_service_dates(schedules, from_date=None, day_bit=None):
+    """
+    {schedule_id: the first date on or after `from_date` (today by default)
+    that the schedule runs and no exception or cancelled trip closes}, looking
+    one horizon ahead and, with `day_bit`, only on that weekday. The date may
+    not have a trip yet. Two queries for any number of schedules.
+    """
+    from_date = from_date or timezone.localdate()
+    dates = [from_date + timedelta(days=i) for i in range(horizon_days())]
+    if day_bit:
+        dates = [day for day in dates if day_bit & (1 << day.weekday())]
+    end = max([from_date] + [schedule.date for schedule in schedules if schedule.date])
+    end = max(end, from_date + timedelta(days=horizon_days() - 1))
+    ids = [schedule.pk for schedule in schedules]
+    closed, per_schedule = _exception_dates(from_date, end, ids)
+    cancelled = Trip.objects.filter(
+        schedule_id__in=ids, service_date__gte=from_date, service_date__lte=end, cancelled=True
+    ).values_list("schedule_id", "service_date")
+    for schedule_id, day in cancelled:
+        per_schedule.setdefault(schedule_id, set()).add(day)
+
+    upcoming = {}
+    for schedule in schedules:
+        skipped = per_schedule.get(schedule.pk, set())
+        if schedule.date:
+            running = [schedule.date] if schedule.date >= from_date else []
+        else:
+            running = [day for day in dates if schedule.days_mask & (1 << day.weekday())]
+        day = next((day for day in running if day not in closed and day not in skipped), None)
+        if day is not None:
+            upcoming[schedule.pk] = day
+    return upcoming
+
+
+def next_trip(schedule, from_date=None, create=True):
+    """
+    The first bookable trip of `schedule` on or after `from_date` (today by
+    default). Its date need not be materialized yet; see get_trip.
+    """
+    day = next_service_dates([schedule], from_date).get(schedule.pk)
+    return get_trip(schedule, day, create) if day else None
@@ -1,3 +1,1436 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from busbuddy import sqlite
+
+from . import urls, views
+from .instrumentation import QueryBudgetExceeded, QueryBudgetMiddleware, QueryCounter, query_budget
+from .models import (
+    Booking, Bus, Conductor, Payment, Schedule, SeatHold, ServiceException, Trip, seats_available, segment_availability,
+)
+from .services import (
+    anthropic_client, fares, holds, inventory, journeys, llm_cache, metrics, page_cache, place_index, query_parser,
+    route_index, search_cache, trips,
+)
+from .services.anthropic_client import AnthropicClient, CircuitBreaker, CircuitOpen
+from .services.anthropic_stub import StubAnthropic
+
+EVERY_DAY = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+# "SCAN main_booking" reads the whole table; "SCAN ... USING INDEX" and "SEARCH" do not
+FULL_SCAN = re.compile(r"\bSCAN (main_\w+|auth_\w+|django_\w+)(?: AS \w+)?$")
+SORTS = "USE TEMP B-TREE FOR ORDER BY"
+
+
+def setUpModule():
+    """Keep the suite's caches away from the project's: the search-version tokens live on disk."""
+    versions_dir = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(versions_dir.cleanup)
+    test_caches = override_settings(CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "busbuddy-tests"},
+        "search_versions": {**settings.CACHES["search_versions"], "LOCATION": versions_dir.name},
+    })
+    test_caches.enable()
+    unittest.addModuleCleanup(test_caches.disable)
+
+
+class BusTestCase(TestCase):
+    """A signed-in conductor with fresh per-process indexes; bus() registers one through the view."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("conductor@example.com", "conductor@example.com", "pw")
+        Conductor.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        caches["search_versions"].clear()
+        route_index.index.clear()
+        place_index.index.clear()
+        self.client.force_login(self.user)
+
+    def bus(self, origin, destination, departure="08:00", arrival="18:00", stops=(), stop_times=(),
+            seats=40, **fields):
+        """The Schedule of a new bus from `origin` to `destination` running every day."""
+        self.client.post("/register_bus/", {
+            "bus_name": f"{origin}-{destination}", "bus_number": f"MH-{Bus.objects.count()}",
+            "total_seats": seats, "from_city": origin, "to_city": destination,
+            "departure_time": departure, "arrival_time": arrival, "days": EVERY_DAY,
+            "stops[]": list(stops), "stop_times[]": list(stop_times), **fields,
+        })
+        return Schedule.objects.order_by("-pk").first()
+
+    def details(self, bus, origin, destination, stops="", seats=None, ac_type="Non-AC", bus_type="Seater",
+                departure="08:00", arrival="18:00"):
+        """Add a route and schedule to `bus` through bus_details; returns the new Schedule."""
+        self.client.post(f"/bus/{bus.pk}/details/", {
+            "ac_type": ac_type, "bus_type": bus_type, "seats": seats or bus.total_seats,
+            "origin": origin, "destination": destination, "stops": stops,
+            "departure_time": departure, "arrival_time": arrival, "days": EVERY_DAY,
+        })
+        return Schedule.objects.order_by("-pk").first()
+
+
+class RouteIndexTests(BusTestCase):
+    """Stop-name lookups: substrings of a stop name, direction of travel, and routes added after the first load."""
+
+    def test_matches_substrings_in_order(self):
+        route = self.bus("Pune Station", "Goa", stops=["Satara", "Kolhapur"], stop_times=["10:00", "12:00"]).route
+        index = route_index.index
+        self.assertEqual(index.match("pune", "goa"), {route.pk: (0, 3)})
+        self.assertEqual(index.match("station", "kolh"), {route.pk: (0, 2)})
+        self.assertEqual(index.match("  SATARA ", "Go"), {route.pk: (1, 3)})
+        self.assertEqual(index.match("pune", ""), {route.pk: (0, 1)})
+        self.assertEqual(index.match("une", "oa"), {route.pk: (0, 3)})  # anywhere in the name, as before
+        self.assertEqual(index.match("pune goa", ""), {})
+
+    def test_destination_must_come_after_source(self):
+        self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"])
+        self.assertEqual(route_index.index.match("goa", "pune"), {})
+        self.assertEqual(route_index.index.match("satara", "pune"), {})
+        back = self.bus("Goa", "Pune").route
+        self.assertEqual(route_index.index.match("goa", "pune"), {back.pk: (0, 1)})
+
+    def test_routes_added_after_load_are_found(self):
+        first = self.bus("Pune", "Goa")
+        self.assertEqual(set(route_index.index.match("pune", "goa")), {first.route_id})
+        with self.captureOnCommitCallbacks(execute=True):
+            second = self.bus("Pune", "Goa")
+        with self.captureOnCommitCallbacks(execute=True):
+            third = self.details(first.bus, "Pune", "Belgaum", stops="Goa")
+        # added on commit by the views, before any sync pulls them
+        self.assertTrue({second.route_id, third.route_id} <= set(route_index.index._lengths))
+        self.assertEqual(set(route_index.index.match("pune", "goa")),
+                         {first.route_id, second.route_id, third.route_id})
+        self.assertEqual(route_index.index.match("goa", "belg"), {third.route_id: (1, 2)})
+
+
+class SeatInventoryTests(BusTestCase):
+    """The conditional decrement is the only availability check; cancelling gives the seats back once."""
+
+    def remaining(self, trip):
+        return sorted(trip.segments.values_list("seats_remaining", flat=True))
+
+    def test_two_requests_for_the_last_seat(self):
+        schedule = self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"], seats=2)
+        trip = schedule.trips.order_by("service_date").first()
+        inventory.reserve_seats(trip.pk, 1)
+        # both requests saw one free seat before either took it
+        self.assertEqual(seats_available(trip), 1)
+        url, data = f"/start-booking/{schedule.pk}/", {"seats": 1, "service_date": trip.service_date.isoformat()}
+        first, second = self.client.post(url, data), self.client.post(url, data)
+        self.assertTrue(first.url.startswith("/payment/"))
+        self.assertEqual(second.url, reverse("bookings"))
+        self.assertEqual(Booking.objects.count(), 1)
+        self.assertEqual(self.remaining(trip), [0, 0])
+        self.assertIsNone(inventory.reserve_seats(trip.pk, 1))
+        self.assertEqual(self.remaining(trip), [0, 0])
+
+    def test_a_short_segment_rolls_back_the_others(self):
+        schedule = self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"], seats=2)
+        trip = schedule.trips.order_by("service_date").first()
+        inventory.reserve_seats(trip.pk, 2, board=1, alight=2)
+        self.assertIsNone(inventory.reserve_seats(trip.pk, 1))
+        self.assertEqual(self.remaining(trip), [0, 2])
+
+    def test_cancelling_restores_counters_once(self):
+        schedule = self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"], seats=4)
+        trip = schedule.trips.order_by("service_date").first()
+        self.client.post(f"/start-booking/{schedule.pk}/",
+                         {"seats": 3, "service_date": trip.service_date.isoformat()})
+        booking = Booking.objects.get()
+        self.assertEqual(self.remaining(trip), [1, 1])
+        self.client.post(f"/booking/{booking.pk}/cancel/")
+        self.client.post(f"/booking/{booking.pk}/cancel/")
+        self.assertEqual(self.remaining(trip), [4, 4])
+        self.assertEqual(inventory.journey_seat_map(trip), 0)
+        self.assertFalse(inventory.drifted_segments().exists())
+
+
+class SegmentInventoryTests(BusTestCase):
+    """A booking for part of a route holds only the segments between its boarding and alighting stops."""
+
+    def setUp(self):
+        super().setUp()
+        # Pune -0- Satara -1- Kolhapur -2- Goa
+        self.schedule = self.bus("Pune", "Goa", stops=["Satara", "Kolhapur"], stop_times=["10:00", "12:00"], seats=2)
+        self.trip = self.schedule.trips.order_by("service_date").first()
+
+    def book(self, board, alight, seats=1):
+        before = Booking.objects.count()
+        self.client.post(f"/start-booking/{self.schedule.pk}/", {
+            "seats": seats, "service_date": self.trip.service_date.isoformat(), "board": board, "alight": alight,
+        })
+        return Booking.objects.count() > before
+
+    def test_partial_booking_takes_only_its_segments(self):
+        self.assertTrue(self.book(1, 2, seats=2))
+        self.assertEqual(list(self.trip.segments.order_by("index").values_list("seats_remaining", flat=True)),
+                         [2, 0, 2])
+        self.assertEqual(segment_availability({self.trip.pk: (0, 1)}), {self.trip.pk: 2})
+        self.assertEqual(segment_availability({self.trip.pk: (0, 3)}), {self.trip.pk: 0})
+        self.assertEqual(seats_available(self.trip, 2, 3), 2)
+
+    def test_overlap_with_a_full_segment_is_refused(self):
+        self.assertTrue(self.book(0, 1, seats=2))
+        self.assertFalse(self.book(0, 2))
+        self.assertTrue(self.book(1, 3))
+        self.assertTrue(self.book(1, 3))
+        self.assertFalse(self.book(2, 3))
+        self.assertEqual(list(self.trip.segments.order_by("index").values_list("seats_remaining", flat=True)),
+                         [0, 0, 0])
+        self.assertFalse(inventory.drifted_segments().exists())
+
+
+class SeatHoldTests(BusTestCase):
+    """An expired hold gives its seats back and can no longer be paid for."""
+
+    def book(self, seats=10):
+        schedule = self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"], seats=seats)
+        trip = schedule.trips.order_by("service_date").first()
+        self.client.post(f"/start-booking/{schedule.pk}/",
+                         {"service_date": trip.service_date.isoformat(), "seat_numbers": ["2", "5"]})
+        booking = Booking.objects.get()
+        self.assertNotEqual(inventory.journey_seat_map(trip), 0)
+        SeatHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        return trip, booking
+
+    def assertReleased(self, trip, booking):
+        booking.refresh_from_db()
+        self.assertTrue(booking.cancelled)
+        self.assertFalse(booking.paid)
+        self.assertEqual(booking.payment.status, "expired")
+        self.assertEqual(set(trip.segments.values_list("seats_remaining", flat=True)), {10})
+        self.assertEqual(inventory.journey_seat_map(trip), 0)
+        self.assertFalse(SeatHold.objects.exists())
+        self.assertFalse(inventory.drifted_segments().exists())
+
+    def test_sweeper_releases_counters_and_seat_map(self):
+        trip, booking = self.book()
+        out = io.StringIO()
+        call_command("release_expired_holds", stdout=out)
+        self.assertIn("Released 1 expired hold(s)", out.getvalue())
+        self.assertReleased(trip, booking)
+
+    def test_payment_after_expiry_is_refused(self):
+        trip, booking = self.book()
+        response = self.client.post(f"/payment/{booking.payment.pk}/", {"provider_payment_id": "late"})
+        self.assertEqual(response.url, reverse("bookings"))
+        self.assertReleased(trip, booking)
+
+    def test_payment_after_the_sweep_is_refused(self):
+        trip, booking = self.book()
+        holds.release_expired()
+        self.client.post(f"/payment/{booking.payment.pk}/", {"provider_payment_id": "late"})
+        self.assertReleased(trip, booking)
+
+
+class SearchCacheTests(BusTestCase):
+    """Every write a search can see bumps a shared version token, so the next search is recomputed."""
+
+    def search(self):
+        return self.client.get("/search/api/", {"source": "Pune", "destination": "Goa"}).json()
+
+    def test_register_bus_bumps_the_catalog(self):
+        self.assertEqual(self.search()["count"], 0)
+        before = search_cache.versions()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bus("Pune", "Goa")
+        self.assertNotEqual(search_cache.versions(), before)
+        self.assertEqual(self.search()["count"], 1)
+
+    def test_bus_details_bumps_the_catalog(self):
+        bus = self.bus("Pune", "Goa").bus
+        self.assertEqual(self.search()["count"], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.details(bus, "Pune", "Goa", ac_type="AC", departure="06:00", arrival="14:00")
+        results = self.search()["results"]
+        self.assertEqual([r["departure"] for r in results], ["06:00", "08:00"])
+        self.assertEqual({r["bus"]["ac_type"] for r in results}, {"AC"})
+
+    def test_start_booking_bumps_the_schedule(self):
+        schedule = self.bus("Pune", "Goa", seats=10)
+        trip = schedule.trips.order_by("service_date").first()
+        self.assertEqual(self.search()["results"][0]["available"], 10)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/start-booking/{schedule.pk}/",
+                             {"seats": 3, "service_date": trip.service_date.isoformat()})
+        self.assertEqual(self.search()["results"][0]["available"], 7)
+
+    def test_payment_bumps_the_schedule(self):
+        schedule = self.bus("Pune", "Goa", seats=10)
+        trip = schedule.trips.order_by("service_date").first()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/start-booking/{schedule.pk}/",
+                             {"seats": 3, "service_date": trip.service_date.isoformat()})
+        self.search()
+        before = search_cache.versions(schedule_ids=[schedule.pk])
+        misses = search_cache.stats()["misses"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/payment/{Payment.objects.get().pk}/")
+        self.assertNotEqual(search_cache.versions(schedule_ids=[schedule.pk]), before)
+        self.assertEqual(self.search()["results"][0]["available"], 7)
+        self.assertEqual(search_cache.stats()["misses"], misses + 1)
+
+    def test_a_bump_by_another_worker_is_seen(self):
+        schedule = self.bus("Pune", "Goa")
+        self.search()
+        hits = search_cache.stats()["hits"]
+        self.search()
+        self.assertEqual(search_cache.stats()["hits"], hits + 1)
+        # another process only shares the directory the tokens are kept in
+        other = FileBasedCache(caches["search_versions"]._dir, {})
+        other.set(f"search:v:schedule:{schedule.pk}", "bumped elsewhere", timeout=None)
+        self.search()
+        self.assertEqual(search_cache.stats()["hits"], hits + 1)
+
+
+class SearchApiTests(BusTestCase):
+    """Keyset pages over the cached, already sorted result list."""
+
+    def setUp(self):
+        super().setUp()
+        for departure, arrival in [("09:00", "13:00"), ("06:30", "16:00"), ("09:00", "11:00"),
+                                   ("22:15", "23:45"), ("07:00", "19:30")]:
+            self.bus("Pune", "Goa", departure, arrival)
+
+    def get(self, **params):
+        return self.client.get("/search/api/", {"source": "Pune", "destination": "Goa", **params})
+
+    def pages(self, sort, limit=2):
+        results, cursor = [], None
+        while True:
+            page = self.get(sort=sort, limit=limit, **({"cursor": cursor} if cursor else {})).json()
+            self.assertEqual(page["count"], 5)
+            self.assertLessEqual(len(page["results"]), limit)
+            results += page["results"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return results
+
+    def test_every_sort_pages_through_all_results_once(self):
+        fields = {"departure": "departure", "price": "price", "duration": "duration_minutes"}
+        for sort, field in fields.items():
+            for order in (sort, f"-{sort}"):
+                with self.subTest(sort=order):
+                    results = self.pages(order)
+                    # descending orders still break ties by ascending schedule id
+                    descending = order.startswith("-")
+                    keys = [(r[field], -r["schedule_id"] if descending else r["schedule_id"]) for r in results]
+                    self.assertEqual(keys, sorted(keys, reverse=descending))
+                    self.assertEqual(len({r["schedule_id"] for r in results}), 5)
+
+    def test_departure_ties_go_by_schedule_id(self):
+        departures = [(r["departure"], r["schedule_id"]) for r in self.pages("departure", limit=1)]
+        self.assertEqual([d for d, _ in departures], ["06:30", "07:00", "09:00", "09:00", "22:15"])
+        self.assertLess(departures[2][1], departures[3][1])
+
+    def test_later_pages_are_served_from_the_sorted_entry(self):
+        first = self.get(sort="duration", limit=2).json()
+        hits = search_cache.stats()["hits"]
+        second = self.get(sort="duration", limit=2, cursor=first["next_cursor"]).json()
+        self.assertEqual(search_cache.stats()["hits"], hits + 1)
+        self.assertEqual([r["duration_minutes"] for r in first["results"] + second["results"]], [90, 120, 240, 570])
+
+    def test_malformed_cursor_is_a_400(self):
+        for cursor in ("not base64!", "bm90IGpzb24", "WzEsIDJd" + "x", "WyJhIiwgMV0", "WzEsIDIsIDNd"):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.get(cursor=cursor).status_code, 400)
+
+    def test_unknown_sort_is_a_400(self):
+        self.assertEqual(self.get(sort="seats").status_code, 400)
+
+
+class PlaceIndexTests(TestCase):
+    """Autocomplete candidates share enough trigrams; they are ranked by edit distance, then popularity."""
+
+    def setUp(self):
+        self.index = place_index.PlaceIndex()
+        places = {"Kolhapur": 3, "Kolhapur Station": 1, "Karad": 5, "Pune": 4, "Panvel": 2, "Punawale": 1}
+        for route_id, (name, routes) in enumerate(places.items()):
+            for n in range(routes):
+                self.index.add_name(name, 100 * route_id + n)
+
+    def names(self, query):
+        return [place["name"] for place in self.index.suggest(query)]
+
+    def test_typo_ranks_the_nearest_name_first(self):
+        self.assertEqual(self.names("kolhapr"), ["Kolhapur", "Kolhapur Station"])
+        self.assertEqual(self.names("kolahpur")[0], "Kolhapur")  # transposition
+        self.assertEqual(self.names("pnvel"), ["Panvel"])
+
+    def test_exact_prefix_beats_a_typo(self):
+        self.assertEqual(self.names("puna"), ["Punawale", "Pune"])
+
+    def test_popularity_breaks_ties(self):
+        self.assertEqual(self.names("kolhapur"), ["Kolhapur", "Kolhapur Station"])
+        self.index.add_name("Kolhapur Station", 900)
+        self.index.add_name("Kolhapur Station", 901)
+        self.index.add_name("Kolhapur Station", 902)
+        self.assertEqual(self.names("kolhapur"), ["Kolhapur Station", "Kolhapur"])
+
+    def test_one_shared_trigram_is_not_a_candidate(self):
+        # "karad" shares only the leading "  k" with the query
+        self.assertNotIn("karad", self.index._candidates("kolhapr", 1))
+        self.assertIn("kolhapur", self.index._candidates("kolhapr", 1))
+        self.assertEqual(self.names("kxxxx"), [])
+
+    def test_candidates_are_capped(self):
+        for n in range(place_index.MAX_CANDIDATES + 50):
+            self.index.add_name(f"Kolhapur Gate {n}", 1000 + n)
+        self.assertEqual(len(self.index._candidates("kolhapur", 1)), place_index.MAX_CANDIDATES)
+        self.assertEqual(self.names("kolhapur")[0], "Kolhapur")
+
+
+@override_settings(TRIP_HORIZON_DAYS=14)
+class TripTests(BusTestCase):
+    """Schedules expand into dated trips over the horizon; exceptions close them; reads never create them."""
+
+    def day(self, offset):
+        return timezone.localdate() + timedelta(days=offset)
+
+    def dates(self, schedule, **filters):
+        return list(schedule.trips.filter(**filters).order_by("service_date").values_list("service_date", flat=True))
+
+    def test_weekday_mask_is_expanded_over_the_horizon(self):
+        schedule = self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"], days=["Mon", "Wed"])
+        expected = [self.day(i) for i in range(14) if self.day(i).weekday() in (0, 2)]
+        self.assertEqual(self.dates(schedule), expected)
+        self.assertEqual(set(schedule.trips.annotate(n=Count("segments")).values_list("n", flat=True)), {2})
+
+    def test_dated_schedule_has_one_trip(self):
+        schedule = self.bus("Pune", "Goa", specific_date=self.day(3).isoformat())
+        self.assertEqual(self.dates(schedule), [self.day(3)])
+
+    def test_exceptions_are_skipped_when_materializing(self):
+        ServiceException.objects.create(date=self.day(2), reason="holiday")
+        schedule = self.bus("Pune", "Goa")
+        self.assertEqual(len(self.dates(schedule)), 13)
+        self.assertNotIn(self.day(2), self.dates(schedule))
+
+    def test_generate_trips_rolls_the_horizon_forward(self):
+        schedule = self.bus("Pune", "Goa")
+        out = io.StringIO()
+        call_command("generate_trips", start=self.day(10).isoformat(), days=7, stdout=out)
+        self.assertEqual(self.dates(schedule), [self.day(i) for i in range(17)])
+        call_command("generate_trips", start=self.day(10).isoformat(), days=7, stdout=out)
+        self.assertEqual(schedule.trips.count(), 17)
+
+    def test_saving_an_exception_cancels_its_trips(self):
+        schedule = self.bus("Pune", "Goa")
+        search = {"source": "Pune", "destination": "Goa", "travel_date": self.day(4).isoformat()}
+        self.assertEqual(self.client.get("/search/api/", search).json()["count"], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            exception = ServiceException.objects.create(schedule=schedule, date=self.day(4))
+        self.assertEqual(self.dates(schedule, cancelled=True), [self.day(4)])
+        self.assertEqual(self.client.get("/search/api/", search).json()["count"], 0)
+
+        # moving it reopens the old date
+        exception.date = self.day(5)
+        exception.save()
+        self.assertEqual(self.dates(schedule, cancelled=True), [self.day(5)])
+
+        # a holiday on the same date keeps the trip closed when the exception goes
+        ServiceException.objects.create(date=self.day(5), reason="holiday")
+        exception.delete()
+        self.assertEqual(self.dates(schedule, cancelled=True), [self.day(5)])
+        with self.captureOnCommitCallbacks(execute=True):
+            ServiceException.objects.get().delete()
+        self.assertEqual(self.dates(schedule, cancelled=True), [])
+        self.assertEqual(self.client.get("/search/api/", search).json()["count"], 1)
+
+    def test_reads_past_the_horizon_do_not_create_trips(self):
+        schedule = self.bus("Pune", "Goa", seats=12)
+        day = self.day(30)
+        trips_before = Trip.objects.count()
+        results = self.client.get("/search/api/", {
+            "source": "Pune", "destination": "Goa", "travel_date": day.isoformat()}).json()["results"]
+        self.assertEqual([(r["service_date"], r["available"]) for r in results], [(day.isoformat(), 12)])
+        response = self.client.get(f"/start-booking/{schedule.pk}/", {"service_date": day.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Trip.objects.count(), trips_before)
+
+        self.client.post(f"/start-booking/{schedule.pk}/", {"seats": 2, "service_date": day.isoformat()})
+        self.assertEqual(Booking.objects.get().trip.service_date, day)
+        self.assertEqual(Trip.objects.count(), trips_before + 1)
+
+    def test_exceptions_past_the_horizon_hide_the_schedule(self):
+        self.bus("Pune", "Goa")
+        day = self.day(30)
+        ServiceException.objects.create(date=day, reason="holiday")
+        search = {"source": "Pune", "destination": "Goa", "travel_date": day.isoformat()}
+        self.assertEqual(self.client.get("/search/api/", search).json()["count"], 0)
+
+    def test_search_does_not_need_materialized_trips(self):
+        schedule = self.bus("Pune", "Goa", seats=12, days=["Mon", "Thu"])
+        Trip.objects.all().delete()
+        running = [self.day(i) for i in range(14) if self.day(i).weekday() in (0, 3)]
+        undated = self.client.get("/search/api/", {"source": "Pune", "destination": "Goa"}).json()["results"]
+        self.assertEqual([(r["service_date"], r["available"]) for r in undated], [(running[0].isoformat(), 12)])
+        dated = self.client.get("/search/api/", {
+            "source": "Pune", "destination": "Goa", "travel_date": running[1].isoformat()}).json()["results"]
+        self.assertEqual([r["service_date"] for r in dated], [running[1].isoformat()])
+
+        self.assertEqual(self.client.get(f"/start-booking/{schedule.pk}/").status_code, 200)
+        self.assertFalse(Trip.objects.exists())
+        self.client.post(f"/start-booking/{schedule.pk}/", {"seats": 1})
+        self.assertEqual(self.dates(schedule), [running[0]])
+
+    def test_next_departure_skips_closed_dates_before_the_first_trip(self):
+        schedule = self.bus("Pune", "Goa")
+        Trip.objects.exclude(service_date=self.day(5)).delete()
+        ServiceException.objects.create(schedule=schedule, date=self.day(0))
+        with self.captureOnCommitCallbacks(execute=True):
+            ServiceException.objects.create(date=self.day(1), reason="holiday")
+        results = self.client.get("/search/api/", {"source": "Pune", "destination": "Goa"}).json()["results"]
+        self.assertEqual([r["service_date"] for r in results], [self.day(2).isoformat()])
+
+        # an exception on a date with no trip yet still invalidates cached searches
+        with self.captureOnCommitCallbacks(execute=True):
+            ServiceException.objects.create(schedule=schedule, date=self.day(2))
+        results = self.client.get("/search/api/", {"source": "Pune", "destination": "Goa"}).json()["results"]
+        self.assertEqual([r["service_date"] for r in results], [self.day(3).isoformat()])
+
+    def test_migration_materializes_the_horizon(self):
+        migration = importlib.import_module("main.migrations.0021_materialize_trip_horizon")
+        schedule = self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"], days=["Tue", "Sat"])
+        expected = self.dates(schedule)
+        Trip.objects.exclude(service_date=expected[0]).delete()
+        migration.materialize_horizon(django_apps, None)
+        self.assertEqual(self.dates(schedule), expected)
+        self.assertEqual(set(schedule.trips.annotate(n=Count("segments")).values_list("n", flat=True)), {2})
+
+
+class UserDashboardTests(BusTestCase):
+    """Bookings are paged newest first by a (created_at, id) cursor; a bad cursor restarts paging."""
+
+    def test_pages_cover_every_booking_once(self):
+        schedule = self.bus("Pune", "Goa")
+        now = timezone.now()
+        for n in range(views.USER_BOOKINGS_PER_PAGE * 2 + 3):
+            booking = Booking.objects.create(user=self.user, schedule=schedule, seats=1)
+            # pairs of bookings share a timestamp, so ties are broken by id
+            Booking.objects.filter(pk=booking.pk).update(created_at=now - timedelta(minutes=n // 2))
+        expected = list(Booking.objects.order_by("-created_at", "-pk").values_list("pk", flat=True))
+
+        seen, params = [], {}
+        while True:
+            response = self.client.get("/dashboard/", params)
+            seen += [booking.pk for booking in response.context["bookings"]]
+            if response.context["next_cursor"] is None:
+                break
+            params = {"before": response.context["next_cursor"]}
+        self.assertEqual(seen, expected)
+
+    def test_bad_cursor_returns_to_the_first_page(self):
+        for before in (
+            "garbage",
+            views._encode_cursor(("2024-02-30T10:00:00+00:00", 5)),  # impossible date
+            views._encode_cursor(("not a date", 5)),
+            views._encode_cursor((5, "2024-02-01T10:00:00+00:00")),
+        ):
+            with self.subTest(before=before):
+                response = self.client.get("/dashboard/", {"before": before})
+                self.assertRedirects(response, "/dashboard/", fetch_redirect_response=False)
+
+
+class FareMatrixTests(SimpleTestCase):
+    """The packed upper triangle holds journey_fare for every (board, alight) pair."""
+
+    def test_lookup_matches_journey_fare_for_every_pair(self):
+        for count in range(2, 13):
+            for ac_type, is_sleeper in [("Non-AC", False), ("AC", False), ("Non-AC", True), ("AC", True)]:
+                surcharges = fares.class_surcharges(ac_type, is_sleeper)
+                matrix = fares.build(count, ac_type, is_sleeper)
+                self.assertEqual(fares.stop_count(matrix), count)
+                for board in range(count):
+                    for alight in range(board + 1, count):
+                        with self.subTest(count=count, ac_type=ac_type, is_sleeper=is_sleeper, pair=(board, alight)):
+                            self.assertEqual(fares.lookup(matrix, count, board, alight),
+                                             fares.journey_fare(alight - board + 1, surcharges))
+
+    def test_offsets_enumerate_the_triangle_row_by_row(self):
+        for count in range(2, 13):
+            offsets = [fares._offset(count, board, alight)
+                       for board in range(count) for alight in range(board + 1, count)]
+            self.assertEqual(offsets, list(range(count * (count - 1) // 2)))
+
+
+class BusFareTests(BusTestCase):
+    """Changing a bus's class reprices every route it runs."""
+
+    def test_class_change_reprices_routes(self):
+        first = self.bus("Pune", "Goa", stops=["Satara"], stop_times=["10:00"])
+        bus = first.bus
+        second = self.details(bus, "Mumbai", "Nashik")
+        routes = [first.route, second.route]
+        self.assertEqual([route.fare() for route in routes], [fares.journey_fare(3), fares.journey_fare(2)])
+
+        bus.ac_type = "AC"
+        bus.save()
+        for route in routes:
+            route.refresh_from_db()
+        self.assertEqual([route.fare() for route in routes],
+                         [fares.journey_fare(3, [fares.AC_PERCENT]), fares.journey_fare(2, [fares.AC_PERCENT])])
+
+        bus.is_sleeper = True
+        bus.save()
+        first.route.refresh_from_db()
+        surcharges = fares.class_surcharges("AC", True)
+        self.assertEqual(first.route.fare(0, 1), fares.journey_fare(2, surcharges))
+        self.assertEqual(first.route.fare(), fares.journey_fare(3, surcharges))
+
+
+class SqliteTransactionTests(TransactionTestCase):
+    """
+    IMMEDIATE is the default for every atomic block, and only writes open
+    one: reads run in autocommit and never take the write lock.
+    """
+
+    def setUp(self):
+        cache.clear()
+        caches["search_versions"].clear()
+        route_index.index.clear()
+        place_index.index.clear()
+        user = get_user_model().objects.create_user("conductor@example.com", "conductor@example.com", "pw")
+        Conductor.objects.create(user=user)
+        self.client.force_login(user)
+        self.client.post("/register_bus/", {
+            "bus_name": "Pune-Goa", "bus_number": "MH-1", "total_seats": 10, "from_city": "Pune",
+            "to_city": "Goa", "departure_time": "08:00", "arrival_time": "18:00", "days": EVERY_DAY,
+        })
+        self.schedule = Schedule.objects.get()
+
+    def begins(self, method, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            getattr(self.client, method)(path, data or {})
+        return [q["sql"] for q in queries if q["sql"].startswith("BEGIN")]
+
+    def test_options_default_to_immediate(self):
+        self.assertEqual(sqlite.options({})["transaction_mode"], "IMMEDIATE")
+        self.assertEqual(sqlite.options({"SQLITE_TRANSACTION_MODE": "DEFERRED"})["transaction_mode"], "DEFERRED")
+        self.assertIsNone(sqlite.options({"SQLITE_TRANSACTION_MODE": ""})["transaction_mode"])
+
+    def test_asgi_does_not_keep_connections(self):
+        env = {k: v for k, v in os.environ.items() if k not in ("SQLITE_CONN_MAX_AGE", "DJANGO_SETTINGS_MODULE")}
+        script = "import busbuddy.{}; from django.conf import settings; print(settings.DATABASES['default']['CONN_MAX_AGE'])"
+        ages = [
+            subprocess.run([sys.executable, "-c", script.format(entry)], env=env, cwd=settings.BASE_DIR,
+                           capture_output=True, text=True, check=True).stdout.split()[-1]
+            for entry in ("asgi", "wsgi")
+        ]
+        self.assertEqual(ages, ["0", "60"])
+
+    def test_booking_and_payment_begin_immediate(self):
+        self.assertIn("BEGIN IMMEDIATE", self.begins("post", f"/start-booking/{self.schedule.pk}/", {"seats": 2}))
+        self.assertIn("BEGIN IMMEDIATE", self.begins("post", f"/payment/{Payment.objects.get().pk}/"))
+        self.assertTrue(Booking.objects.get().paid)
+
+    def test_reads_open_no_transaction(self):
+        for path, params in [
+            ("/search/api/", {"source": "Pune", "destination": "Goa"}),
+            ("/search/results/", {"source": "Pune", "destination": "Goa"}),
+            (f"/start-booking/{self.schedule.pk}/", {}),
+            ("/dashboard/", {}),
+        ]:
+            with self.subTest(path=path):
+                self.assertEqual(self.begins("get", path, params), [])
+
+
+class SeatNumberTests(BusTestCase):
+    """Chosen seat numbers are counted once, so counters, seat maps and the charge agree."""
+
+    def test_duplicate_seat_numbers_take_one_seat(self):
+        schedule = self.bus("Pune", "Goa", seats=10)
+        trip = schedule.trips.order_by("service_date").first()
+        url = f"/start-booking/{schedule.pk}/"
+        self.client.post(url, {"service_date": trip.service_date.isoformat(), "seat_numbers": ["3", "3"]})
+        booking = Booking.objects.get()
+        self.assertEqual((booking.seats, booking.seat_numbers), (1, "3"))
+        self.assertEqual(booking.payment.amount, schedule.route.fare(0, 1))
+        self.assertEqual(set(trip.segments.values_list("seats_remaining", flat=True)), {9})
+        self.assertFalse(inventory.drifted_segments().exists())
+        self.assertEqual(inventory.rebuild_seat_maps(Trip.objects.filter(pk=trip.pk)), 0)
+
+    def test_reserve_seats_counts_distinct_numbers(self):
+        trip = self.bus("Pune", "Goa", seats=10).trips.order_by("service_date").first()
+        self.assertEqual(inventory.reserve_seats(trip.pk, 5, seat_numbers=[4, 4, 2]), [2, 4])
+        self.assertEqual(set(trip.segments.values_list("seats_remaining", flat=True)), {8})
+
+    def test_out_of_range_seat_is_refused(self):
+        schedule = self.bus("Pune", "Goa", seats=10)
+        trip = schedule.trips.order_by("service_date").first()
+        self.client.post(f"/start-booking/{schedule.pk}/",
+                         {"service_date": trip.service_date.isoformat(), "seat_numbers": ["11"]})
+        self.assertFalse(Booking.objects.exists())
+        self.assertEqual(set(trip.segments.values_list("seats_remaining", flat=True)), {10})
+
+
+class JourneyPlannerTests(BusTestCase):
+    """The connection scan returns every journey on the (arrival, transfers) Pareto set."""
+
+    def test_later_direct_bus_is_kept_beside_a_faster_transfer(self):
+        self.bus("Pune", "Satara", "08:00", "09:00")
+        self.bus("Satara", "Kolhapur", "09:20", "10:00")
+        direct = self.bus("Pune", "Kolhapur", "10:30", "12:00")
+        itineraries = journeys.timetable.plan("Pune", "Kolhapur", timezone.localdate(), 0, 3)
+        self.assertEqual([(i["transfers"], i["arrival"][-5:]) for i in itineraries], [(1, "10:00"), (0, "12:00")])
+        self.assertEqual(itineraries[1]["legs"][0]["schedule_id"], direct.pk)
+
+    def test_slower_journey_with_more_transfers_is_dropped(self):
+        self.bus("Pune", "Satara", "07:00", "08:00")
+        self.bus("Satara", "Kolhapur", "08:30", "13:00")
+        self.bus("Pune", "Kolhapur", "09:00", "12:00")
+        itineraries = journeys.timetable.plan("Pune", "Kolhapur", timezone.localdate(), 0, 3)
+        self.assertEqual([i["transfers"] for i in itineraries], [0])
+
+
+class QueryPlanTests(TestCase):
+    """
+    Runs the hot views and EXPLAINs every query they issue, failing on a full
+    table scan. Guards the indexes in migration 0020 against model changes.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("plan@example.com", "plan@example.com", "pw")
+        Conductor.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        route_index.index.clear()
+        place_index.index.clear()
+        self.client.force_login(self.user)
+        for i in range(3):
+            self.client.post("/register_bus/", {
+                "bus_name": f"Bus {i}", "bus_number": f"MH-{i}", "total_seats": 10,
+                "from_city": "Pune", "to_city": "Goa", "departure_time": "08:00", "arrival_time": "18:00",
+                "days": EVERY_DAY, "stops[]": ["Satara", "Kolhapur"], "stop_times[]": ["10:00", "12:00"],
+            })
+        self.schedule = Schedule.objects.order_by("pk").first()
+        self.service_date = self.schedule.trips.order_by("service_date").first().service_date.isoformat()
+        self.client.post(f"/start-booking/{self.schedule.pk}/", {"seats": 2, "service_date": self.service_date})
+        self.booking = Booking.objects.get()
+
+    def plans(self, queries):
+        """(sql, [plan lines]) for every captured statement that reads a table."""
+        plans = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                sql = query["sql"]
+                if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                    continue
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                plans.append((sql, [row[-1] for row in cursor.fetchall()]))
+        return plans
+
+    def full_scans(self, queries):
+        return [
+            f"{line}\n    in: {sql}"
+            for sql, lines in self.plans(queries)
+            for line in lines
+            if FULL_SCAN.search(line)
+        ]
+
+    def assertNoFullScans(self, method, url, data=None):
+        # the first call warms the in-memory indexes, which load whole tables by design
+        getattr(self.client, method)(url, data or {})
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+        scans = self.full_scans(captured.captured_queries)
+        self.assertEqual(scans, [], f"{method.upper()} {url} scans whole tables:\n" + "\n".join(scans))
+        return response
+
+    def test_search(self):
+        self.assertNoFullScans("get", "/search/results/", {"source": "pune", "destination": "goa"})
+        self.assertNoFullScans("get", "/search/results/", {"source": "satara", "destination": "goa", "Day": "Monday"})
+        cache.clear()
+        self.assertNoFullScans("get", "/search/results/", {"source": "pune", "destination": "goa",
+                                                           "travel_date": self.service_date})
+
+    def test_search_api(self):
+        cache.clear()
+        self.assertNoFullScans("get", "/search/api/", {"source": "pune", "destination": "kolhapur", "sort": "price"})
+
+    def test_journeys(self):
+        self.assertNoFullScans("get", "/search/journeys/", {"source": "pune", "destination": "goa",
+                                                             "travel_date": self.service_date})
+
+    def test_booking(self):
+        url = f"/start-booking/{self.schedule.pk}/"
+        self.assertNoFullScans("get", url, {"service_date": self.service_date})
+        self.assertNoFullScans("post", url, {"seats": 1, "service_date": self.service_date})
+        self.assertNoFullScans("get", f"/payment/{self.booking.payment.pk}/")
+
+    def test_payment(self):
+        payment = Payment.objects.get(booking=self.booking)
+        with CaptureQueriesContext(connection) as captured:
+            self.client.post(f"/payment/{payment.pk}/")
+        self.assertEqual(self.full_scans(captured.captured_queries), [])
+
+    def test_cancel(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.client.post(f"/booking/{self.booking.pk}/cancel/")
+        self.assertEqual(self.full_scans(captured.captured_queries), [])
+
+    def test_search_beyond_trip_horizon(self):
+        far = timezone.localdate() + timedelta(days=trips.horizon_days() + 30)
+        self.assertNoFullScans("get", "/search/results/", {"source": "pune", "destination": "goa",
+                                                           "travel_date": far.isoformat()})
+
+    def test_trip_materialization(self):
+        with CaptureQueriesContext(connection) as captured:
+            trips.materialize_trips()
+        self.assertEqual(self.full_scans(captured.captured_queries), [])
+
+    def test_hold_sweeper(self):
+        with CaptureQueriesContext(connection) as captured:
+            holds.release_expired(now=timezone.now() + timedelta(days=1))
+        self.assertEqual(self.full_scans(captured.captured_queries), [])
+
+    def test_user_dashboard(self):
+        self.assertNoFullScans("get", "/dashboard/")
+        # keyset pages walk the (user, created_at) index instead of sorting the history
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get("/dashboard/")
+        history = [lines for sql, lines in self.plans(captured.captured_queries)
+                   if 'FROM "main_booking"' in sql and "ORDER BY" in sql and "GROUP BY" not in sql]
+        self.assertTrue(history)
+        self.assertNotIn(SORTS, history[0])
+
+    def test_conductor_pages(self):
+        self.assertNoFullScans("get", "/conductor/dashboard/")
+        self.assertNoFullScans("get", f"/conductor/bus/{self.schedule.bus_id}/schedules/")
+        self.assertNoFullScans("get", f"/conductor/schedule/{self.schedule.pk}/bookings/")
+
+
+class QueryBudgetTests(TestCase):
+    """Every routed view stays within its @query_budget against a seeded dataset, with no N+1 loops."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("budget@example.com", "budget@example.com", "pw")
+        cls.user.is_staff = True
+        cls.user.save()
+        Conductor.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        route_index.index.clear()
+        place_index.index.clear()
+        self.client.force_login(self.user)
+        for i in range(6):
+            self.client.post("/register_bus/", {
+                "bus_name": f"Bus {i}", "bus_number": f"MH-{i}", "total_seats": 40,
+                "from_city": "Pune", "to_city": "Goa", "departure_time": f"0{i}:00", "arrival_time": "18:00",
+                "days": EVERY_DAY, "stops[]": ["Satara", "Kolhapur"], "stop_times[]": ["10:00", "12:00"],
+            })
+        self.schedule = Schedule.objects.order_by("pk").first()
+        self.service_date = self.schedule.trips.order_by("service_date").first().service_date.isoformat()
+        for _ in range(8):
+            self.client.post(f"/start-booking/{self.schedule.pk}/", {"seats": 1, "service_date": self.service_date})
+        self.booking = Booking.objects.order_by("pk").first()
+        self.client.post(f"/payment/{self.booking.payment.pk}/")
+
+    def assertWithinBudget(self, method, url, data=None):
+        view = resolve(url.split("?")[0]).func
+        budget = getattr(view, "query_budget", None)
+        self.assertIsNotNone(budget, f"{url} has no @query_budget")
+        with QueryCounter() as counter:
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+        self.assertLessEqual(counter.count, budget, f"{method.upper()} {url}")
+        self.assertEqual(counter.repeated(), [], f"{method.upper()} {url} repeats queries")
+        return counter
+
+    def requests(self):
+        """(url name, method, url kwargs, data) covering every view in main/urls.py."""
+        schedule, booking = self.schedule.pk, self.booking
+        later = Booking.objects.filter(paid=False).order_by("pk").last()
+        search = {"source": "pune", "destination": "goa"}
+        return [
+            ("index", "get", {}, None),
+            ("search", "get", {}, None),
+            ("search_results", "get", {}, search),
+            ("search_results", "get", {}, {**search, "travel_date": self.service_date}),
+            ("search_api", "get", {}, {"source": "satara", "destination": "goa", "sort": "price", "limit": 2}),
+            ("autocomplete", "get", {}, {"q": "kolhapr"}),
+            ("journey_api", "get", {}, {**search, "travel_date": self.service_date}),
+            ("parse_query", "get", {}, {"q": "AC sleeper from Pune to Goa tomorrow"}),
+            ("login", "get", {}, None),
+            ("login", "post", {}, {"email": "budget@example.com", "password": "pw"}),
+            ("register", "get", {}, None),
+            ("register", "post", {}, {"fullname": "New Rider", "email": "rider@example.com", "phone": "98000",
+                                      "password1": "a-long-passphrase", "password2": "a-long-passphrase"}),
+            ("conductor_register", "get", {}, None),
+            ("conductor_dashboard", "get", {}, None),
+            ("conductor_bus_schedules", "get", {"pk": self.schedule.bus_id}, None),
+            ("schedule_bookings", "get", {"pk": schedule}, None),
+            ("register_bus", "get", {}, None),
+            ("register_bus", "post", {}, {
+                "bus_name": "New", "bus_number": "MH-NEW", "total_seats": 30, "from_city": "Pune",
+                "to_city": "Nagpur", "departure_time": "07:00", "arrival_time": "19:00", "days": EVERY_DAY,
+                "stops[]": ["Shirur", "Ahmednagar", "Aurangabad", "Jalna", "Amravati"],
+                "stop_times[]": ["08:00", "09:00", "11:00", "13:00", "16:00"],
+            }),
+            ("bus_details", "get", {"pk": self.schedule.bus_id}, None),
+            ("bus_details", "post", {"pk": self.schedule.bus_id}, {
+                "seats": 44, "origin": "Pune", "destination": "Goa", "stops": "Lonand, Satara, Karad, Kolhapur, Belgaum",
+                "departure_time": "06:00", "arrival_time": "18:00", "days": EVERY_DAY, "ac_type": "AC",
+                "bus_type": "Sleeper", "stop_times[]": ["07:00", "08:00", "09:00", "11:00", "13:00"],
+            }),
+            ("start_booking", "get", {"schedule_id": schedule}, {"service_date": self.service_date}),
+            ("start_booking", "post", {"schedule_id": schedule}, {"seats": 2, "service_date": self.service_date}),
+            ("payment_page", "get", {"payment_id": later.payment.pk}, None),
+            ("payment_page", "post", {"payment_id": later.payment.pk}, None),
+            ("user_dashboard", "get", {}, None),
+            ("cancel_booking", "post", {"booking_id": booking.pk}, None),
+            ("bookings", "get", {}, None),
+            ("hold_stats", "get", {}, None),
+            ("search_cache_stats", "get", {}, None),
+            ("metrics", "get", {}, None),
+            ("assistant", "get", {}, None),
+            ("assistant_stream", "get", {}, {"q": "hi"}),
+            ("sectors", "get", {}, None),
+            ("connected", "get", {}, None),
+            ("who_we_are", "get", {}, None),
+            ("logout", "get", {}, None),
+        ]
+
+    def test_every_view_has_a_budget(self):
+        covered = {name for name, _, _, _ in self.requests()}
+        named = {pattern.name for pattern in urls.urlpatterns if getattr(pattern, "name", None)}
+        self.assertEqual(named - covered, set())
+        for pattern in urls.urlpatterns:
+            if getattr(pattern, "name", None):
+                self.assertTrue(hasattr(pattern.callback, "query_budget"), pattern.name)
+
+    def test_views_within_budget(self):
+        for name, method, kwargs, data in self.requests():
+            with self.subTest(view=name, method=method):
+                self.assertWithinBudget(method, reverse(name, kwargs=kwargs), data)
+
+    @override_settings(QUERY_INSTRUMENTATION=True, QUERY_BUDGET_RAISE=True)
+    def test_middleware_flags_overruns_and_n_plus_one(self):
+        @query_budget(1)
+        def per_schedule(request):
+            return [schedule.route.origin for schedule in Schedule.objects.all()]
+
+        def handler(request):
+            middleware.process_view(request, per_schedule, (), {})
+            return per_schedule(request)
+
+        middleware = QueryBudgetMiddleware(handler)
+        with self.assertRaisesRegex(QueryBudgetExceeded, r"budget 1; N\+1: 6x SELECT .* FROM \"main_route\""):
+            middleware(RequestFactory().get("/"))
+
+
+class BenchmarkCommandTests(TestCase):
+    """generate_dataset loads consistent inventory and benchmark_requests measures it without writing."""
+
+    def setUp(self):
+        cache.clear()
+        route_index.index.clear()
+        place_index.index.clear()
+
+    def generate(self, seed=7):
+        call_command("generate_dataset", seed=seed, users=30, buses=4, buses_per_conductor=2, routes=8,
+                     schedules=12, bookings=400, history_days=3, days=7, stdout=io.StringIO())
+
+    def bookings(self):
+        return list(Booking.objects.order_by("pk").values_list(
+            "schedule__route__origin", "trip__service_date", "seats", "seat_numbers", "board_order", "paid"))
+
+    def test_dataset_is_reproducible_and_consistent(self):
+        self.generate()
+        self.assertEqual(Booking.objects.count(), 400)
+        self.assertFalse(inventory.drifted_segments().exists())
+        self.assertEqual(inventory.rebuild_seat_maps(), 0)
+        first = self.bookings()
+
+        Bus.objects.all().delete()
+        get_user_model().objects.filter(username__startswith="gen7-").delete()
+        self.generate()
+        self.assertEqual(self.bookings(), first)
+
+    def test_benchmark_writes_results_and_rolls_back(self):
+        self.generate()
+        bookings = Booking.objects.count()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "results.json")
+            call_command("benchmark_requests", iterations=3, warmup=1, output=output, stdout=io.StringIO())
+            with open(output) as fh:
+                results = json.load(fh)["results"]
+        self.assertEqual(set(results), {"search", "booking", "payment", "user_dashboard", "conductor_dashboard"})
+        for result in results.values():
+            self.assertEqual(result["errors"], 0)
+            self.assertLessEqual(result["p50_ms"], result["p95_ms"])
+        self.assertEqual(Booking.objects.count(), bookings)
+
+
+def _child_worker(done=None):
+    metrics.observe("child_view", "GET", 200, 0.02, metrics.RequestTimings())
+    metrics.flush(force=True)
+    if done is not None:
+        done.wait(10)
+
+
+class RequestMetricsTests(TestCase):
+    """Server-Timing headers and the Prometheus export, merged across worker processes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("ops@example.com", "ops@example.com", "pw", is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(METRICS_DIR=self.tmp.name, REQUEST_METRICS=True)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_server_timing_header(self):
+        search = {"source": "pune", "destination": "goa"}
+        first = self.client.get("/search/results/", search)["Server-Timing"]
+        self.assertRegex(first, r'db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+, cache;desc="0 hit, 1 miss", total;dur=')
+        self.assertIn('cache;desc="1 hit, 0 miss"', self.client.get("/search/results/", search)["Server-Timing"])
+
+    def test_prometheus_export_sums_every_worker(self):
+        self.client.get("/search/results/", {"source": "pune", "destination": "goa"})
+        context = multiprocessing.get_context("fork")
+        done = context.Event()
+        process = context.Process(target=_child_worker, args=(done,))
+        process.start()
+        self.addCleanup(process.join)
+        self.addCleanup(done.set)
+        deadline = time.monotonic() + 10
+        child_file = os.path.join(self.tmp.name, f"{metrics._host}-{process.pid}.json")
+        while not os.path.exists(child_file) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.client.force_login(self.user)
+        response = self.client.get("/ops/metrics/")
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn("busbuddy_metrics_workers 2", text)
+        self.assertIn('busbuddy_request_duration_seconds_count{view="search_results",method="GET"} 1', text)
+        self.assertIn('busbuddy_request_duration_seconds_bucket{view="child_view",method="GET",le="0.025"} 1', text)
+        self.assertIn('busbuddy_request_duration_seconds_bucket{view="child_view",method="GET",le="0.01"} 0', text)
+        self.assertIn('busbuddy_cache_requests_total{view="search_results",cache="search",result="miss"} 1', text)
+
+    def test_workers_that_are_gone_drop_out_of_the_totals(self):
+        process = multiprocessing.get_context("fork").Process(target=_child_worker)
+        process.start()
+        process.join()
+        stale = os.path.join(self.tmp.name, "elsewhere-1.json")
+        with open(stale, "w") as fh:
+            json.dump([["busbuddy_requests_total", [["view", "child_view"]], 1]], fh)
+        os.utime(stale, (time.time() - 2 * 24 * 3600,) * 2)
+
+        totals, workers = metrics.collect()
+        self.assertEqual(workers, 1)
+        self.assertFalse(any(("view", "child_view") in labels for _, labels in totals))
+        self.assertEqual(os.listdir(self.tmp.name), [f"{metrics._host}-{os.getpid()}.json"])
+
+    def test_metrics_endpoint_is_staff_only(self):
+        self.assertEqual(self.client.get("/ops/metrics/").status_code, 302)
+
+
+class AnthropicClientTests(SimpleTestCase):
+    """The pooled client against the local stub: reuse, retries, the breaker and bounded fan-out."""
+
+    def client_for(self, stub, **kwargs):
+        kwargs.setdefault("sleep", lambda seconds: None)
+        client = AnthropicClient("test-key", api_url=stub.url, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_reuses_one_connection(self):
+        with StubAnthropic() as stub:
+            client = self.client_for(stub)
+            answers = [client.generate(f"prompt {i}") for i in range(5)]
+        self.assertEqual(answers, [f"echo: prompt {i}" for i in range(5)])
+        self.assertEqual(len(stub.connections), 1)
+        self.assertEqual(stub.requests[0]["headers"]["x-api-key"], "test-key")
+
+    def test_retries_429_and_5xx_with_backoff(self):
+        delays = []
+        script = [(429, {}, {"Retry-After": "2"}), (503, {}), (200, {"completion": "done"})]
+        with StubAnthropic(script) as stub:
+            client = self.client_for(stub, sleep=delays.append, backoff_base=0.5)
+            self.assertEqual(client.generate("hi"), "done")
+        self.assertEqual(len(stub.requests), 3)
+        self.assertEqual(delays[0], 2.0)  # Retry-After wins
+        self.assertTrue(0 <= delays[1] <= 1.0)  # jittered base * 2
+
+    def test_client_errors_are_not_retried(self):
+        with StubAnthropic([(400, {"error": "bad prompt"})]) as stub:
+            client = self.client_for(stub)
+            self.assertIn("HTTP 400", client.generate("hi"))
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual(client.breaker.state, "closed")
+
+    def test_circuit_breaker_fails_fast_then_recovers(self):
+        now = [0.0]
+        breaker = CircuitBreaker(threshold=2, reset_seconds=30, clock=lambda: now[0])
+        with StubAnthropic([(503, {})] * 3) as stub:
+            client = self.client_for(stub, max_retries=0, breaker=breaker)
+            client.generate("a")
+            client.generate("b")
+            with self.assertRaises(CircuitOpen):
+                client.complete("c")
+            self.assertEqual(len(stub.requests), 2)
+
+            now[0] = 31.0  # half-open: one trial, which fails and reopens
+            self.assertIn("HTTP 503", client.generate("d"))
+            self.assertEqual(breaker.state, "open")
+            now[0] = 62.0
+            self.assertEqual(client.generate("e"), "echo: e")
+            self.assertEqual(breaker.state, "closed")
+        self.assertEqual(len(stub.requests), 4)
+
+    def test_generate_many_runs_concurrently_in_order(self):
+        with StubAnthropic(delay=0.2) as stub:
+            client = self.client_for(stub, max_concurrency=3)
+            started = time.perf_counter()
+            answers = client.generate_many([f"p{i}" for i in range(6)])
+            elapsed = time.perf_counter() - started
+        self.assertEqual(answers, [f"echo: p{i}" for i in range(6)])
+        self.assertEqual(stub.max_in_flight, 3)
+        self.assertLess(elapsed, 1.0)  # two waves of 0.2 s, not six
+
+    def test_async_fan_out_is_bounded(self):
+        with StubAnthropic(delay=0.1) as stub:
+            client = self.client_for(stub, max_concurrency=2)
+            answers = asyncio.run(client.agenerate_many([f"p{i}" for i in range(5)]))
+        self.assertEqual(answers, [f"echo: p{i}" for i in range(5)])
+        self.assertEqual(stub.max_in_flight, 2)
+
+    def test_placeholder_without_api_key(self):
+        self.assertIn("not configured", AnthropicClient("").generate("hi"))
+
+
+class LLMCacheTests(SimpleTestCase):
+    """Completion caching: both tiers, TTL and size eviction, and coalescing of identical calls."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "llm.sqlite3")
+
+    def response_cache(self, **kwargs):
+        return llm_cache.ResponseCache(llm_cache.LRU(16), llm_cache.DiskCache(self.path, **kwargs))
+
+    def client_for(self, stub, cache):
+        client = AnthropicClient("test-key", api_url=stub.url, cache=cache, max_retries=0)
+        self.addCleanup(client.close)
+        return client
+
+    def test_memory_then_disk_hits(self):
+        with StubAnthropic() as stub:
+            cache = self.response_cache()
+            client = self.client_for(stub, cache)
+            self.assertEqual(client.generate("route?"), "echo: route?")
+            self.assertEqual(client.generate("route?"), "echo: route?")
+            # another worker: empty LRU, same file
+            other = self.client_for(stub, self.response_cache())
+            self.assertEqual(other.generate("route?"), "echo: route?")
+            self.assertEqual(other.generate("route?", max_tokens=50), "echo: route?")
+        self.assertEqual(len(stub.requests), 2)  # the max_tokens=50 call is a different key
+        self.assertEqual(cache.stats()["memory_hit"], 1)
+        self.assertEqual(other.cache.stats()["disk_hit"], 1)
+
+    def test_sampled_calls_and_errors_are_not_cached(self):
+        with StubAnthropic([(400, {"error": "bad"})]) as stub:
+            client = self.client_for(stub, self.response_cache())
+            self.assertIn("HTTP 400", client.generate("a"))
+            self.assertEqual(client.generate("a"), "echo: a")
+            client.generate("b", temperature=0.7)
+            client.generate("b", temperature=0.7)
+        self.assertEqual(len(stub.requests), 4)
+
+    def test_concurrent_identical_prompts_share_one_call(self):
+        with StubAnthropic(delay=0.3) as stub:
+            client = self.client_for(stub, self.response_cache())
+            answers = client.generate_many(["same"] * 5)
+        self.assertEqual(answers, ["echo: same"] * 5)
+        self.assertEqual(len(stub.requests), 1)
+        stats = client.cache.stats()
+        self.assertEqual((stats["miss"], stats["coalesced"]), (1, 4))
+        self.assertEqual(stats["hit_rate"], 0.8)
+
+    def test_failing_disk_write_still_answers_every_caller(self):
+        class LockedDisk(llm_cache.DiskCache):
+            def set(self, key, value):
+                raise sqlite3.OperationalError("database is locked")
+
+        cache = llm_cache.ResponseCache(llm_cache.LRU(16), LockedDisk(self.path))
+        answers = []
+        with StubAnthropic(delay=0.3) as stub:
+            client = self.client_for(stub, cache)
+            with self.assertLogs("busbuddy.llm_cache", "WARNING"):
+                # daemon, so a follower left waiting fails the test instead of hanging it
+                worker = threading.Thread(
+                    target=lambda: answers.extend(client.generate_many(["same"] * 5)), daemon=True
+                )
+                worker.start()
+                worker.join(10)
+            self.assertFalse(worker.is_alive())
+            self.assertEqual(answers, ["echo: same"] * 5)
+            self.assertEqual(client.generate("same"), "echo: same")
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual(cache.stats()["memory_hit"], 1)
+
+    def test_disk_ttl_and_size_eviction(self):
+        now = [1000.0]
+        disk = llm_cache.DiskCache(self.path, ttl=60, max_bytes=1000, clock=lambda: now[0])
+        for i in range(20):
+            now[0] += 1
+            disk.set(f"k{i}", "x" * 100)
+        now[0] += 1
+        disk.get("k0")  # recently read, so it survives eviction
+        disk.evict()
+        self.assertLessEqual(disk.size(), 1000)
+        self.assertIsNotNone(disk.get("k0"))
+        self.assertIsNone(disk.get("k1"))
+        self.assertIsNotNone(disk.get("k19"))
+        now[0] += 61
+        self.assertIsNone(disk.get("k19"))
+
+    def test_lru_evicts_least_recently_used(self):
+        lru = llm_cache.LRU(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+
+
+class AssistantStreamTests(TestCase):
+    """Streaming completions: pieces in order, cancellation upstream, and the SSE view."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("ask@example.com", "ask@example.com", "pw")
+
+    def client_for(self, stub, cache=None):
+        client = AnthropicClient("test-key", api_url=stub.url, cache=cache, max_retries=0)
+        self.addCleanup(client.close)
+        return client
+
+    def test_stream_yields_pieces_then_caches(self):
+        cache = llm_cache.ResponseCache(llm_cache.LRU(16))
+        with StubAnthropic() as stub:
+            client = self.client_for(stub, cache)
+            pieces = list(client.stream("three word question"))
+            again = list(client.stream("three word question"))
+        self.assertEqual(pieces, ["echo:", " three", " word", " question"])
+        self.assertEqual(again, ["echo: three word question"])
+        self.assertEqual(len(stub.requests), 1)
+        self.assertTrue(stub.requests[0]["json"]["stream"])
+
+    def test_stream_without_a_stop_reason_is_not_cached(self):
+        cache = llm_cache.ResponseCache(llm_cache.LRU(16))
+        with StubAnthropic(truncate=True) as stub:
+            client = self.client_for(stub, cache)
+            pieces = list(client.stream("cut short"))
+            again = list(client.stream("cut short"))
+        self.assertEqual(pieces, ["echo:", " cut", " short"])
+        self.assertEqual(again, pieces)
+        self.assertEqual(len(stub.requests), 2)
+
+    def test_first_piece_is_not_held_back_by_buffering(self):
+        with StubAnthropic(chunk_delay=0.3) as stub:
+            client = self.client_for(stub)
+            stream = client.stream(" ".join(["word"] * 10))
+            started = time.monotonic()
+            self.assertEqual(next(stream), "echo:")
+            elapsed = time.monotonic() - started
+            stream.close()
+        self.assertLess(elapsed, 0.3)
+
+    def test_closing_astream_aborts_upstream(self):
+        async def first_two(client):
+            stream = client.astream(" ".join(["word"] * 200))
+            pieces = [await anext(stream), await anext(stream)]
+            await stream.aclose()
+            return pieces
+
+        with StubAnthropic(chunk_delay=0.02) as stub:
+            client = self.client_for(stub)
+            self.assertEqual(asyncio.run(first_two(client)), ["echo:", " word"])
+            self.assertTrue(stub.finished.wait(5))
+        self.assertEqual(stub.aborted, 1)
+
+    async def test_view_streams_server_sent_events(self):
+        with StubAnthropic() as stub:
+            with override_settings(ANTHROPIC_API_KEY="test-key", ANTHROPIC_API_URL=stub.url, LLM_CACHE=False):
+                anthropic_client.reset_client()
+                self.addCleanup(anthropic_client.reset_client)
+                await self.async_client.aforce_login(self.user)
+                response = await self.async_client.get(reverse("assistant_stream"), {"q": "night bus to Goa?"})
+                chunks = [chunk.decode() async for chunk in response.streaming_content]
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(chunks[0], ": stream open\n\n")
+        tokens = [json.loads(chunk.split("data: ")[1])["text"] for chunk in chunks if chunk.startswith("event: token")]
+        self.assertTrue("".join(tokens).endswith("night bus to Goa?\n\nAssistant:"))
+        self.assertEqual(chunks[-1], "event: done\ndata: {}\n\n")
+
+    def test_view_requires_a_question(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse("assistant_stream")).status_code, 400)
+
+
+class QueryParserTests(TestCase):
+    """Typed trip queries: the rules read the usual phrasings, and only leftovers reach the model, once."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("parse@example.com", "parse@example.com", "pw")
+        Conductor.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        route_index.index.clear()
+        place_index.index.clear()
+        query_parser.reset()
+        self.client.force_login(self.user)
+        self.client.post("/register_bus/", {
+            "bus_name": "Bus", "bus_number": "MH-1", "total_seats": 40,
+            "from_city": "Pune", "to_city": "Goa", "departure_time": "08:00", "arrival_time": "18:00",
+            "days": EVERY_DAY, "stops[]": ["Navi Mumbai", "Kolhapur"], "stop_times[]": ["10:00", "12:00"],
+        })
+        self.today = timezone.localdate().replace(year=2026, month=10, day=18)  # a Sunday
+
+    def params(self, text):
+        parsed = query_parser.parse(text, self.today, fallback=False)
+        self.assertEqual(parsed["via"], "rules")
+        return parsed["params"], parsed["time_of_day"]
+
+    def test_rules_read_common_phrasings(self):
+        self.assertEqual(self.params("sleeper AC from Pune to Goa next Friday evening"), ({
+            "source": "Pune", "destination": "Goa", "travel_date": "2026-10-23",
+            "bus_type": "AC", "sleeper_type": "Sleeper",
+        }, "evening"))
+        self.assertEqual(self.params("to goa from navi mumbai tomorrow")[0],
+                         {"source": "Navi Mumbai", "destination": "Goa", "travel_date": "2026-10-19"})
+        self.assertEqual(self.params("kolhapr goa non-ac seater 25/10 ladies")[0], {
+            "source": "Kolhapur", "destination": "Goa", "travel_date": "2026-10-25",
+            "bus_type": "Non-AC", "sleeper_type": "Seater", "is_woman_safe": "on",
+        })
+        self.assertEqual(self.params("A/C buses to Goa on sunday")[0],
+                         {"destination": "Goa", "bus_type": "AC", "travel_date": "2026-10-18"})
+        self.assertEqual(self.params("pune to goa 3 jan")[0]["travel_date"], "2027-01-03")
+
+    def test_leftovers_go_to_the_model_once(self):
+        answer = json.dumps({"source": "Pune", "destination": None, "day": "tomorrow", "bus_type": "AC"})
+        with StubAnthropic([(200, {"completion": answer})]) as stub:
+            with override_settings(ANTHROPIC_API_KEY="test-key", ANTHROPIC_API_URL=stub.url, LLM_CACHE=False):
+                anthropic_client.reset_client()
+                self.addCleanup(anthropic_client.reset_client)
+                first = query_parser.parse("PNQ to Goa", self.today)
+                again = query_parser.parse("pnq  to goa", self.today + timedelta(days=1))
+                self.assertEqual(query_parser.parse("Pune to Goa", self.today)["via"], "rules")
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual((first["via"], again["via"]), ("llm", "memo"))
+        self.assertEqual(first["params"], {
+            "source": "Pune", "destination": "Goa", "travel_date": "2026-10-19", "bus_type": "AC",
+        })
+        self.assertEqual(again["params"]["travel_date"], "2026-10-20")  # "tomorrow" resolved per call
+        self.assertEqual(query_parser.stats()["rules_rate"], round(1 / 3, 4))
+
+    def test_parse_view(self):
+        response = self.client.get(reverse("parse_query"), {"q": "Pune to Goa AC"})
+        body = response.json()
+        self.assertEqual(body["params"], {"source": "Pune", "destination": "Goa", "bus_type": "AC"})
+        self.assertEqual(body["search_url"], "/search/results/?source=Pune&destination=Goa&bus_type=AC")
+        self.assertEqual(self.client.get(reverse("parse_query")).status_code, 400)
+
+    def test_benchmark_reports_percentiles(self):
+        out = io.StringIO()
+        call_command("benchmark_query_parser", queries=300, stdout=out)
+        self.assertRegex(out.getvalue(), r"300 queries over \d+ places: p50 .* p99 .*us")
+
+
+class PageCacheTests(TestCase):
+    """Deploy-static pages are rendered once, spliced per user, and revalidate with 304s."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("page@example.com", "page@example.com", "pw",
+                                                        first_name="Asha")
+
+    def setUp(self):
+        cache.clear()
+        page_cache.reset()
+
+    def test_anonymous_revalidation_is_free(self):
+        first = self.client.get("/")
+        self.assertEqual(first.status_code, 200)
+        self.assertIn(b"Login", first.content)
+        self.assertIn("public", first["Cache-Control"])
+        self.assertTrue(first.has_header("Last-Modified"))
+        with self.assertNumQueries(0):
+            again = self.client.get("/", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again["ETag"], first["ETag"])
+        self.assertIn("Cookie", again["Vary"])
+
+    def test_cached_page_gets_the_users_header(self):
+        anonymous = self.client.get("/sectors/")
+        self.client.get("/")  # cached with the anonymous header
+        self.client.force_login(self.user)
+        response = self.client.get("/")
+        self.assertTemplateNotUsed(response, "main/index.html")
+        self.assertIn(b"Asha", response.content)
+        self.assertNotIn(b">Login<", response.content)
+        self.assertIn("private", response["Cache-Control"])
+        self.assertFalse(response.has_header("Last-Modified"))
+        self.assertEqual(self.client.get("/", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        self.assertEqual(self.client.get("/sectors/", HTTP_IF_NONE_MATCH=anonymous["ETag"]).status_code, 200)
+
+        self.user.first_name = "Asha R"
+        self.user.save()
+        renamed = self.client.get("/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(renamed.status_code, 200)
+        self.assertIn(b"Asha R", renamed.content)
+
+    def test_search_page_varies_by_query(self):
+        monday = self.client.get("/search/", {"Day": "Monday"})
+        plain = self.client.get("/search/")
+        self.assertNotEqual(monday["ETag"], plain["ETag"])
+        self.assertIn(b'value="Monday" selected', self.client.get("/search/", {"Day": "Monday"}).content)
+
+    @override_settings(PAGE_CACHE=False)
+    def test_disabled(self):
+        self.assertFalse(self.client.get("/").has_header("ETag"))
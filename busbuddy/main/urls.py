@@ -12,6 +12,14 @@ urlpatterns = [
     # Search flow
     path('search/', views.search, name='search'),                    # search page (form)
     path('search/results/', views.search_buses, name='search_results'),  # actual results page
+    path('search/api/', views.search_api, name='search_api'),  # same search as JSON, paginated
+    path('search/autocomplete/', views.autocomplete, name='autocomplete'),
+    path('search/journeys/', views.journey_api, name='journey_api'),  # multi-leg, with transfers
+    path('search/parse/', views.parse_query, name='parse_query'),  # typed trip -> search parameters
+
+    # AI travel assistant; the stream is server-sent events, served through asgi.py
+    path('assistant/', views.assistant, name='assistant'),
+    path('assistant/stream/', views.assistant_stream, name='assistant_stream'),
 
     # Auth
     path("login/", views.login_view, name="login"),
@@ -22,6 +30,8 @@ urlpatterns = [
     # Conductor
     path('conductor/register/', views.conductor_register, name='conductor_register'),
     path('conductor/dashboard/', views.conductor_dashboard, name='conductor_dashboard'),
+    path('conductor/bus/<int:pk>/schedules/', views.conductor_bus_schedules, name='conductor_bus_schedules'),
+    path('conductor/schedule/<int:pk>/bookings/', views.schedule_bookings, name='schedule_bookings'),
 
     # Bus registration
     path('register_bus/', views.register_bus, name='register_bus'),
@@ -31,8 +41,12 @@ urlpatterns = [
     path('start-booking/<int:schedule_id>/', views.start_booking, name='start_booking'),
     path('payment/<int:payment_id>/', views.payment_page, name='payment_page'),
     path('dashboard/', views.user_dashboard, name='user_dashboard'),
+    path('booking/<int:booking_id>/cancel/', views.cancel_booking, name='cancel_booking'),
 
     path('bookings/', views.bookings, name='bookings'),
+    path('ops/holds/', views.hold_stats, name='hold_stats'),
+    path('ops/search-cache/', views.search_cache_stats, name='search_cache_stats'),
+    path('ops/metrics/', views.metrics_export, name='metrics'),  # Prometheus scrape target
     # Static pages
     path('sectors/', views.sectors, name='sectors'),
     path('connected/', views.connected, name='connected'),
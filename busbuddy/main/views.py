@@ -1,19 +1,33 @@
 # main/views.py
-from collections import Counter
+import base64
+import binascii
+import bisect
+import json
 from datetime import datetime, time as dtime, timedelta
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.forms import UserCreationForm
 from django.db import transaction
+from django.core.paginator import Paginator
+from django.db.models import Count, F, Q, Window
+from django.db.models.functions import RowNumber
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
-from django.views.decorators.http import require_POST
+from django.urls import reverse
+from django.utils.http import urlencode
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_http_methods, require_POST
 from django.contrib.auth import logout
 from .forms import UserRegisterForm, User
 
 
 from .forms import BusDetailsForm, BusForm, BusSearchForm, ConductorForm
+from .instrumentation import query_budget
 from .models import (
     Booking,
     Bus,
@@ -23,15 +37,41 @@ from .models import (
     Stop,
     Route,
     Schedule,
+    Trip,
+    TripSegment,
+    annotate_bookable_trip,
+    days_to_mask,
     seats_available,
+    seats_available_bulk,
+    segment_availability,
+    weekday_bit,
+)
+from .services import (
+    anthropic_client,
+    fares,
+    holds,
+    inventory,
+    journeys,
+    metrics,
+    page_cache,
+    place_index,
+    query_parser,
+    reports,
+    route_index,
+    search_cache,
+    seatmap,
+    trips,
 )
 
 
+@query_budget(3)
+@page_cache.cached_page
 def index(request):
     return render(request, "main/index.html")
 
 
 
+@query_budget(4)
 def register(request):
     if request.method == 'POST':
         form = UserRegisterForm(request.POST)
@@ -54,6 +94,7 @@ def register(request):
 
     return render(request, 'main/register.html', {'form': form})
 
+@query_budget(8)
 def login_view(request):
     if request.method == "POST":
         email = request.POST.get("email")
@@ -89,6 +130,7 @@ def bus_register(request):
     return render(request, "main/bus_register.html", {"form": form})
 
 
+@query_budget(25)
 @login_required
 def bus_details(request, pk):
     bus = get_object_or_404(Bus, pk=pk)
@@ -113,6 +155,12 @@ def bus_details(request, pk):
                 days_value = days_selected
 
             with transaction.atomic():
+                # keep existing schedules' inventory in step with the new capacity
+                seats_delta = seats - bus.total_seats
+                if seats_delta:
+                    TripSegment.objects.filter(trip__schedule__bus=bus).update(
+                        seats_remaining=F("seats_remaining") + seats_delta
+                    )
                 bus.total_seats = seats
                 bus.ac_type = form.cleaned_data["ac_type"]
                 bus.bus_type = form.cleaned_data["bus_type"]
@@ -126,7 +174,10 @@ def bus_details(request, pk):
                     destination=destination,
                     stops=stops_raw,
                 )
+                transaction.on_commit(lambda: route_index.index.add(route))
+                transaction.on_commit(lambda: place_index.index.add(route))
 
+                new_stops = []
                 for idx, stop_name in enumerate(stops_list):
                     time_str = stop_times[idx] if idx < len(stop_times) else "00:00"
                     try:
@@ -134,20 +185,30 @@ def bus_details(request, pk):
                     except:
                         stop_time = dtime(0, 0)
 
-                    Stop.objects.create(
+                    new_stops.append(Stop(
                         route=route,
                         name=stop_name,
                         time=stop_time,
                         order=idx,
-                    )
+                    ))
+                Stop.objects.bulk_create(new_stops)
 
-                Schedule.objects.create(
+                schedule = Schedule.objects.create(
                     bus=bus,
                     route=route,  # Now this works
                     departure_time=departure,
                     arrival_time=arrival,
                     days=days_value,
+                    days_mask=days_to_mask(days_value),
                 )
+                trips.materialize_trips(schedules=Schedule.objects.filter(pk=schedule.pk))
+
+                # capacity and class changes show up in every search over this bus
+                route_ids = list(bus.routes.values_list("pk", flat=True))
+                schedule_ids = list(bus.schedules.values_list("pk", flat=True))
+                transaction.on_commit(search_cache.bump_catalog)
+                transaction.on_commit(lambda: search_cache.bump_routes(route_ids))
+                transaction.on_commit(lambda: search_cache.bump_schedules(schedule_ids))
 
             messages.success(request, "Bus details saved.")
             return redirect("conductor_dashboard")
@@ -157,19 +218,25 @@ def bus_details(request, pk):
 
     return render(request, "main/bus_details.html", {"form": form, "bus": bus})
 
-def _schedule_to_context(sched):
+def _schedule_to_context(sched, available=None, board=None, alight=None):
     """
     Convert a Schedule instance into a simple dict structure.
+    Pass `available` when it was already computed in bulk to avoid a query per schedule.
+    `board`/`alight` are the route positions of the passenger's journey (whole route by default).
     """
     route = sched.route if sched.route else None
     bus = sched.bus
-    available = seats_available(sched)
+    if available is None:
+        available = seats_available_bulk([sched.pk]).get(sched.pk, 0)
+    stop_names = route.stop_names() if route else []
+    board = board or 0
+    alight = alight if alight is not None else max(len(stop_names) - 1, 0)
     
     # Calculate duration
     duration = get_duration(sched.departure_time, sched.arrival_time)
     
-    # Calculate price
-    price = calculate_price(route, bus) if route else 0
+    # Per-seat fare for this journey, looked up in the route's fare matrix
+    price = route.fare(board, alight) if route else 0
     
     return {
         "id": sched.pk,
@@ -190,12 +257,164 @@ def _schedule_to_context(sched):
         "time": sched.departure_time.strftime("%H:%M"),
         "arrival_time": sched.arrival_time.strftime("%H:%M"),
         "days": sched.days or "",
+        "service_date": sched.service_date.strftime("%Y-%m-%d") if getattr(sched, "service_date", None) else "",
         "available": available,
+        "board": board,
+        "alight": alight,
+        "from_stop": stop_names[board] if stop_names else "",
+        "to_stop": stop_names[alight] if stop_names else "",
         "duration": duration,
+        "duration_minutes": _duration_minutes(sched.departure_time, sched.arrival_time),
         "price": price,
         "raw_schedule": sched,
     }
 
+def _search_query(params):
+    """
+    Normalize search parameters (both naming conventions) into a hashable query dict.
+    """
+    source = params.get('source') or params.get('from_place', '')
+    destination = params.get('destination') or params.get('to_place', '')
+    travel_date = params.get('travel_date')
+    day_filter = params.get('Day') or params.get('day_filter', '')
+
+    # Handle travel_date if provided
+    travel_date_obj = None
+    if travel_date:
+        try:
+            travel_date_obj = datetime.strptime(travel_date, "%Y-%m-%d").date()
+        except ValueError:
+            travel_date_obj = None
+
+    # Determine which weekday to use (priority: travel_date > Day filter)
+    day_bit = None
+    if travel_date_obj:
+        day_bit = 1 << travel_date_obj.weekday()
+    elif day_filter:
+        day_bit = weekday_bit(day_filter)
+
+    return {
+        "source": route_index.normalize(source),
+        "destination": route_index.normalize(destination),
+        "travel_date": travel_date_obj,
+        "day_bit": day_bit,
+        "bus_type": params.get('bus_type', ''),
+        "sleeper_type": params.get('sleeper_type', ''),
+        "is_woman_safe": params.get('is_woman_safe', '') == 'on',
+        # without a date the result is "the next departure", which moves every day
+        "today": None if travel_date_obj else timezone.localdate(),
+    }
+
+
+def _search_schedules(query):
+    """
+    Run a search. Returns (results, snapshot): the schedule context dicts and
+    the search cache version snapshot they were computed under.
+    """
+    travel_date_obj = query["travel_date"]
+    day_bit = query["day_bit"]
+    catalog = search_cache.versions()
+
+    # Only routes visiting source and then destination, via the stop index
+    matches = route_index.index.match(query["source"], query["destination"])
+    candidates = Schedule.objects.select_related("bus", "route").filter(route_id__in=list(matches))
+
+    # Date/day matching runs in SQL against the weekday bitmask
+    if day_bit is not None:
+        candidates = candidates.annotate(day_hit=F("days_mask").bitand(day_bit))
+    if travel_date_obj:
+        # Dated schedules must match the date, recurring ones the weekday
+        candidates = candidates.filter(
+            Q(date=travel_date_obj) | Q(date__isnull=True, day_hit__gt=0)
+        )
+    elif day_bit is not None:
+        candidates = candidates.filter(day_hit__gt=0)
+
+    # The trip each candidate would be booked on, in the same query. A date the
+    # horizon has not reached has no trip yet; a search does not create it, booking does
+    candidates = annotate_bookable_trip(candidates, travel_date_obj, day_bit)
+    if travel_date_obj:
+        candidates = candidates.filter(Q(trip_id__isnull=False) | trips.unmaterialized(travel_date_obj))
+
+    bus_type = query["bus_type"]
+    sleeper_type = query["sleeper_type"]
+    matched = []
+
+    for sched in candidates:
+        bus = sched.bus
+
+        # Bus type filters
+        if bus_type:
+            if bus_type == "AC" and bus.ac_type != "AC":
+                continue
+            if bus_type == "Non-AC" and bus.ac_type != "Non-AC":
+                continue
+
+        # Sleeper type filters
+        if sleeper_type:
+            if sleeper_type == "Sleeper" and not bus.is_sleeper:
+                continue
+            if sleeper_type == "Seater" and bus.is_sleeper:
+                continue
+
+        # Women safety filter
+        if query["is_woman_safe"]:
+            if not bus.driver_name:
+                continue
+
+        matched.append(sched)
+
+    if not travel_date_obj:
+        # the next departure may fall on a date with no trip yet, before the first materialized one
+        upcoming = trips.next_service_dates(matched, day_bit=day_bit)
+        for sched in matched:
+            day = upcoming.get(sched.pk)
+            if day is not None and (sched.trip_id is None or day < sched.service_date):
+                sched.trip_id, sched.service_date = None, day
+        matched = [sched for sched in matched if sched.trip_id is not None or sched.pk in upcoming]
+
+    # snapshot the schedule versions before reading availability, so a booking
+    # landing in between makes the cached entry stale rather than wrong
+    snapshot = search_cache.versions(
+        {sched.route_id for sched in matched}, [sched.pk for sched in matched], catalog=False
+    )
+    snapshot.update(catalog)
+
+    # Free seats over just the segments between source and destination, one query for all trips
+    availability = segment_availability({
+        sched.trip_id: matches[sched.route_id] for sched in matched if sched.trip_id is not None
+    })
+    results = []
+    for sched in matched:
+        if sched.trip_id is None:
+            # not materialized yet, so nothing is booked on it
+            sched.service_date = travel_date_obj or sched.service_date
+            available = sched.bus.total_seats
+        else:
+            available = availability[sched.trip_id]
+        if available <= 0:
+            continue
+        board, alight = matches[sched.route_id]
+        ctx = _schedule_to_context(sched, available, board, alight)
+        del ctx["raw_schedule"]  # results are cached; keep model instances out of them
+        results.append(ctx)
+    return results, snapshot
+
+
+def _cached_search(query, sort=None, sort_key=None):
+    """Results for `query`; with `sort`, cached under it already ordered by `sort_key`."""
+    if sort:
+        query = {**query, "sort": sort}
+    results = search_cache.lookup(query)
+    if results is None:
+        results, snapshot = _search_schedules(query)
+        if sort_key:
+            results.sort(key=sort_key)
+        search_cache.store(query, snapshot, results)
+    return results
+
+
+@query_budget(8)
 def search_buses(request):
     """
     Search schedules that match source, destination, and date/day criteria.
@@ -203,136 +422,18 @@ def search_buses(request):
     """
     form = BusSearchForm(request.GET or None)
     schedules_ctx = []
-    
+
     # Handle both parameter naming conventions
     source = request.GET.get('source') or request.GET.get('from_place', '')
     destination = request.GET.get('destination') or request.GET.get('to_place', '')
     travel_date = request.GET.get('travel_date')
     day_filter = request.GET.get('Day') or request.GET.get('day_filter', '')
-    
+
     # If form is valid or we have search parameters
     if form.is_valid() or source or destination:
-        source = source.strip().lower()
-        destination = destination.strip().lower()
-        
-        # Handle travel_date if provided
-        travel_date_obj = None
-        if travel_date:
-            try:
-                travel_date_obj = datetime.strptime(travel_date, "%Y-%m-%d").date()
-                # Get day name from date
-                day_from_date = travel_date_obj.strftime("%A")  # Monday, Tuesday, etc.
-                day_abbr_from_date = travel_date_obj.strftime("%a")  # Mon, Tue, etc.
-            except ValueError:
-                travel_date_obj = None
-                day_from_date = None
-                day_abbr_from_date = None
-        
-        # Handle day filter if provided
-        day_abbr = None
-        if day_filter:
-            day_name_map = {
-                'Monday': 'Mon' or 'mon' or 'monday', 'Tuesday': 'Tue' or 'tue' or 'tuesday', 'Wednesday': 'Wed' or 'wed' or 'wednesday',
-                'Thursday': 'Thu' or 'tue' or 'tuesday', 'Friday': 'Fri' or 'fri' or 'friday', 'Saturday': 'Sat' or 'sat' or 'saturday', 'Sunday': 'Sun' or 'sun' or 'sunday'
-            }
-            day_abbr = day_name_map.get(day_filter, day_filter[:3])
-        
-        # Determine which day to use (priority: travel_date > Day filter)
-        target_day_abbr = None
-        if travel_date_obj and day_abbr_from_date:
-            target_day_abbr = day_abbr_from_date
-        elif day_abbr:
-            target_day_abbr = day_abbr
-        
-        # Get all schedules with related data
-        candidates = Schedule.objects.select_related("bus", "route").all()
-        
-        for sched in candidates:
-            route = sched.route
-            if not route:  # Skip if no route
-                continue
-
-            # Build stops sequence: [origin, stops..., destination]
-            stops_seq = [route.origin.lower()]
-            if route.stops:
-                stops_seq += [s.strip().lower() for s in route.stops.split(",") if s.strip()]
-            stops_seq.append(route.destination.lower())
-
-            # Check if source and destination are in the route in correct order
-            try:
-                # Find source (partial match)
-                source_idx = -1
-                for i, stop in enumerate(stops_seq):
-                    if source in stop:
-                        source_idx = i
-                        break
-                
-                # Find destination after source
-                dest_idx = -1
-                for i in range(source_idx + 1, len(stops_seq)):
-                    if destination in stops_seq[i]:
-                        dest_idx = i
-                        break
-                
-                if source_idx == -1 or dest_idx == -1:
-                    continue
-                    
-            except Exception:
-                continue  # Source or destination not found in route
-
-            # Check date/day matching
-            if travel_date_obj:
-                # If schedule has specific date, check if it matches
-                if sched.date:
-                    if sched.date != travel_date_obj:
-                        continue
-                # If schedule has days, check if day matches
-                elif sched.days and target_day_abbr:
-                    if target_day_abbr not in sched.days:
-                        continue
-                else:
-                    # No date or days specified, skip
-                    continue
-            elif target_day_abbr:
-                # Only day filter provided (no specific date)
-                if sched.days:
-                    if target_day_abbr not in sched.days:
-                        continue
-                else:
-                    # No days specified, skip
-                    continue
-
-            bus = sched.bus
-            
-            # Get other filter parameters
-            bus_type = request.GET.get('bus_type', '')
-            sleeper_type = request.GET.get('sleeper_type', '')
-            is_woman_safe = request.GET.get('is_woman_safe', '') == 'on'
-            
-            # Bus type filters
-            if bus_type:
-                if bus_type == "AC" and bus.ac_type != "AC":
-                    continue
-                if bus_type == "Non-AC" and bus.ac_type != "Non-AC":
-                    continue
-            
-            # Sleeper type filters
-            if sleeper_type:
-                if sleeper_type == "Sleeper" and not bus.is_sleeper:
-                    continue
-                if sleeper_type == "Seater" and bus.is_sleeper:
-                    continue
-            
-            # Women safety filter
-            if is_woman_safe:
-                if not bus.driver_name:
-                    continue
-
-            avail = seats_available(sched)
-            if avail <= 0:
-                continue
-
-            schedules_ctx.append(_schedule_to_context(sched))
+        query = _search_query(request.GET)
+        source, destination = query["source"], query["destination"]
+        schedules_ctx = _cached_search(query)
 
     return render(
         request,
@@ -347,6 +448,190 @@ def search_buses(request):
         },
     )
 
+# sort keys for the JSON search API; every key ends in the schedule id so the order is total
+def _departure_key(result):
+    return int(result["time"][:2]) * 60 + int(result["time"][3:]), result["id"]
+
+
+def _price_key(result):
+    return result["price"], result["id"]
+
+
+def _duration_key(result):
+    return result["duration_minutes"], result["id"]
+
+
+def _descending(sort_key):
+    """`sort_key` with its value reversed; ties still go by ascending id."""
+    def descending_key(result):
+        value, pk = sort_key(result)
+        return -value, pk
+    return descending_key
+
+
+SEARCH_SORTS = {
+    "departure": _departure_key,
+    "price": _price_key,
+    "duration": _duration_key,
+}
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def _decode_cursor(cursor, *types):
+    """The key tuple in `cursor`, or None unless it is well formed with one value of each of `types`."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, TypeError, ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(key, list) or len(key) != len(types):
+        return None
+    if not all(isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(key, types)):
+        return None
+    return tuple(key)
+
+
+def _search_result_json(result):
+    """The compact projection of a search result returned by search_api."""
+    bus = result["bus"]
+    return {
+        "schedule_id": result["id"],
+        "service_date": result["service_date"],
+        "departure": result["time"],
+        "arrival": result["arrival_time"],
+        "duration_minutes": result["duration_minutes"],
+        "price": result["price"],
+        "available": result["available"],
+        "from_stop": result["from_stop"],
+        "to_stop": result["to_stop"],
+        "board": result["board"],
+        "alight": result["alight"],
+        "bus": {
+            "name": bus["name"],
+            "ac_type": bus["ac_type"],
+            "bus_type": bus["bus_type"],
+            "is_sleeper": bus["is_sleeper"],
+        },
+    }
+
+
+@query_budget(8)
+def search_api(request):
+    """
+    JSON variant of search_buses. Takes the same parameters plus `sort`
+    (departure, price or duration; prefix with "-" for descending), `limit`
+    and the `cursor` returned as `next_cursor` by the previous page.
+
+    Pages are keyset pages over the result list, which is cached already
+    sorted per sort order: the cursor is the sort key of the last result
+    served, so any page is found with a binary search instead of sorting or
+    skipping over the earlier ones.
+    """
+    sort = request.GET.get("sort", "departure")
+    descending = sort.startswith("-")
+    sort_key = SEARCH_SORTS.get(sort.lstrip("-"))
+    if sort_key is None:
+        return JsonResponse({"error": f"sort must be one of {', '.join(SEARCH_SORTS)}"}, status=400)
+    if descending:
+        sort_key = _descending(sort_key)
+
+    try:
+        limit = min(max(int(request.GET.get("limit", SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({"error": "limit must be an integer"}, status=400)
+
+    after = None
+    if request.GET.get("cursor"):
+        after = _decode_cursor(request.GET["cursor"], (int, float), int)
+        if after is None:
+            return JsonResponse({"error": "invalid cursor"}, status=400)
+
+    results = _cached_search(_search_query(request.GET), sort, sort_key)
+    start = bisect.bisect_right(results, after, key=sort_key) if after else 0
+    page = results[start:start + limit]
+    has_more = start + limit < len(results)
+
+    return JsonResponse({
+        "count": len(results),
+        "results": [_search_result_json(result) for result in page],
+        "next_cursor": _encode_cursor(sort_key(page[-1])) if has_more else None,
+    })
+
+
+MAX_TRANSFERS = 3
+
+
+@query_budget(6)
+def journey_api(request):
+    """
+    Journeys from `source` to `destination` on `travel_date` (today by
+    default), changing buses at most `max_transfers` times. Returns the
+    fastest itinerary and every slower one with fewer transfers; each leg
+    carries the start_booking link for its part of the route.
+    """
+    source = request.GET.get('source') or request.GET.get('from_place', '')
+    destination = request.GET.get('destination') or request.GET.get('to_place', '')
+    today = timezone.localdate()
+    try:
+        travel_date = datetime.strptime(request.GET['travel_date'], "%Y-%m-%d").date() if request.GET.get('travel_date') else today
+        max_transfers = min(max(int(request.GET.get('max_transfers', 2)), 0), MAX_TRANSFERS)
+    except ValueError:
+        return JsonResponse({"error": "travel_date must be YYYY-MM-DD and max_transfers an integer"}, status=400)
+    if travel_date < today:
+        return JsonResponse({"itineraries": []})
+
+    # today, only buses that have not left yet
+    now = timezone.localtime()
+    depart_after = now.hour * 60 + now.minute if travel_date == today else 0
+
+    itineraries = journeys.timetable.plan(source, destination, travel_date, depart_after, max_transfers + 1)
+    for itinerary in itineraries:
+        for leg in itinerary["legs"]:
+            leg["book_url"] = "{}?service_date={}&board={}&alight={}".format(
+                reverse("start_booking", args=[leg["schedule_id"]]), leg["service_date"], leg["board"], leg["alight"]
+            )
+    return JsonResponse({"itineraries": itineraries})
+
+
+AUTOCOMPLETE_LIMIT = 8
+
+
+@query_budget(3)
+def autocomplete(request):
+    """
+    Stop/city suggestions for the search form: `q` is the partly typed name.
+    Served from the in-memory place index, tolerating typos.
+    """
+    try:
+        limit = min(max(int(request.GET.get("limit", AUTOCOMPLETE_LIMIT)), 1), 20)
+    except ValueError:
+        limit = AUTOCOMPLETE_LIMIT
+    query = request.GET.get("q", "")
+    return JsonResponse({"query": query, "suggestions": place_index.index.suggest(query, limit)})
+
+
+PARSE_MAX_QUERY = 200
+
+
+@query_budget(3)
+def parse_query(request):
+    """
+    search_buses parameters for a trip typed in plain words (`q`), such as
+    "sleeper AC from Pune to Goa next Friday evening", with the results URL.
+    """
+    query = request.GET.get("q", "").strip()[:PARSE_MAX_QUERY]
+    if not query:
+        return JsonResponse({"error": "Type a trip with ?q=."}, status=400)
+    parsed = query_parser.parse(query)
+    parsed["query"] = query
+    parsed["search_url"] = f"{reverse('search_results')}?{urlencode(parsed['params'])}"
+    return JsonResponse(parsed)
+
+
 def search_results(request):
     source = request.GET.get("source", "")
     destination = request.GET.get("destination", "")
@@ -401,28 +686,61 @@ def search_results(request):
         "schedules": schedules
     })
 
+USER_BOOKINGS_PER_PAGE = 20
+
+
+@query_budget(6)
 @login_required(login_url="login")
 def user_dashboard(request):
     """
     Shows bookings for the logged-in user and frequent routes.
+    Bookings are paged newest first with a keyset cursor (`before`), so a
+    deep page costs the same as the first.
     """
-    bookings = request.user.bookings.select_related("schedule__route", "schedule__bus").order_by("-created_at")
-    routes = [
-        (b.schedule.route.origin, b.schedule.route.destination)
-        for b in bookings
-        if b.schedule and b.schedule.route
-    ]
-    freq = Counter(routes).most_common(5)
+    bookings = request.user.bookings.select_related("schedule__route", "schedule__bus").order_by("-created_at", "-pk")
+    if request.GET.get("before"):
+        before = _decode_cursor(request.GET["before"], str, int)
+        try:
+            # well formed but impossible dates (Feb 30) raise rather than return None
+            created_at = parse_datetime(before[0]) if before else None
+        except ValueError:
+            created_at = None
+        if created_at is None:
+            # a cursor we did not issue: start again from the first page
+            return redirect("user_dashboard")
+        bookings = bookings.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=before[1]))
+    page = list(bookings[:USER_BOOKINGS_PER_PAGE + 1])
+    next_cursor = None
+    if len(page) > USER_BOOKINGS_PER_PAGE:
+        page = page[:USER_BOOKINGS_PER_PAGE]
+        next_cursor = _encode_cursor((page[-1].created_at.isoformat(), page[-1].pk))
+
+    freq = (
+        request.user.bookings.filter(schedule__route__isnull=False)
+        .order_by()
+        .values_list("schedule__route__origin", "schedule__route__destination")
+        .annotate(n=Count("pk"))
+        .order_by("-n", "schedule__route__origin", "schedule__route__destination")[:5]
+    )
     return render(
         request,
         "main/user_dashboard.html",
         {
-            "bookings": bookings,
-            "frequent_routes": freq,
+            "bookings": page,
+            "next_cursor": next_cursor,
+            "first_page": not request.GET.get("before"),
+            "frequent_routes": [((origin, destination), n) for origin, destination, n in freq],
         },
     )
 
 
+CONDUCTOR_BUSES_PER_PAGE = 10
+CONDUCTOR_SCHEDULES_PER_BUS = 5
+SCHEDULES_PER_PAGE = 20
+BOOKINGS_PER_PAGE = 25
+
+
+@query_budget(14)
 @login_required(login_url="login")
 def conductor_dashboard(request):
     """
@@ -432,17 +750,69 @@ def conductor_dashboard(request):
     conductor = getattr(request.user, "conductor", None)
     if not conductor:
         return redirect("conductor_register")
-    buses = conductor.buses.prefetch_related("routes", "schedules", "schedules__bookings")
-    # prepare a small context for templates
-    buses_ctx = []
-    for b in buses:
-        schedules = []
-        for s in b.schedules.all():
-            schedules.append(_schedule_to_context(s))
-        buses_ctx.append({"bus": b, "schedules": schedules})
-    return render(request, "main/conductor_dashboard.html", {"buses": buses_ctx})
+    page = Paginator(conductor.buses.order_by("pk"), CONDUCTOR_BUSES_PER_PAGE).get_page(request.GET.get("page"))
+    bus_ids = [bus.pk for bus in page]
+    totals = reports.bus_stats(bus_ids)
+
+    # only the first few schedules of each bus on the page; the rest are one click away
+    first_schedules = (
+        Schedule.objects.select_related("bus", "route")
+        .filter(bus_id__in=bus_ids)
+        .annotate(rank=Window(RowNumber(), partition_by=F("bus_id"), order_by=[F("departure_time").asc(), F("pk").asc()]))
+        .filter(rank__lte=CONDUCTOR_SCHEDULES_PER_BUS)
+    )
+    schedules = {}
+    for row in _schedule_rows(first_schedules):
+        schedules.setdefault(row["raw_schedule"].bus_id, []).append(row)
+
+    buses_ctx = [
+        {"bus": bus, "totals": totals[bus.pk], "schedules": schedules.get(bus.pk, [])}
+        for bus in page
+    ]
+    return render(request, "main/conductor_dashboard.html", {"buses": buses_ctx, "page": page})
+
 
+def _schedule_rows(schedules):
+    """Dashboard rows for a page of schedules: next-trip availability plus grouped sales figures."""
+    schedules = list(schedules)
+    ids = [s.pk for s in schedules]
+    availability = seats_available_bulk(ids)
+    stats = reports.schedule_stats(ids)
+    rows = []
+    for s in schedules:
+        row = _schedule_to_context(s, availability.get(s.pk, 0))
+        row.update(stats[s.pk])
+        rows.append(row)
+    return rows
 
+
+@query_budget(11)
+@login_required(login_url="login")
+def conductor_bus_schedules(request, pk):
+    """All schedules of one of the conductor's buses, a page at a time."""
+    bus = get_object_or_404(Bus, pk=pk, conductor__user=request.user)
+    schedules = bus.schedules.select_related("bus", "route").order_by("departure_time", "pk")
+    page = Paginator(schedules, SCHEDULES_PER_PAGE).get_page(request.GET.get("page"))
+    return render(request, "main/conductor_bus_schedules.html", {
+        "bus": bus,
+        "page": page,
+        "schedules": _schedule_rows(page),
+    })
+
+
+@query_budget(7)
+@login_required(login_url="login")
+def schedule_bookings(request, pk):
+    """Bookings on one of the conductor's schedules, newest first, a page at a time."""
+    schedule = get_object_or_404(
+        Schedule.objects.select_related("bus", "route"), pk=pk, bus__conductor__user=request.user
+    )
+    bookings = schedule.bookings.select_related("user", "trip").order_by("-created_at", "-pk")
+    page = Paginator(bookings, BOOKINGS_PER_PAGE).get_page(request.GET.get("page"))
+    return render(request, "main/schedule_bookings.html", {"schedule": schedule, "page": page})
+
+
+@query_budget(6)
 @login_required(login_url="login")
 def conductor_register(request):
     """
@@ -466,6 +836,7 @@ def conductor_register(request):
     return render(request, "main/conductor_register.html", {"form": form})
 
 
+@query_budget(20)
 @login_required(login_url="login")
 def register_bus(request):
     conductor = getattr(request.user, "conductor", None)
@@ -547,8 +918,11 @@ def register_bus(request):
                     destination=to_city,
                     stops=stops_string,
                 )
+                transaction.on_commit(lambda: route_index.index.add(route))
+                transaction.on_commit(lambda: place_index.index.add(route))
 
-                # Save stops properly
+                # Save stops properly, in one INSERT
+                new_stops = []
                 for idx, stop_name in enumerate(stops_list):
                     stop_name = stop_name.strip()
                     if not stop_name:
@@ -560,22 +934,26 @@ def register_bus(request):
                     except:
                         stop_time = dtime(0, 0)
 
-                    Stop.objects.create(
+                    new_stops.append(Stop(
                         route=route,
                         name=stop_name,
                         time=stop_time,
                         order=idx
-                    )
+                    ))
+                Stop.objects.bulk_create(new_stops)
 
                 # Create schedule with days or specific date
-                Schedule.objects.create(
+                schedule = Schedule.objects.create(
                     bus=bus,
                     route=route,
                     date=specific_date,  # Will be None if not specified
                     departure_time=dep_t,
                     arrival_time=arr_t,
                     days=days_value if not specific_date else None,  # Only set days if no specific date
+                    days_mask=days_to_mask(days_value) if not specific_date else 0,
                 )
+                trips.materialize_trips(schedules=Schedule.objects.filter(pk=schedule.pk))
+                transaction.on_commit(search_cache.bump_catalog)
 
             messages.success(request, "Bus registered successfully.")
             return redirect("conductor_dashboard")
@@ -586,50 +964,114 @@ def register_bus(request):
 
     return render(request, "main/register_bus.html", {})
 
+@query_budget(22)
 @login_required(login_url="login")
-@require_POST
+@require_http_methods(["GET", "POST"])
 def start_booking(request, schedule_id):
     """
-    Start booking: creates a Booking and a Payment placeholder, then redirects to payment_page.
+    GET renders the seat picker for a trip. POST takes the seats, creates a
+    Booking and a Payment placeholder, then redirects to payment_page.
     """
-    schedule = get_object_or_404(Schedule, pk=schedule_id)
+    schedule = get_object_or_404(Schedule.objects.select_related("bus", "route"), pk=schedule_id)
+    data = request.POST if request.method == "POST" else request.GET
+
+    # seats are sold per dated trip; without a date, book the next departure
+    service_date = None
+    if data.get("service_date"):
+        try:
+            service_date = datetime.strptime(data["service_date"], "%Y-%m-%d").date()
+        except ValueError:
+            service_date = None
+    # a GET only shows the trip; one past the horizon is created by the booking itself
+    create = request.method == "POST"
+    trip = trips.get_trip(schedule, service_date, create) if service_date else trips.next_trip(schedule, create=create)
+    if trip is None:
+        messages.error(request, "This bus does not run on the selected date.")
+        return redirect("bookings")
+
+    # the part of the route travelled, as route positions; the whole route by default
+    last_stop = trips.segment_count(schedule.route)
     try:
-        seats_requested = int(request.POST.get("seats", 1))
+        board = int(data.get("board", 0))
+        alight = int(data.get("alight", last_stop))
     except (TypeError, ValueError):
-        seats_requested = 1
-
-    avail = seats_available(schedule)
-    if seats_requested <= 0 or seats_requested > avail:
-        messages.error(request, f"Only {avail} seats available.")
-        # redirect back to search/bookings
+        board, alight = 0, last_stop
+    if not 0 <= board < alight <= last_stop:
+        messages.error(request, "Invalid boarding or alighting stop.")
         return redirect("bookings")
 
-    # price per seat can be sent from form or defaulted
+    if request.method == "GET":
+        if trip.pk is None:
+            occupied, available = 0, schedule.bus.total_seats
+        else:
+            # one query over the journey's segment seat maps, no per-booking parsing
+            occupied = inventory.journey_seat_map(trip, board, alight)
+            available = seats_available(trip, board, alight)
+        return render(request, "main/start_booking.html", {
+            "schedule": _schedule_to_context(schedule, available, board, alight),
+            "service_date": trip.service_date.strftime("%Y-%m-%d"),
+            "available": available,
+            "seat_list": seatmap.free_seats(occupied, schedule.bus.total_seats),
+        })
+
+    # each seat once, so the count charged matches the seats marked taken
+    seat_numbers = sorted({int(n) for n in request.POST.getlist("seat_numbers") if n.isdigit()})
+    if any(not 1 <= seat <= schedule.bus.total_seats for seat in seat_numbers):
+        messages.error(request, "Invalid seat number.")
+        return redirect("bookings")
     try:
-        price_per_seat = float(request.POST.get("price_per_seat", 200.0))
+        seats_requested = len(seat_numbers) or int(request.POST.get("seats", 1))
     except (TypeError, ValueError):
-        price_per_seat = 200.0
+        seats_requested = 1
+
+    if seats_requested <= 0:
+        messages.error(request, "Select at least one seat.")
+        return redirect("bookings")
+
+    # the fare is always the server's, from the route's fare matrix
+    price_per_seat = schedule.route.fare(board, alight) if schedule.route else fares.FLAT_FARE
     total_amount = seats_requested * price_per_seat
 
-    # create booking + payment inside a transaction
+    # abandoned checkouts on this trip give their seats back before we check
+    holds.release_expired(trip_ids=[trip.pk])
+
+    # take the seats and create booking + payment inside a transaction;
+    # the conditional decrement is the only availability check, so there is no read-then-write race
     with transaction.atomic():
-        booking = Booking.objects.create(
-            user=request.user,
-            schedule=schedule,
-            seats=seats_requested,
-            amount_paid=0,
-            paid=False,
-        )
-        payment = Payment.objects.create(
-            booking=booking,
-            provider="razorpay",
-            amount=total_amount,
-            status="initiated",
-        )
+        reserved = inventory.reserve_seats(trip.pk, seats_requested, board, alight, seat_numbers)
+        if reserved:
+            booking = Booking.objects.create(
+                user=request.user,
+                schedule=schedule,
+                trip=trip,
+                seats=seats_requested,
+                seat_numbers=seatmap.format_seat_numbers(reserved),
+                board_order=board,
+                alight_order=alight,
+                amount_paid=0,
+                paid=False,
+            )
+            payment = Payment.objects.create(
+                booking=booking,
+                provider="razorpay",
+                amount=total_amount,
+                status="initiated",
+            )
+            holds.place_hold(booking)
+            transaction.on_commit(lambda: search_cache.bump_schedules([schedule.pk]))
+
+    if not reserved:
+        if seat_numbers:
+            messages.error(request, "Some of the selected seats are no longer free.")
+        else:
+            messages.error(request, f"Only {seats_available(trip, board, alight)} seats available.")
+        # redirect back to search/bookings
+        return redirect("bookings")
 
     return redirect("payment_page", payment_id=payment.pk)
 
 
+@query_budget(16)
 @login_required(login_url="login")
 def payment_page(request, payment_id):
     """
@@ -637,70 +1079,161 @@ def payment_page(request, payment_id):
     Replace with real gateway integration (Razorpay/Stripe) in production.
     """
     payment = get_object_or_404(Payment, pk=payment_id)
+    booking = payment.booking
+    if not booking.paid and (booking.cancelled or holds.is_expired(booking)):
+        holds.release_expired(trip_ids=[booking.trip_id])
+        messages.error(request, "Your seat hold expired before payment completed. Please book again.")
+        return redirect("bookings")
+
     if request.method == "POST":
         # Simulate the provider callback / success
-        payment.status = "succeeded"
-        payment.provider_payment_id = request.POST.get("provider_payment_id", "simulated")
-        payment.save()
-
-        booking = payment.booking
-        booking.paid = True
-        booking.amount_paid = payment.amount
-        booking.save()
+        with transaction.atomic():
+            if not holds.confirm(booking):
+                messages.error(request, "Your seat hold expired before payment completed. Please book again.")
+                return redirect("bookings")
+            payment.status = "succeeded"
+            payment.provider_payment_id = request.POST.get("provider_payment_id", "simulated")
+            payment.save()
+
+            booking.paid = True
+            booking.amount_paid = payment.amount
+            booking.save(update_fields=["paid", "amount_paid"])
+            transaction.on_commit(lambda: search_cache.bump_schedules([booking.schedule_id]))
 
         messages.success(request, "Payment successful — booking confirmed.")
         return redirect("user_dashboard")
 
-    return render(request, "main/payment_page.html", {"payment": payment})
+    hold = getattr(booking, "hold", None) if not booking.paid else None
+    return render(request, "main/payment_page.html", {"payment": payment, "hold": hold})
+
+
+@query_budget(15)
+@login_required(login_url="login")
+@require_POST
+def cancel_booking(request, booking_id):
+    """
+    Cancel one of the logged-in user's bookings and return its seats to inventory.
+    """
+    booking = get_object_or_404(Booking, pk=booking_id, user=request.user)
+    if inventory.cancel_booking(booking):
+        search_cache.bump_schedules([booking.schedule_id])
+        messages.success(request, "Booking cancelled.")
+    else:
+        messages.info(request, "This booking was already cancelled.")
+    return redirect("user_dashboard")
 
 
+@query_budget(3)
 @login_required(login_url="login")
 def bookings(request):
     """Simple wrapper if you want a dedicated bookings view."""
     return render(request, "main/bookings.html")
 
+@query_budget(5)
+@staff_member_required
+def hold_stats(request):
+    """Live seat hold counters for monitoring."""
+    return JsonResponse({
+        "live_holds": holds.live_count(),
+        "expired_holds_pending_release": holds.expired_count(),
+    })
+
+
+@query_budget(3)
+@staff_member_required
+def search_cache_stats(request):
+    """Search cache hit/miss counters of this worker process."""
+    return JsonResponse(search_cache.stats())
+
+
+ASSISTANT_MAX_QUESTION = 500
+ASSISTANT_PROMPT = (
+    "\n\nHuman: You are the travel assistant of BusBuddy, an intercity bus booking site in India. "
+    "Answer briefly and practically.\n\n{question}\n\nAssistant:"
+)
+
+
+@query_budget(3)
+@login_required(login_url="login")
+def assistant(request):
+    return render(request, "main/assistant.html")
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _assistant_events(prompt, model):
+    # a comment line goes out at once, so the browser has its first byte before the model starts
+    yield ": stream open\n\n"
+    try:
+        async for piece in anthropic_client.astream(prompt, model=model):
+            yield _sse("token", {"text": piece})
+    except anthropic_client.AnthropicError as exc:
+        yield _sse("error", {"message": str(exc)})
+    else:
+        yield _sse("done", {})
+
+
+@query_budget(3)
+@login_required(login_url="login")
+async def assistant_stream(request):
+    """
+    Relay the assistant's answer to `q` as server-sent events while it is
+    generated. Served through busbuddy/asgi.py, a client that disconnects
+    cancels the stream, which closes the upstream request.
+    """
+    question = request.GET.get("q", "").strip()[:ASSISTANT_MAX_QUESTION]
+    if not question:
+        return JsonResponse({"error": "Ask a question with ?q=."}, status=400)
+    model = (settings.AI_ENABLED_MODELS or ["claude-haiku-4.5"])[0]
+    response = StreamingHttpResponse(
+        _assistant_events(ASSISTANT_PROMPT.format(question=question), model),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # keep proxies from buffering the stream
+    return response
+
+
+@query_budget(3)
+@staff_member_required
+def metrics_export(request):
+    """Request metrics of every worker process, in Prometheus text format."""
+    return HttpResponse(metrics.prometheus_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@query_budget(3)
+@page_cache.cached_page
 def search(request):
     return render(request, "main/search.html")
 
+@query_budget(2)
+@page_cache.cached_page
 def sectors(request):
     return render(request, "main/sectors.html")
 
+@query_budget(2)
+@page_cache.cached_page
 def connected(request):
     return render(request, "main/connected.html")
+@query_budget(2)
+@page_cache.cached_page
 def who_we_are(request):
     return render(request, "main/who_we_are.html")
 
+@query_budget(5)
 def logout_user(request):
     logout(request)
     messages.success(request, "You have been logged out.")
     return redirect("index")
 
-def get_duration(departure, arrival):
+def _duration_minutes(departure, arrival):
     dep = datetime.combine(datetime.today(), departure)
     arr = datetime.combine(datetime.today(), arrival)
     if arr < dep:
         arr += timedelta(days=1)    # next day arrival for overnight buses
-    diff = arr - dep
-    hours = diff.seconds // 3600
-    mins = (diff.seconds % 3600) // 60
-    return f"{hours}h {mins}m"
-
-def calculate_price(route, bus):
-    if not route:
-        return 200 
-    
-    base = 150
+    return (arr - dep).seconds // 60
 
-    stops = [route.origin] + [s.strip() for s in route.stops.split(",") if s.strip()] + [route.destination]
-
-    distance = len(stops) * 40
-
-    price = base + (distance * 2)
-
-    if bus.is_sleeper:
-        price += price * 0.3
-
-    if bus.ac_type:
-        price += price * 0.2
-
-    return int(price)
+def get_duration(departure, arrival):
+    minutes = _duration_minutes(departure, arrival)
+    return f"{minutes // 60}h {minutes % 60}m"